@@ -0,0 +1,250 @@
+"""
+Backfills the lustre_usage table for a range of past dates.
+
+Every wrstat file in the range is found up front, and they're all read
+in parallel (a process per file, up to --processes at a time, oldest
+first). Only the last bit - adding any missing PIs, groups, volumes or
+base directories, then loading the day - is done one at a time, as soon
+as a day and every day before it have been read, so each day's warnings
+are worked out from the history as it was then. A file that can't be
+read is logged and skipped, and the rest of its day is loaded anyway.
+
+Loading a day replaces whatever was in lustre_usage for that volume on
+that day, so running this over the same range twice is harmless. Days
+the run ledger has as loaded, or as still loading (which could be the
+nightly run, part way through), are skipped, unless --reload is given.
+
+The directory tables aren't backfilled - they only hold the latest data,
+which is group_reporter.py's job. Quotas aren't backfilled either, the
+current ones are used.
+
+    python backfill.py --since 2021-11-01 --until 2022-06-01
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import logging
+import logging.config
+import multiprocessing
+import operator
+import os
+import typing as T
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import db.common
+import db.group_reporter
+import db.history
+import db.ledger
+import db.metrics
+import db_config as config
+import reporter.aggregate
+import utils.finder
+import utils.hardlinks
+import utils.ldap
+import utils.wrstat
+from directory_config import EXACT_HARDLINKS, LOGGING_CONFIG, METRICS_TO_DB, VOLUMES, WRSTAT_DIR
+from lurge_types.group_report import GroupReport
+from utils.metrics import Metrics
+from utils.quota import QuotaReader
+from utils.spill import SpillingAggregator
+
+
+def get_reports_from_wrstat(
+        volume: int, date: datetime.date, report_path: str,
+        names: T.Tuple[T.Dict[int, str], T.Dict[int, str]],
+        logger: logging.Logger) -> T.Tuple[int, datetime.date, T.List[GroupReport], Metrics]:
+    """Reads one day's wrstat file for a volume into GroupReports, the same
+    way group_reporter.py's workers do
+
+    :param names: - (group_id: pi name, group_id: group_name)
+
+    :returns: volume, date, the GroupReports (without their subdirectories,
+        as we're not backfilling those) and the Metrics for this file
+    """
+    metrics = Metrics("backfill", f"Volume {volume} ({date})")
+    wrstat_time = int(os.stat(report_path).st_mtime)
+
+    # the base directories as they were at the time
+    with metrics.stage("read_base_directories"):
+        base_directory_info = utils.finder.read_base_directories(
+            Path(WRSTAT_DIR), as_of=wrstat_time)
+
+    # (gid, base_path)
+    reports: SpillingAggregator[T.Tuple[int, str], GroupReport] = \
+        SpillingAggregator(operator.iadd)
+
+    hardlink_owners = None
+    if EXACT_HARDLINKS:
+        logger.info(f"finding hardlinks in {report_path}")
+        hardlink_owners = utils.hardlinks.scan_owners(report_path, metrics)
+
+    logger.info(f"reading {report_path}")
+    with metrics.stage("read_wrstat", bytes=os.path.getsize(report_path)) as stage:
+        for block in utils.wrstat.read_blocks(report_path):
+            reporter.aggregate.process_block(
+                block, base_directory_info, volume, reports, metrics, hardlink_owners,
+                as_of=wrstat_time)
+            reports.maybe_spill()
+            stage.lines += len(block)
+
+    pis, groups = names
+    finished_reports: T.List[GroupReport] = []
+    for key, report in reports.items():
+        report.subdirs = {}
+        report.tree = {}
+        report.pi_name = pis.get(key[0])
+        report.group_name = groups.get(key[0])
+        report.wrstat_time = wrstat_time
+        report.base_path = key[1]
+        finished_reports.append(report)
+
+    logger.info(f"finished {report_path}")
+    return volume, date, finished_reports, metrics
+
+
+def _read_day(task: T.Tuple[int, datetime.date, str,
+                             T.Tuple[T.Dict[int, str], T.Dict[int, str]], logging.Logger]
+              ) -> T.Tuple[int, datetime.date, T.Optional[T.List[GroupReport]], Metrics]:
+    """get_reports_from_wrstat (for imap_unordered), but a file we can't read
+    is logged, and comes back with None for its reports, rather than stopping
+    everything"""
+    volume, date, report_path, _, logger = task
+    try:
+        return get_reports_from_wrstat(*task)
+    except Exception:
+        logger.exception(f"couldn't read {report_path}, skipping it")
+        return volume, date, None, Metrics("backfill", f"Volume {volume} ({date})")
+
+
+def main(since: datetime.date, until: datetime.date, volumes: T.List[int] = VOLUMES,
+         processes: T.Optional[int] = None, reload: bool = False) -> None:
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+    metrics = Metrics("backfill")
+
+    db_conn = db.common.get_sql_connection(config)
+
+    with metrics.stage("ldap"):
+        ldap_conn = utils.ldap.get_ldap_connection()
+        group_pi_names = utils.ldap.get_groups_ldap_info(ldap_conn)
+
+    # Find every wrstat file we're going to need
+    tasks: T.List[T.Tuple[int, datetime.date, str,
+                          T.Tuple[T.Dict[int, str], T.Dict[int, str]], logging.Logger]] = []
+    for volume in volumes:
+        for date, report_path in utils.finder.find_reports(
+                f"scratch{volume}", WRSTAT_DIR, since, until):
+            wrstat_mtime = int(os.stat(report_path).st_mtime)
+            with metrics.stage("check_date"):
+                # the run ledger has what's loaded (see db/ledger.py). A day
+                # that's still marked as loading could be the nightly run's,
+                # part way through, so it's only taken over with --reload
+                if reload:
+                    db.ledger.record(db_conn, "group_reporter", volume, date,
+                                     db.ledger.LOADING, wrstat_path=report_path,
+                                     wrstat_mtime=wrstat_mtime)
+                elif not db.ledger.begin_run(db_conn, "group_reporter", volume, date,
+                                             report_path, wrstat_mtime, logger,
+                                             take_over=False):
+                    continue
+            tasks.append((volume, date, report_path, group_pi_names, logger))
+
+    logger.info(f"backfilling from {len(tasks)} wrstat files")
+    tasks.sort(key=lambda task: task[1])
+
+    with metrics.stage("quota"):
+        quota_readers = {volume: QuotaReader(volume)
+                         for volume in {task[0] for task in tasks}}
+
+    # make sure the history store's been seeded from MySQL
+    db.history.get_historical_usage()
+    history_store = db.history.HistoryStore()
+
+    def load_day(date: datetime.date, day: T.List[T.Tuple[int, T.List[GroupReport]]]) -> None:
+        logger.info(f"loading {date}")
+        with metrics.stage("foreign_keys"):
+            keys = db.group_reporter.resolve_foreign_keys(
+                db_conn, (report for _, reports in day for report in reports),
+                logging.LoggerAdapter(logger, {}))
+
+        with metrics.stage("history"):
+            history = history_store.usage_before(date)
+
+        for volume, reports in day:
+            if len(reports) == 0:
+                # nothing to load, but it's done
+                db.ledger.complete_run(db_conn, "group_reporter", volume, date, 0)
+                continue
+
+            warnings: T.List[T.Optional[int]] = []
+            with metrics.stage("warnings"):
+                for report in reports:
+                    if report.group_name is not None:
+                        report.quota = quota_readers[report.volume].get_quota(
+                            report.group_name)
+                    warnings.append(report.get_warning(
+                        history, datetime.datetime.fromtimestamp(report.wrstat_time)))
+
+            with metrics.stage("db_load"), db.common.statement_metrics(metrics):
+                db.group_reporter.load_usage_into_db(
+                    db_conn, reports, date, volume, keys, warnings, metrics)
+
+        with metrics.stage("history"):
+            db.history.record_reports([reports for _, reports in day])
+
+    # The files are read as many at once as we can, oldest first, and each
+    # day's loaded (one at a time) as soon as it and every day before it
+    # have been read, so only the days waiting on an older one are held
+    unread: T.Counter[datetime.date] = Counter(task[1] for task in tasks)
+    to_load = sorted(unread)
+    days: T.DefaultDict[datetime.date,
+                        T.List[T.Tuple[int, T.List[GroupReport]]]] = defaultdict(list)
+    failed = 0
+    with metrics.stage("read_and_load"), \
+            multiprocessing.Pool(processes=processes) as pool:
+        for volume, date, reports, task_metrics in pool.imap_unordered(
+                _read_day, tasks):
+            metrics.merge(task_metrics)
+            unread[date] -= 1
+            if reports is None:
+                # nothing was loaded, so it's not left marked as loading
+                failed += 1
+                db.ledger.abandon_run(db_conn, "group_reporter", volume, date)
+            else:
+                days[date].append((volume, reports))
+
+            while to_load and unread[to_load[0]] == 0:
+                ready = to_load.pop(0)
+                if ready in days:
+                    load_day(ready, days.pop(ready))
+
+    if failed:
+        logger.error(f"{failed} wrstat files couldn't be read, and weren't loaded")
+
+    logger.info(f"run metrics written to {metrics.write_summary()}")
+    if METRICS_TO_DB:
+        db.metrics.write_run_metrics(db_conn, metrics, logger)
+
+    logger.info("Done")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backfill lustre_usage from old wrstat files")
+    parser.add_argument("--since", type=datetime.date.fromisoformat, required=True,
+                        help="first date to backfill (YYYY-MM-DD)")
+    # not today - that's the nightly run's to load
+    parser.add_argument("--until", type=datetime.date.fromisoformat,
+                        default=datetime.date.today() - datetime.timedelta(days=1),
+                        help="last date to backfill (YYYY-MM-DD), defaults to yesterday")
+    parser.add_argument("--volumes", type=int, nargs="+", default=VOLUMES)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="wrstat files to read at once, defaults to the number of CPUs")
+    parser.add_argument("--reload", action="store_true",
+                        help="replace days that already have data")
+    args = parser.parse_args()
+
+    main(args.since, args.until, args.volumes, args.processes, args.reload)
@@ -1,30 +1,29 @@
 #!/usr/bin/env bash
 
-# We're going to submit a whole load of farm jobs to backfill a load of data
+# We're going to submit a farm job to backfill a load of data (see backfill.py)
 
-# Firstly, the MAX_DAYS_AGO variable must be set to a much larger value
-# in directory_config.py
+# Every wrstat file between SINCE and UNTIL is read in parallel, one per CPU,
+# and then loaded into the DB a day at a time, so unlike the old way of doing
+# this (an LSF job array running group_reporter.py one job at a time), there's
+# no need to change MAX_DAYS_AGO, or work out how many jobs we need.
 
-# Also, NOTE - the quota will not be backfilled, it'll just fill in as the 
-# current quota.
+# NOTE - the quota will not be backfilled, it'll just fill in as the
+# current quota, and only the lustre_usage table is backfilled (the
+# directory tables only ever have the latest data in)
 
-# Also NOTE - you should ensure it can always access a base directory info
-# file - maybe change `utils/finder.py` to use a current one if older ones
-# don't exist
+# Also NOTE - each day uses the most recent base directory info file from
+# no later than that day, or the oldest one there is if there aren't any
+# that old
 
-# Also, set the number of jobs in the array appropriately. Remeber, each run
-# will go from that number of days back as far back as it can until it finds 
-# some data to fill in. Only one should be run at a time, to avoid conflicts
-# i.e. two simulataneous processes both adding the same group to the DB and
-# oh look now it's there twice, but it should only be there once.
+# Days that already have data are skipped, so if it dies, just run it again.
+# Days it was part way through loading are skipped too (as far as it can
+# tell, that could be the nightly run loading them), so if it died while
+# loading, add --reload to the command, which replaces every day instead.
+# UNTIL shouldn't be today, that's the nightly run's to load.
 
 # Example: it's June 2022 and we want to fill in data back to November 2021.
-# That's approximately 210 days. We know wrstat only outputs every four days
-# if we're lucky, so at maximum, we need 52 runs. So we'll do that. It's not 
-# precise maths, and we may get a few jobs at the end that quit instantly if
-# they run over the max 210 days limit. But, it's good enough. :)
-
-# Now the actual commands and not just comments explainig the process...
+SINCE="2021-11-01"
+UNTIL="2022-06-01"
 
 source /usr/local/lsf/conf/profile.lsf
 
@@ -32,10 +31,12 @@ export INSTANCE="dev"
 SOFTWARE_ROOT="/software/hgi/installs/lurge"
 export REPORT_DIR="/lustre/scratch119/humgen/teams/hgi/lurge/$INSTANCE"
 
+# each process holds one day's reports for one volume while it's reading,
+# so the memory needed goes up with the number of CPUs
 bsub \
-    -J "lurgeBackfill[1-52]%1" \
-    -o $REPORT_DIR/backfill-logs/%J.%I.out \
-    -e $REPORT_DIR/backfill-logs/%J.%I.out \
+    -J "lurgeBackfill" \
+    -o $REPORT_DIR/backfill-logs/%J.out \
+    -e $REPORT_DIR/backfill-logs/%J.out \
     -G hgi \
-    -R "select[mem>3000] rusage[mem=3000]" -M 3000 -n 36 \
-    "mpirun $SOFTWARE_ROOT/.venv/bin/python3 $SOFTWARE_ROOT/$INSTANCE/group_reporter.py --start-days-ago \$((\$LSB_JOBINDEX * 4))"
\ No newline at end of file
+    -R "select[mem>24000] rusage[mem=24000] span[hosts=1]" -M 24000 -n 16 \
+    "$SOFTWARE_ROOT/.venv/bin/python3 $SOFTWARE_ROOT/$INSTANCE/backfill.py --since $SINCE --until $UNTIL --processes 16"
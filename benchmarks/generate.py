@@ -0,0 +1,208 @@
+"""
+Generates synthetic wrstat output (`*.stats.gz`) and a `.basedirs` file,
+so the reporters can be run and benchmarked without a real Lustre dump.
+
+    python -m benchmarks.generate /tmp/lurge-bench --volumes 123 --files 1000000
+
+The same seed always gives the same files.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import datetime
+import gzip
+import os
+import random
+import typing as T
+
+# areas base directories can live under - the mdt ones are there so the
+# MDT symlink translation has something to do
+AREAS = ["humgen/projects", "humgen/teams",
+         "hgi/mdt0/projects", "hgi/mdt1/teams"]
+
+# (extension, relative frequency)
+EXTENSIONS = [
+    (".bam", 8), (".cram.gz", 4), (".fastq", 2), (".fastq.gz", 6),
+    (".vcf", 2), (".vcf.gz", 4), (".bed", 1), (".sam", 1),
+    (".txt", 20), (".log", 10), (".py", 5), ("", 10)
+]
+
+VAULT_STATES = ["keep", "archive"]
+
+
+class WrstatWriter:
+    """writes wrstat lines, making up inodes and directory records as needed"""
+
+    def __init__(self, wrstat: T.TextIO, rng: random.Random, now: int, dev: int) -> None:
+        self.wrstat = wrstat
+        self.rng = rng
+        self.now = now
+        self.dev = dev
+
+        self.next_inode = 1000
+        self.directories: T.Set[str] = set()
+        self.lines = 0
+
+    def inode(self) -> int:
+        self.next_inode += 1
+        return self.next_inode
+
+    def times(self) -> T.Tuple[int, int, int]:
+        # most data was modified in the last couple of years, and looked at
+        # since then
+        mtime = self.now - int(self.rng.expovariate(1 / (200 * 86400)))
+        atime = min(self.now, mtime + int(self.rng.expovariate(1 / (30 * 86400))))
+        return atime, mtime, max(atime, mtime)
+
+    def write(self, path: str, size: int, uid: int, gid: int,
+              filetype: str, inode: int, nlink: int = 1) -> None:
+        atime, mtime, ctime = self.times()
+        self.wrstat.write("\t".join([
+            base64.b64encode(path.encode("UTF-8")).decode("ascii"),
+            str(size), str(uid), str(gid), str(atime), str(mtime), str(ctime),
+            filetype, str(inode), str(nlink), str(self.dev)
+        ]) + "\n")
+        self.lines += 1
+
+    def directory(self, path: str, uid: int, gid: int) -> None:
+        """writes a directory record for path, and any parents we haven't
+        seen yet"""
+        if path in self.directories or path == "":
+            return
+
+        self.directory(path.rsplit("/", 1)[0], uid, gid)
+        self.directories.add(path)
+        self.write(path, 4096, uid, gid, "d", self.inode(), 1)
+
+
+def generate(output_dir: str,
+             volumes: T.List[int],
+             files: int = 100000,
+             depth: int = 6,
+             groups: int = 50,
+             users: int = 200,
+             basedirs_per_group: int = 2,
+             vault_fraction: float = 0.002,
+             hardlink_fraction: float = 0.01,
+             seed: int = 0,
+             date: T.Optional[datetime.date] = None) -> T.List[str]:
+    """
+    Writes a `{date}_scratch{volume}.*.*.stats.gz` for each volume with
+    `files` files in, and one `.basedirs` file covering all the volumes.
+
+    Group and base directory sizes follow a Zipf-like distribution (a few
+    groups own most of the data), file sizes are log-normal, and some files
+    are hardlinked or tracked by vault (which is a hardlink too).
+
+    :returns: the paths of everything written
+    """
+    rng = random.Random(seed)
+    date = date or datetime.date.today()
+    now = int(datetime.datetime.combine(date, datetime.time()).timestamp())
+    os.makedirs(output_dir, exist_ok=True)
+
+    gids = [20000 + i for i in range(groups)]
+    uids = [10000 + i for i in range(users)]
+    group_weights = [1 / (i + 1) for i in range(groups)]
+    extensions, extension_weights = zip(*EXTENSIONS)
+
+    written: T.List[str] = []
+    all_basedirs: T.List[T.Tuple[int, str]] = []
+
+    for volume in volumes:
+        basedirs: T.Dict[int, T.List[str]] = {
+            gid: [f"/lustre/scratch{volume}/{rng.choice(AREAS)}/group{gid}-{n}"
+                  for n in range(basedirs_per_group)]
+            for gid in gids
+        }
+        all_basedirs += [(gid, path) for gid, paths in basedirs.items()
+                         for path in paths]
+
+        # each group has its own set of users
+        group_users = {gid: rng.sample(uids, min(len(uids), 10)) for gid in gids}
+
+        wrstat_path = os.path.join(
+            output_dir,
+            f"{date.strftime('%Y%m%d')}_scratch{volume}.{rng.getrandbits(32):08x}.{rng.getrandbits(32):08x}.stats.gz")
+
+        with gzip.open(wrstat_path, "wt", compresslevel=6) as wrstat:
+            writer = WrstatWriter(wrstat, rng, now, dev=volume)
+
+            for _ in range(files):
+                gid = rng.choices(gids, group_weights)[0]
+                uid = rng.choice(group_users[gid])
+                base_path = rng.choice(basedirs[gid])
+
+                # the first level is where the reporters split things up
+                first_level = rng.choices(
+                    [f"users/user{uid}", f"projects/p{rng.randrange(5)}",
+                     f"dir{rng.randrange(10)}", ""], [4, 3, 2, 1])[0]
+                subdirs = [f"d{rng.randrange(8)}"
+                           for _ in range(rng.randrange(depth))]
+                directory = "/".join(
+                    x for x in [base_path, first_level, *subdirs] if x)
+                writer.directory(directory, uid, gid)
+
+                name = f"file{writer.lines}{rng.choices(extensions, extension_weights)[0]}"
+                path = f"{directory}/{name}"
+                size = min(int(rng.lognormvariate(12, 3)), 2**42)
+                inode = writer.inode()
+
+                vault_key = None
+                if rng.random() < vault_fraction:
+                    encoded = base64.b64encode(
+                        path[len(base_path) + 1:].replace("/", "_").encode("UTF-8")).decode("ascii")
+                    # vault keys can't have a / in, so we'll skip those
+                    if "/" not in encoded:
+                        hex_inode = f"{inode:08x}"
+                        vault_key = "/".join([
+                            base_path, ".vault", rng.choice(VAULT_STATES),
+                            hex_inode[:2], hex_inode[2:4], f"{hex_inode[4:]}-{encoded}"])
+
+                hardlink = None
+                if vault_key is None and rng.random() < hardlink_fraction:
+                    hardlink = f"{base_path}/dir{rng.randrange(10)}/link{writer.lines}"
+
+                nlink = 2 if vault_key or hardlink else 1
+                writer.write(path, size, uid, gid, "f", inode, nlink)
+
+                for link in [vault_key, hardlink]:
+                    if link is not None:
+                        writer.directory(link.rsplit("/", 1)[0], uid, gid)
+                        writer.write(link, size, uid, gid, "f", inode, nlink)
+
+        written.append(wrstat_path)
+
+    basedirs_path = os.path.join(
+        output_dir, f"{date.strftime('%Y%m%d')}.basedirs")
+    with open(basedirs_path, "w") as f:
+        for gid, path in all_basedirs:
+            f.write(f"{gid}\t{path}\n")
+    written.append(basedirs_path)
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic wrstat output for benchmarking")
+    parser.add_argument("output_dir")
+    parser.add_argument("--volumes", type=int, nargs="+", default=[123])
+    parser.add_argument("--files", type=int, default=100000,
+                        help="number of files per volume")
+    parser.add_argument("--depth", type=int, default=6,
+                        help="max directory depth below the first level")
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--basedirs-per-group", type=int, default=2)
+    parser.add_argument("--vault-fraction", type=float, default=0.002)
+    parser.add_argument("--hardlink-fraction", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for path in generate(args.output_dir, args.volumes, args.files, args.depth, args.groups,
+                         args.users, args.basedirs_per_group, args.vault_fraction,
+                         args.hardlink_fraction, args.seed):
+        print(path)
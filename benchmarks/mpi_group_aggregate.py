@@ -0,0 +1,58 @@
+"""
+The group reporter's MPI backend (reporter/mpi.py) for a single volume,
+with LDAP, quotas and the DB stubbed out (see benchmarks.run.stub_services),
+so we can benchmark it under a local mpirun:
+
+    mpirun -n 4 python -m benchmarks.mpi_group_aggregate 123
+
+Rank 0 is the main process, rank 1 the volume's controller, and every
+other rank one of its workers - the same messages as the nightly run.
+Prints a JSON summary from rank 0.
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import logging
+import sys
+import time
+
+import utils.finder
+from benchmarks.run import stub_services
+from directory_config import WRSTAT_DIR
+from utils.metrics import Metrics
+
+
+def main(volume: int) -> None:
+    names = stub_services(volume)
+
+    import reporter.mpi
+    reporter.mpi.WORKERS_PER_VOLUME = reporter.mpi.comm.Get_size() - 2
+    backend = reporter.mpi.MPIBackend(fresh=True)
+
+    if reporter.mpi.rank != 0:
+        backend.serve()
+        return
+
+    wall = time.perf_counter()
+    metrics = Metrics("benchmark")
+    reports = backend.aggregate(names, metrics)[0]
+    wall = time.perf_counter() - wall
+
+    report_path = utils.finder.find_report(
+        f"scratch{volume}", WRSTAT_DIR, logging.getLogger("benchmark"))
+    with gzip.open(report_path, "rb") as wrstat:
+        lines = sum(1 for _ in wrstat)
+
+    print(json.dumps({
+        "lines": lines,
+        "reports": len(reports),
+        "wall": round(wall, 3),
+        "controller_wait": round(sum(
+            stages["wait_for_workers"].wall for stages in metrics.processes.values()), 3)
+    }))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]))
@@ -0,0 +1,332 @@
+"""
+Runs each reporter's aggregation core against synthetic wrstat output
+(see benchmarks/generate.py), and compares throughput and peak memory
+against a stored baseline.
+
+    python -m benchmarks.generate /tmp/lurge-bench
+    python -m benchmarks.run /tmp/lurge-bench --save-baseline
+    ... make changes ...
+    python -m benchmarks.run /tmp/lurge-bench
+
+Every case is run in its own process, so peak RSS is just that case.
+Exits with 1 if anything has regressed by more than the tolerance.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import logging
+import operator
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing as T
+from pathlib import Path
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+CASES = ["group_aggregate", "group_reporter_mpi", "group_reporter_pool", "user_reporter",
+         "group_splitter", "puppeteer", "group_db_load"]
+DEFAULT_CASES = ["group_aggregate", "user_reporter",
+                 "group_splitter", "puppeteer"]
+
+
+def _peak_rss() -> int:
+    """peak RSS in bytes, of us or anything we ran (ru_maxrss is KiB)"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def stub_services(volume: int) -> T.Tuple[T.Dict[int, str], T.Dict[int, str]]:
+    """
+    Points the group reporter at just the one volume, with LDAP, quotas and
+    the DB's date check stubbed out, so its backends run as they do every
+    night, against whatever's in LURGE_WRSTAT_DIR.
+
+    :returns: the names LDAP would've given - (gid: pi name, gid: group name),
+        for every group with a base directory
+    """
+    import contextlib
+
+    import db.common
+    import db.ledger
+    import directory_config
+    import reporter.volume
+    import utils.finder
+    from directory_config import WRSTAT_DIR
+
+    class _Quotas:
+        def __init__(self, volume: int) -> None:
+            pass
+
+        def get_quota(self, group_name: str) -> int:
+            return 0
+
+    # the backends import VOLUMES by name, so it's changed in place
+    directory_config.VOLUMES[:] = [volume]
+    db.common.get_sql_connection = lambda config: contextlib.nullcontext()  # type: ignore
+    db.ledger.begin_run = lambda *args, **kwargs: True  # type: ignore
+    reporter.volume.QuotaReader = _Quotas  # type: ignore
+
+    gids = {int(gid) for gid, _ in utils.finder.read_base_directories(Path(WRSTAT_DIR))}
+    return {gid: f"pi{gid}" for gid in gids}, {gid: f"group{gid}" for gid in gids}
+
+
+def _group_aggregate(volume: int, logger: logging.Logger):
+    """what the group reporter's workers do, but all in one process - the
+    lines under a base directory (see reporter.aggregate.line_filter),
+    aggregated a block at a time"""
+    import reporter.aggregate
+    import utils.finder
+    import utils.wrstat
+    from directory_config import WRSTAT_DIR
+    from utils.metrics import Metrics
+    from utils.spill import SpillingAggregator
+    from utils.wrstat import WrstatBlock
+
+    base_directory_info = utils.finder.read_base_directories(Path(WRSTAT_DIR))
+    line_filter = reporter.aggregate.line_filter(base_directory_info)
+    report_path = utils.finder.find_report(
+        f"scratch{volume}", WRSTAT_DIR, logger)
+    as_of = int(os.stat(report_path).st_mtime)
+    metrics = Metrics("benchmark")
+    reports: T.Any = SpillingAggregator(operator.iadd)
+
+    lines = 0
+    for block in utils.wrstat.read_blocks(report_path):
+        lines += len(block)
+        wanted = line_filter.select(block)
+        if len(wanted) > 0:
+            reporter.aggregate.process_block(
+                WrstatBlock(b"\n".join(wanted) + b"\n"), base_directory_info, volume,
+                reports, metrics, as_of=as_of)
+            reports.maybe_spill()
+
+    return report_path, lines, list(reports.items())
+
+
+def run_case(case: str, volume: int, logger: logging.Logger) -> T.Dict[str, T.Any]:
+    """runs one case in this process, and times it"""
+    from directory_config import WRSTAT_DIR
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    if case == "group_aggregate":
+        report_path, lines, _ = _group_aggregate(volume, logger)
+
+    elif case == "group_db_load":
+        # against a local MySQL, or a SQLite file (see db_config.py), which
+        # we set up the tables for first
+        import db.common
+        import db.group_reporter
+        import db_config
+
+        # here, "lines" are the GroupReports we load
+        report_path, _, reports = _group_aggregate(volume, logger)
+        lines = len(reports)
+        for (_, base_path), report in reports:
+            report.base_path = base_path
+            report.wrstat_time = int(os.stat(report_path).st_mtime)
+        db_conn = db.common.get_sql_connection(db_config)
+        if getattr(db_config, "SQLITE", None) is not None:
+            create_sqlite_schema(db_conn)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        db.group_reporter.load_reports_into_db(
+            db_conn, [[report for _, report in reports]], logging.LoggerAdapter(logger, {}))
+
+    elif case == "group_reporter_mpi":
+        import utils.finder
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
+        # one rank for the main process, one for the volume's controller,
+        # and the rest are its workers
+        proc = subprocess.run(
+            ["mpirun", "-n", str(int(os.getenv("LURGE_BENCH_MPI_RANKS", "4"))),
+             sys.executable, "-m", "benchmarks.mpi_group_aggregate", str(volume)],
+            capture_output=True, check=True, encoding="UTF-8")
+        lines = json.loads(proc.stdout.strip().splitlines()[-1])["lines"]
+
+    elif case == "group_reporter_pool":
+        import utils.finder
+        from reporter.pool import PoolBackend
+        from utils.metrics import Metrics
+        names = stub_services(volume)
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
+        PoolBackend(fresh=True, processes=int(os.getenv("LURGE_BENCH_POOL_PROCESSES", "4"))
+                    ).aggregate(names, Metrics("benchmark"))
+        lines = _count_lines(report_path)
+
+    elif case == "user_reporter":
+        import user_reporter
+        import utils.finder
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
+        user_reporter.get_user_info_from_wrstat(volume, logger)
+        lines = _count_lines(report_path)
+
+    elif case == "group_splitter":
+        import datetime
+
+        import group_splitter
+        import utils.finder
+        from directory_config import REPORT_DIR
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
+        os.makedirs(
+            f"{REPORT_DIR}groups/{datetime.datetime.now().strftime('%Y%m%d')}", exist_ok=True)
+        groups = {gid: f"group{gid}" for gid, _ in
+                  utils.finder.read_base_directories(Path(WRSTAT_DIR))}
+        group_info, _ = group_splitter.get_group_info_from_wrstat(
+            volume, groups, logger)
+        for split in group_info.values():
+            split.flush_lines()
+        lines = _count_lines(report_path)
+
+    elif case == "puppeteer":
+        import puppeteer
+        import utils.finder
+        from utils.metrics import Metrics
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
+        puppeteer.find_vault_puppets(report_path, logger, Metrics("benchmark"))
+        # puppeteer goes over the file twice
+        lines = 2 * _count_lines(report_path)
+
+    else:
+        raise ValueError(f"unknown benchmark case {case}")
+
+    wall = time.perf_counter() - wall
+    return {
+        "case": case,
+        "lines": lines,
+        "bytes": os.path.getsize(report_path),
+        "wall": round(wall, 3),
+        "cpu": round(time.process_time() - cpu, 3),
+        "lines_per_sec": round(lines / wall, 1),
+        "peak_rss": _peak_rss()
+    }
+
+
+def _count_lines(report_path: str) -> int:
+    with gzip.open(report_path, "rb") as wrstat:
+        return sum(1 for _ in wrstat)
+
+
+# the tables the db modules don't create for themselves, for a SQLite
+# stand-in - only the columns they use
+SQLITE_SCHEMA = [
+    "pi (pi_id INTEGER PRIMARY KEY, pi_name TEXT UNIQUE)",
+    "unix_group (group_id INTEGER PRIMARY KEY, group_name TEXT UNIQUE)",
+    "volume (volume_id INTEGER PRIMARY KEY, scratch_disk TEXT UNIQUE)",
+    "vault_actions (vault_action_id INTEGER PRIMARY KEY, action_name TEXT UNIQUE)",
+    "user (user_id INTEGER PRIMARY KEY, user_name TEXT UNIQUE)",
+    "filetype (filetype_id INTEGER PRIMARY KEY, filetype_name TEXT UNIQUE)",
+    """base_directory (base_directory_id INTEGER PRIMARY KEY, directory_path TEXT,
+        volume_id INTEGER)""",
+    """lustre_usage (usage_id INTEGER PRIMARY KEY, used INTEGER, quota INTEGER,
+        record_date DATE, last_modified REAL, pi_id INTEGER, unix_id INTEGER,
+        base_directory_id INTEGER, warning_id INTEGER)""",
+    """directory (directory_id INTEGER PRIMARY KEY, directory_path TEXT, num_files INTEGER,
+        size REAL, last_modified REAL, pi_id INTEGER, base_directory_id INTEGER,
+        group_id INTEGER)""",
+    "file_size (directory_id INTEGER, filetype_id INTEGER, size REAL)"
+]
+
+
+def create_sqlite_schema(db_conn: T.Any) -> None:
+    from db_config import SCHEMA
+    cursor = db_conn.cursor()
+    for table in SQLITE_SCHEMA:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {SCHEMA}.{table}")
+    db_conn.commit()
+
+
+def compare(results: T.List[T.Dict[str, T.Any]], baseline: T.Dict[str, T.Dict[str, T.Any]],
+            tolerance: float) -> T.List[str]:
+    """the regressions, if there are any"""
+    regressions: T.List[str] = []
+    for result in results:
+        base = baseline.get(result["case"])
+        if base is None:
+            continue
+
+        if result["lines_per_sec"] < base["lines_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{result['case']}: {result['lines_per_sec']} lines/sec, baseline {base['lines_per_sec']}")
+        if result["peak_rss"] > base["peak_rss"] * (1 + tolerance):
+            regressions.append(
+                f"{result['case']}: peak RSS {result['peak_rss']}, baseline {base['peak_rss']}")
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the reporters against synthetic wrstat output")
+    parser.add_argument("data_dir", help="output of benchmarks.generate")
+    parser.add_argument("--volume", type=int, default=123)
+    parser.add_argument("--cases", nargs="+",
+                        choices=CASES, default=DEFAULT_CASES)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction worse than the baseline we'll put up with")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logger = logging.getLogger("benchmark")
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.child:
+        print(json.dumps(run_case(args.child, args.volume, logger)))
+        return
+
+    report_dir = tempfile.mkdtemp(prefix="lurge-bench-")
+    env = {**os.environ,
+           "LURGE_WRSTAT_DIR": os.path.abspath(args.data_dir) + "/",
+           "REPORT_DIR": report_dir}
+
+    results: T.List[T.Dict[str, T.Any]] = []
+    try:
+        for case in args.cases:
+            proc = subprocess.run(
+                [sys.executable, "-m", "benchmarks.run", args.data_dir,
+                 "--volume", str(args.volume), "--child", case],
+                env=env, capture_output=True, encoding="UTF-8")
+            if proc.returncode != 0:
+                sys.exit(f"{case} failed:\n{proc.stderr}")
+
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{case:<20} {result['lines_per_sec']:>12} lines/sec "
+                  f"{result['wall']:>9}s {result['peak_rss'] / 2**20:>9.1f} MiB")
+    finally:
+        shutil.rmtree(report_dir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({result["case"]: result for result in results}, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
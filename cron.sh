@@ -19,10 +19,26 @@ bsub \
     -R "select[mem>3000] rusage[mem=3000] span[hosts=1]" -M 3000 -n 5 \
     "$SOFTWARE_ROOT/.venv/bin/python3 $SOFTWARE_ROOT/$INSTANCE/manager.py puppeteer users $run_splitter"
 
+# The duplicate candidates read every volume's wrstat file again, so they
+# get their own job alongside the others, rather than adding hours to the
+# one above. It's a pool process per CPU, each with a batch of lines at a
+# time, and the candidates are partitioned onto TMPDIR, with only one
+# partition sorted in memory at once
+NUM_DUPLICATE_CPUs=16
+
+bsub \
+    -o $REPORT_DIR/report-logs/$(date '+%Y-%m-%d').%J.duplicates.out \
+    -e $REPORT_DIR/report-logs/$(date '+%Y-%m-%d').%J.duplicates.err \
+    -G hgi \
+    -R "select[mem>4000] rusage[mem=4000] span[hosts=1]" -M 4000 -n $NUM_DUPLICATE_CPUs \
+    "$SOFTWARE_ROOT/.venv/bin/python3 $SOFTWARE_ROOT/$INSTANCE/duplicate_reporter.py --processes $NUM_DUPLICATE_CPUs"
+
 # Run main reporter with MPI
 # NUM_CPUs is 1 + number of volumes * (WORKERS_PER_VOLUME + 1)
-# WORKERS_PER_VOLUME is defined towards top of group_reporter.py
+# WORKERS_PER_VOLUME is defined towards top of reporter/mpi.py
 # i.e. 5 volumes (117, 118, 119, 123, 124, 125, 126), 6 workers per volume = 50 cores
+# (to run on a single host without MPI instead, use
+#  "$SOFTWARE_ROOT/.venv/bin/python3 $SOFTWARE_ROOT/$INSTANCE/group_reporter.py --backend pool --processes $NUM_CPUs")
 NUM_CPUs=50
 
 export LD_LIBRARY_PATH=/software/openmpi-4.0.3/lib:$LD_LIBRARY_PATH
@@ -1,34 +1,456 @@
 from __future__ import annotations
 
+import collections
+import contextlib
 import datetime
 import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import typing as T
 from types import ModuleType
 
 import mysql.connector
+from mysql.connector import errorcode
 
 from db_config import SCHEMA
+from directory_config import DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_RETRIES, DB_RETRY_BACKOFF
+from utils.metrics import Metrics
 
+# Everything that talks to MySQL gets its connection from here.
+#
+# Each process keeps a pool of up to DB_POOL_SIZE connections per database,
+# which get handed back when they're closed, so the controllers' date
+# checks and the loads share connections rather than opening their own.
+#
+# Statements that fail with a transient error (the server going away, a
+# dropped connection, a deadlock or a lock wait timeout) are retried, up to
+# DB_RETRIES times with exponential backoff, reconnecting if need be - but
+# only if there's nothing uncommitted on the connection, as that would have
+# been lost. For a whole transaction, use retry_transaction. DDL (CREATE,
+# DROP etc.) commits by itself in MySQL, so it doesn't leave anything
+# uncommitted - but in SQLite it doesn't, so it needs a commit() there.
+#
+# If all DB_POOL_SIZE connections are in use, getting another waits for
+# one to be handed back, but only for DB_POOL_TIMEOUT seconds - i.e. nested
+# `with` blocks holding every connection would otherwise wait forever.
+#
+# Statements with parameters are run as server-side prepared statements,
+# with a prepared cursor kept for each one, so a load that inserts the same
+# thing thousands of times only has it parsed once.
+#
+# If the config has SQLITE set to a file, we use that instead, with the
+# schema attached under its usual name - i.e. for testing (or benchmarking)
+# the db modules without a MySQL server. The few bits of MySQL the loads
+# use (INSERT IGNORE, ON DUPLICATE KEY UPDATE, IF, CONCAT and indexes in
+# CREATE TABLE) are rewritten for it (see _sqlite_statement), but anything
+# else MySQL-only (i.e. multi-table UPDATE and DELETE) won't work there.
 
-def get_sql_connection(config: ModuleType) -> mysql.connector.MySQLConnection:
-    # connects to the MySQL server used to store the report data, change the
-    # credentials here to point at your desired database
-    port = config.PORT if config.PORT is not None else 3306
+logger = logging.getLogger(__name__)
+
+# mysql errors worth trying again
+TRANSIENT_ERRORS = {
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_CONN_HOST_ERROR,
+    errorcode.ER_LOCK_DEADLOCK,
+    errorcode.ER_LOCK_WAIT_TIMEOUT
+}
+# and the ones where we'll need a new connection
+_CONNECTION_ERRORS = {
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_CONN_HOST_ERROR
+}
+
+# prepared statements kept open per connection
+PREPARED_CACHE_SIZE = 64
+
+# (statement, seconds, rows) - called after every statement
+StatementHook = T.Callable[[str, float, int], None]
+_statement_hooks: T.List[StatementHook] = []
+
+_READ_ONLY = {"SELECT", "SHOW", "DESCRIBE", "EXPLAIN"}
+# statements MySQL commits straight away (along with anything before them)
+_IMPLICIT_COMMIT = {"CREATE", "DROP", "ALTER", "TRUNCATE", "RENAME"}
+_TABLE = re.compile(r"\b(?:INTO|FROM|UPDATE|TABLE(?: IF NOT EXISTS)?)\s+(?:\w+\.)?(\w+)", re.I)
+
+R = T.TypeVar("R")
+
+
+def add_statement_hook(hook: StatementHook) -> None:
+    _statement_hooks.append(hook)
+
+
+def remove_statement_hook(hook: StatementHook) -> None:
+    _statement_hooks.remove(hook)
+
+
+def statement_name(statement: str) -> str:
+    """i.e. "INSERT lustre_usage" - for grouping statements' timings"""
+    verb = _verb(statement)
+    table = _TABLE.search(statement)
+    return f"{verb} {table.group(1)}" if table is not None else verb
+
+
+@contextlib.contextmanager
+def statement_metrics(metrics: Metrics) -> T.Iterator[None]:
+    """while in the block, every statement in this process is timed in
+    metrics, as "sql:INSERT lustre_usage" etc."""
+    def hook(statement: str, seconds: float, rows: int) -> None:
+        metrics.add(f"sql:{statement_name(statement)}", wall=seconds, rows=max(rows, 0))
+
+    add_statement_hook(hook)
+    try:
+        yield
+    finally:
+        remove_statement_hook(hook)
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, mysql.connector.Error):
+        return error.errno in TRANSIENT_ERRORS
+    if isinstance(error, sqlite3.OperationalError):
+        return "locked" in str(error) or "busy" in str(error)
+    return False
+
+
+# MySQL: SQLite, for the statements that differ
+_SQLITE_REWRITES = [
+    (re.compile(r"\bINSERT IGNORE\b", re.I), "INSERT OR IGNORE"),
+    (re.compile(r"\bON DUPLICATE KEY UPDATE\b", re.I), "ON CONFLICT DO UPDATE SET"),
+    (re.compile(r"\bVALUES\((`?\w+`?)\)", re.I), r"excluded.\1"),
+    (re.compile(r"\bIF\(", re.I), "iif("),
+    (re.compile(r",\s*INDEX\s*\([^)]*\)", re.I), "")
+]
+
+
+def _sqlite_statement(statement: str) -> str:
+    for pattern, replacement in _SQLITE_REWRITES:
+        statement = pattern.sub(replacement, statement)
+    return statement.replace("%s", "?")
+
+
+def _verb(statement: str) -> str:
+    words = statement.split(None, 1)
+    return words[0].upper() if len(words) > 0 else ""
+
+
+def _is_read_only(statement: str) -> bool:
+    return _verb(statement) in _READ_ONLY
+
+
+class _Pool:
+    """idle connections to one database, for one process"""
+
+    def __init__(self, config: ModuleType, size: int,
+                 timeout: T.Optional[float] = DB_POOL_TIMEOUT) -> None:
+        self.config = config
+        self.size = size
+        self.timeout = timeout
+        self._idle: queue.LifoQueue[T.Any] = queue.LifoQueue()
+        self._open = 0
+        self._lock = threading.Lock()
+
+    @property
+    def sqlite(self) -> T.Optional[str]:
+        return getattr(self.config, "SQLITE", None)
+
+    def connect(self) -> T.Any:
+        if self.sqlite is not None:
+            raw = sqlite3.connect(self.sqlite, check_same_thread=False)
+            raw.execute("ATTACH DATABASE ? AS " + SCHEMA, (self.sqlite,))
+            raw.create_function("CONCAT", -1, lambda *args: "".join(map(str, args)))
+            return raw
+
+        return mysql.connector.connect(
+            host=self.config.HOST,
+            database=self.config.DATABASE,
+            port=self.config.PORT if self.config.PORT is not None else 3306,
+            user=self.config.USER,
+            passwd=self.config.PASSWORD
+        )
+
+    def get(self) -> T.Any:
+        """an idle connection, a new one if there's room, or else the next
+        one that's handed back
+
+        :raises mysql.connector.errors.PoolError: if none are handed back
+            within timeout seconds
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            opening = self._open < self.size
+            if opening:
+                self._open += 1
+        if opening:
+            try:
+                return _retry(self.connect)
+            except BaseException:
+                with self._lock:
+                    self._open -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise mysql.connector.errors.PoolError(
+                f"all {self.size} DB connections in this process have been in use for "
+                f"{self.timeout}s - is something holding on to them (i.e. nested `with` "
+                "blocks)? DB_POOL_SIZE may need to be bigger") from None
+
+    def put(self, raw: T.Any) -> None:
+        self._idle.put(raw)
+
+    def discard(self, raw: T.Any) -> None:
+        """for a connection that's no use any more"""
+        with contextlib.suppress(Exception):
+            raw.close()
+        with self._lock:
+            self._open -= 1
+
+
+# (pid, host, port, database, user, sqlite file): pool
+_pools: T.Dict[T.Tuple[T.Any, ...], _Pool] = {}
+_pools_lock = threading.Lock()
 
-    db_conn = mysql.connector.connect(
-        host=config.HOST,
-        database=config.DATABASE,
-        port=port,
-        user=config.USER,
-        passwd=config.PASSWORD
-    )
 
-    return db_conn
+def _retry(fn: T.Callable[[], R], before_retry: T.Optional[T.Callable[[Exception], None]] = None,
+           retries: int = DB_RETRIES) -> R:
+    """calls fn, and again (with backoff) if it fails with a transient
+    error"""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as error:
+            if not is_transient(error) or attempt == retries:
+                raise
+            wait = DB_RETRY_BACKOFF * 2**attempt
+            logger.warning(f"{error} - trying again in {wait}s ({attempt + 1}/{retries})")
+            time.sleep(wait)
+            if before_retry is not None:
+                before_retry(error)
+    raise AssertionError("unreachable")
 
 
-def check_date(conn: mysql.connector.MySQLConnection, table: str, date: datetime.date,
-               volume: int, logger: logging.LoggerAdapter[logging.Logger], base_dir_usage: bool = False) -> bool:
-    # Checks the dates in the DB table to see if the date already has data for
-    # that particular volume
+class Connection:
+    """
+    A connection from the pool - it's handed back when it's closed (or at
+    the end of a `with` block), after rolling back anything uncommitted.
+    Behaves like the mysql.connector connection it wraps, as far as the
+    db modules use it.
+    """
+
+    def __init__(self, pool: _Pool, raw: T.Any) -> None:
+        self._pool = pool
+        self._raw: T.Optional[T.Any] = raw
+        self._sqlite = pool.sqlite is not None
+        # statement: prepared cursor, least recently used first
+        self._prepared: T.OrderedDict[str, T.Any] = collections.OrderedDict()
+        # whether there's anything we'd lose if the connection went
+        self.uncommitted = False
+
+    @property
+    def raw(self) -> T.Any:
+        if self._raw is None:
+            raise ValueError("connection has been closed")
+        return self._raw
+
+    def __enter__(self) -> Connection:
+        return self
+
+    def __exit__(self, *_: T.Any) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        # so one that's been forgotten about still goes back to the pool
+        with contextlib.suppress(Exception):
+            self.close()
+
+    def cursor(self, buffered: bool = True, prepared: bool = True) -> Cursor:
+        """results are always buffered - `buffered` is only here so the
+        mysql.connector way of asking for it still works"""
+        return Cursor(self, prepared)
+
+    def commit(self) -> None:
+        self.raw.commit()
+        self.uncommitted = False
+
+    def rollback(self) -> None:
+        self.raw.rollback()
+        self.uncommitted = False
+
+    def close(self) -> None:
+        if self._raw is None:
+            return
+
+        raw, self._raw = self._raw, None
+        try:
+            raw.rollback()
+            self._close_prepared()
+            self._pool.put(raw)
+        except Exception:
+            self._pool.discard(raw)
+
+    def _close_prepared(self) -> None:
+        for cursor in self._prepared.values():
+            with contextlib.suppress(Exception):
+                cursor.close()
+        self._prepared.clear()
+
+    def _reset(self, error: Exception) -> None:
+        """gets the connection usable again after a transient error"""
+        self._close_prepared()
+        if isinstance(error, mysql.connector.Error) and error.errno in _CONNECTION_ERRORS:
+            self.raw.reconnect(attempts=1)
+        else:
+            with contextlib.suppress(Exception):
+                self.raw.rollback()
+        self.uncommitted = False
+
+    def _cursor_for(self, statement: str, prepared: bool) -> T.Tuple[T.Any, bool]:
+        """(cursor, whether it's a prepared one)"""
+        if self._sqlite or not prepared:
+            return self.raw.cursor(), False
+
+        if statement in self._prepared:
+            self._prepared.move_to_end(statement)
+        else:
+            if len(self._prepared) >= PREPARED_CACHE_SIZE:
+                _, oldest = self._prepared.popitem(last=False)
+                with contextlib.suppress(Exception):
+                    oldest.close()
+            self._prepared[statement] = self.raw.cursor(prepared=True)
+        return self._prepared[statement], True
+
+    def run(self, statement: str, params: T.Any, many: bool,
+            prepared: bool) -> T.Tuple[T.List[T.Any], T.Optional[int], int]:
+        """
+        Runs a statement (or a statement for each set of params, if many),
+        retrying it if we can.
+
+        :returns: the rows it gave back, the last inserted ID and how many
+            rows it affected
+        """
+        if self._sqlite:
+            statement = _sqlite_statement(statement)
+
+        def attempt() -> T.Tuple[T.List[T.Any], T.Optional[int], int]:
+            # executemany isn't any faster prepared - an INSERT gets turned
+            # into one multi-row INSERT
+            cursor, is_prepared = self._cursor_for(
+                statement, prepared and not many and len(params) > 0)
+            try:
+                if many:
+                    cursor.executemany(statement, params)
+                else:
+                    cursor.execute(statement, params)
+                rows = cursor.fetchall() if cursor.description is not None else []
+                return rows, cursor.lastrowid, cursor.rowcount
+            finally:
+                if not is_prepared:
+                    cursor.close()
+
+        def before_retry(error: Exception) -> None:
+            if self.uncommitted:
+                # it'd only be half a transaction
+                raise error
+            self._reset(error)
+
+        start = time.perf_counter()
+        result = _retry(attempt, before_retry) if not self.uncommitted else attempt()
+        seconds = time.perf_counter() - start
+
+        if not self._sqlite and _verb(statement) in _IMPLICIT_COMMIT:
+            self.uncommitted = False
+        elif not _is_read_only(statement):
+            self.uncommitted = True
+        for hook in _statement_hooks:
+            hook(statement, seconds, result[2] if result[2] >= 0 else len(result[0]))
+
+        return result
+
+
+class Cursor:
+    """what Connection.cursor gives back - the results of each statement
+    are fetched straight away, so the connection's free for the next one"""
+
+    def __init__(self, connection: Connection, prepared: bool = True) -> None:
+        self.connection = connection
+        self.prepared = prepared
+        self._rows: T.Deque[T.Any] = collections.deque()
+        self.lastrowid: T.Optional[int] = None
+        self.rowcount = -1
+
+    def execute(self, statement: str, params: T.Sequence[T.Any] = ()) -> None:
+        rows, self.lastrowid, self.rowcount = self.connection.run(
+            statement, tuple(params), False, self.prepared)
+        self._rows = collections.deque(rows)
+
+    def executemany(self, statement: str, params: T.Iterable[T.Sequence[T.Any]]) -> None:
+        rows, self.lastrowid, self.rowcount = self.connection.run(
+            statement, [tuple(x) for x in params], True, self.prepared)
+        self._rows = collections.deque(rows)
+
+    def fetchone(self) -> T.Optional[T.Any]:
+        return self._rows.popleft() if len(self._rows) > 0 else None
+
+    def fetchall(self) -> T.List[T.Any]:
+        rows = list(self._rows)
+        self._rows.clear()
+        return rows
+
+    def __iter__(self) -> T.Iterator[T.Any]:
+        while len(self._rows) > 0:
+            yield self._rows.popleft()
+
+    def close(self) -> None:
+        self._rows.clear()
+
+
+def get_sql_connection(config: ModuleType) -> Connection:
+    """a connection to the MySQL server used to store the report data (see
+    db_config.py), from this process' pool"""
+    key = (os.getpid(), config.HOST, config.PORT, config.DATABASE,
+           config.USER, getattr(config, "SQLITE", None))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = _Pool(config, DB_POOL_SIZE)
+        pool = _pools[key]
+
+    return Connection(pool, pool.get())
+
+
+def retry_transaction(conn: Connection, fn: T.Callable[[Connection], R]) -> R:
+    """
+    Runs fn (which does everything through conn), then commits. If it fails
+    with a transient error part way through, everything it did is rolled
+    back and it's run again from the start - so fn shouldn't change
+    anything outside the DB until it's done.
+    """
+    def attempt() -> R:
+        try:
+            result = fn(conn)
+            conn.commit()
+            return result
+        except Exception as error:
+            if is_transient(error):
+                conn._reset(error)
+            raise
+
+    return _retry(attempt)
+
+
+def get_loaded_dates(conn: Connection, table: str, volume: int,
+                     base_dir_usage: bool = False) -> T.Set[datetime.date]:
+    # All the dates in the DB table that have data for that particular volume
     cursor = conn.cursor(buffered=True)
     cursor.execute(
         f"""SELECT DISTINCT record_date FROM {SCHEMA}.{table}
@@ -37,8 +459,5 @@ def check_date(conn: mysql.connector.MySQLConnection, table: str, date: datetime
         WHERE scratch_disk = %s""", (f"scratch{volume}",)
     )
 
-    for (result,) in cursor:
-        if date == result:
-            logger.warning(f"{volume} already has DB data for {date}")
-            return True
-    return False
+    return {result for (result,) in cursor}
+
@@ -1,11 +1,10 @@
 import typing as T
 
-import mysql.connector
-
+import db.common
 from db_config import SCHEMA
 
 
-def get_db_foreign_keys(db_conn: mysql.connector.MySQLConnection) -> T.Tuple[
+def get_db_foreign_keys(db_conn: db.common.Connection) -> T.Tuple[
     T.Dict[str, int],
     T.Dict[str, int],
     T.Dict[str, int],
@@ -4,23 +4,34 @@ import datetime
 import logging
 import typing as T
 
-import mysql.connector
-import mysql.connector.cursor
-
+import db.common
 import db.foreign
+import db.histograms
+import db.ledger
+import db.top_files
 from db_config import SCHEMA
 from lurge_types.group_report import GroupReport
+from utils.metrics import Metrics
 from utils.symlink import get_mdt_symlink
 
 SCALING_FACTOR = 2**30  # bytes / 2**30 = GiB
 
 
-def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
-                         reports: T.List[T.List[GroupReport]], logger: logging.LoggerAdapter[logging.Logger]) -> None:
-    cursor: mysql.connector.cursor.MySQLCursor = db_conn.cursor(buffered=True)
+def load_reports_into_db(db_conn: db.common.Connection,
+                         reports: T.List[T.List[GroupReport]], logger: logging.LoggerAdapter[logging.Logger],
+                         metrics: T.Optional[Metrics] = None) -> None:
+    cursor = db_conn.cursor()
+
+    # the statements themselves are timed per table by statement_metrics
+    # (see db/common.py) - this is for the rest. If no one's asked, nobody
+    # reads these
+    metrics = metrics or Metrics("group_reporter")
 
     pis, groups, volumes, _, _, filetypes, base_dirs = db.foreign.get_db_foreign_keys(
         db_conn)
+    db.ledger.create_ledger(db_conn)
+    db.histograms.create_tables(db_conn)
+    db.top_files.create_table(db_conn)
 
     # Add Top Level Reports
     for _vol in reports:
@@ -33,10 +44,13 @@ def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
         logger.debug(f"renaming old directory data for deletion later on {scratch_disk}")
         cursor.execute(
             f"""UPDATE {SCHEMA}.directory
-                INNER JOIN base_directory USING (base_directory_id)
-                INNER JOIN volume USING (volume_id)
-                SET directory.directory_path = (SELECT CONCAT('.hgi.old.', directory.directory_path))
-                WHERE scratch_disk = %s;""", (scratch_disk,))
+                SET directory_path = CONCAT('.hgi.old.', directory_path)
+                WHERE base_directory_id IN (
+                    SELECT base_directory_id FROM {SCHEMA}.base_directory
+                    INNER JOIN {SCHEMA}.volume USING (volume_id)
+                    WHERE scratch_disk = %s
+                );""", (scratch_disk,))
+        db.top_files.delete_volume(cursor, _vol[0].volume)
         db_conn.commit()
 
         for report in _vol:
@@ -91,6 +105,9 @@ def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
             query = f"""INSERT INTO {SCHEMA}.lustre_usage (used, quota, record_date,
                 last_modified, pi_id, unix_id, base_directory_id, warning_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s);"""
 
+            with metrics.stage("warnings"):
+                warning = report.warning
+
             cursor.execute(query, (
                 report.usage,
                 report.quota,
@@ -99,20 +116,25 @@ def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
                 pi,
                 group_id,
                 base_dirs[base_dir],
-                report.warning
+                warning
             ))
 
             db_conn.commit()
 
+            # and how its files break down by size and age
+            db.histograms.insert_usage_histograms(
+                cursor, datetime.date.fromtimestamp(report.wrstat_time),
+                base_dirs[base_dir], group_id, report.histograms)
+
+            # and where to start if they need to clear some space
+            db.top_files.insert_top_files(
+                cursor, report, base_dirs[base_dir], group_id)
+
             # Add All the Subdirectory Info
             for subdir, subdir_report in report.subdirs.items():
-                # scale and round the sizes
-                subdir_report.size /= SCALING_FACTOR
-                subdir_report.size = round(subdir_report.size, 2)
-
-                for filetype, size in subdir_report.filetypes.items():
-                    subdir_report.filetypes[filetype] = round(
-                        size / SCALING_FACTOR, 2)
+                # scale and round the sizes - we don't change the report
+                # itself, as the TSVs and exports want exact byte counts
+                scaled_size = round(subdir_report.size / SCALING_FACTOR, 2)
 
                 # Add new data
                 logger.debug(f"adding sub directory info for {subdir}")
@@ -122,7 +144,7 @@ def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
                 cursor.execute(query, (
                     subdir,
                     subdir_report.num_files,
-                    subdir_report.size,
+                    scaled_size,
                     subdir_report.relative_mtime,
                     pi,
                     base_dirs.get(base_dir),
@@ -130,8 +152,12 @@ def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
                 ))
 
                 # Get the new directory_id back, so we can add file types
+                # and histograms
                 new_id: int = cursor.lastrowid
 
+                db.histograms.insert_directory_histograms(
+                    cursor, new_id, subdir_report.histograms)
+
                 # Add the file sizes
                 for filetype, size in subdir_report.filetypes.items():
                     if filetype not in filetypes:
@@ -143,13 +169,20 @@ def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
                     logger.debug(
                         f"adding filetype {filetype} info for {subdir}")
                     cursor.execute(f"""INSERT INTO {SCHEMA}.file_size (directory_id, filetype_id, size)
-                    VALUES (%s, %s, %s);""", (new_id, filetypes[filetype], size))
+                    VALUES (%s, %s, %s);""", (new_id, filetypes[filetype], round(size / SCALING_FACTOR, 2)))
+
+                with metrics.stage("db:commit"):
+                    db_conn.commit()
 
-                db_conn.commit()
+        # this volume's all in now
+        db.ledger.complete_run(
+            db_conn, "group_reporter", _vol[0].volume,
+            datetime.date.fromtimestamp(_vol[0].wrstat_time), len(_vol))
 
     # Now we've added all the new data, we can delete all the old data
     # This is data where the path is prefixed with `.hgi.old.`
     logger.debug("deleting old directory information")
+    db.histograms.delete_old_directory_histograms(cursor)
     cursor.execute(f"""DELETE FROM {SCHEMA}.file_size WHERE directory_id IN (
                         SELECT directory_id FROM {SCHEMA}.directory
                         WHERE directory_path LIKE '.hgi.old.%'
@@ -159,3 +192,118 @@ def load_reports_into_db(db_conn: mysql.connector.MySQLConnection,
         f"DELETE FROM {SCHEMA}.directory WHERE directory_path LIKE '.hgi.old%'")
 
     db_conn.commit()
+
+
+def resolve_foreign_keys(db_conn: db.common.Connection,
+                         reports: T.Iterable[GroupReport],
+                         logger: logging.LoggerAdapter[logging.Logger]
+                         ) -> T.Tuple[T.Dict[str, int], T.Dict[str, int], T.Dict[str, int]]:
+    """
+    Makes sure every PI, group, volume and base directory in reports is in
+    the DB, adding any that aren't in one go.
+
+    This is the bit that has to happen one at a time - two processes doing
+    it at once could both add the same group.
+
+    :returns: PIs, Groups, Base Directories (name: id)
+    """
+    def resolve(db_conn: db.common.Connection) -> T.Tuple[
+            T.Dict[str, int], T.Dict[str, int], T.Dict[str, int]]:
+        cursor = db_conn.cursor()
+        pis, groups, volumes, _, _, _, base_dirs = db.foreign.get_db_foreign_keys(
+            db_conn)
+
+        for report in reports:
+            scratch_disk = f"scratch{report.volume}"
+            base_dir = get_mdt_symlink(report.base_path or "")
+
+            if report.pi_name is not None and report.pi_name not in pis:
+                logger.info(f"adding PI {report.pi_name} to DB")
+                cursor.execute(
+                    f"INSERT INTO {SCHEMA}.pi (pi_name) VALUES (%s);", (report.pi_name,))
+                pis[report.pi_name] = int(cursor.lastrowid)
+
+            if report.group_name is not None and report.group_name not in groups:
+                logger.info(f"adding group {report.group_name} to DB")
+                cursor.execute(
+                    f"INSERT INTO {SCHEMA}.unix_group (group_name) VALUES (%s);", (report.group_name,))
+                groups[report.group_name] = int(cursor.lastrowid)
+
+            if scratch_disk not in volumes:
+                logger.info(f"adding volume {report.volume} to DB")
+                cursor.execute(
+                    f"INSERT INTO {SCHEMA}.volume (scratch_disk) VALUES (%s);", (scratch_disk,))
+                volumes[scratch_disk] = int(cursor.lastrowid)
+
+            if base_dir not in base_dirs:
+                logger.info(
+                    f"adding base directory {base_dir} to DB (volume {report.volume})")
+                cursor.execute(
+                    f"INSERT INTO {SCHEMA}.base_directory (directory_path, volume_id) VALUES (%s, %s);",
+                    (base_dir, volumes[scratch_disk]))
+                base_dirs[base_dir] = int(cursor.lastrowid)
+
+        return pis, groups, base_dirs
+
+    # the keys are read again if it has to start over, so nothing's left
+    # pointing at a row that was rolled back
+    return db.common.retry_transaction(db_conn, resolve)
+
+
+def load_usage_into_db(db_conn: db.common.Connection, reports: T.List[GroupReport],
+                       date: datetime.date, volume: int,
+                       keys: T.Tuple[T.Dict[str, int], T.Dict[str, int], T.Dict[str, int]],
+                       warnings: T.List[T.Optional[int]],
+                       metrics: T.Optional[Metrics] = None) -> None:
+    """
+    Replaces the lustre_usage rows for a volume on a date with reports (and
+    their warnings and histograms). The delete and the insert are one transaction (along
+    with marking it loaded in the run ledger), so loading the same day twice
+    leaves the same rows as loading it once.
+
+    Unlike load_reports_into_db, this doesn't touch the directory or
+    top_file tables - they only ever hold the latest data.
+
+    :param keys: - what resolve_foreign_keys gave back
+    """
+    metrics = metrics or Metrics("group_reporter")
+    pis, groups, base_dirs = keys
+    db.ledger.create_ledger(db_conn)
+    db.histograms.create_tables(db_conn)
+
+    def replace(db_conn: db.common.Connection) -> None:
+        cursor = db_conn.cursor()
+        cursor.execute(f"""DELETE {SCHEMA}.lustre_usage FROM {SCHEMA}.lustre_usage
+            INNER JOIN {SCHEMA}.base_directory USING (base_directory_id)
+            INNER JOIN {SCHEMA}.volume USING (volume_id)
+            WHERE record_date = %s AND scratch_disk = %s""", (date, f"scratch{volume}"))
+        cursor.execute(f"""DELETE {SCHEMA}.usage_histogram FROM {SCHEMA}.usage_histogram
+            INNER JOIN {SCHEMA}.base_directory USING (base_directory_id)
+            INNER JOIN {SCHEMA}.volume USING (volume_id)
+            WHERE record_date = %s AND scratch_disk = %s""", (date, f"scratch{volume}"))
+
+        cursor.executemany(f"""INSERT INTO {SCHEMA}.lustre_usage (used, quota, record_date,
+            last_modified, pi_id, unix_id, base_directory_id, warning_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s);""", [
+            (
+                report.usage,
+                report.quota,
+                date,
+                report.relative_mtime,
+                pis.get(report.pi_name) if report.pi_name is not None else None,
+                groups.get(report.group_name) if report.group_name is not None else None,
+                base_dirs[get_mdt_symlink(report.base_path or "")],
+                warning
+            )
+            for report, warning in zip(reports, warnings)
+        ])
+        for report in reports:
+            db.histograms.insert_usage_histograms(
+                cursor, date, base_dirs[get_mdt_symlink(report.base_path or "")],
+                groups.get(report.group_name) if report.group_name is not None else None,
+                report.histograms)
+        db.ledger.complete_run(
+            db_conn, "group_reporter", volume, date, len(reports), commit=False)
+
+    with metrics.stage("db:lustre_usage", rows=len(reports)):
+        # it's idempotent, so it can always go again
+        db.common.retry_transaction(db_conn, replace)
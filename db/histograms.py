@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import datetime
+import typing as T
+
+import db.common
+from db_config import SCHEMA
+from lurge_types.histograms import HISTOGRAMS, Histograms
+
+# The size and age histograms (see lurge_types/histograms.py) go in the DB
+# a row per bucket with anything in it, alongside the row they're for:
+#     usage_histogram         lustre_usage (by date, base directory and group)
+#     directory_histogram     directory (by directory_id)
+#     user_usage_histogram    user_usage (by date, user, group and volume)
+# histogram_bucket has the lower bound of every bucket (bytes for size, days
+# for atime and mtime), so i.e. the data in a base directory that hasn't
+# been accessed for a year is:
+#     SELECT SUM(size) FROM usage_histogram INNER JOIN histogram_bucket
+#         USING (histogram, bucket)
+#     WHERE histogram = 'atime' AND lower_bound >= 365 AND ...
+
+_created = False
+
+
+def create_tables(conn: db.common.Connection) -> None:
+    """creates the histogram tables, if they aren't there yet"""
+    global _created
+    if _created:
+        return
+
+    cursor = conn.cursor()
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.histogram_bucket (
+        histogram VARCHAR(16) NOT NULL,
+        bucket TINYINT NOT NULL,
+        lower_bound BIGINT NOT NULL,
+        PRIMARY KEY (histogram, bucket)
+    )""")
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.usage_histogram (
+        record_date DATE NOT NULL,
+        base_directory_id INT NOT NULL,
+        unix_id INT,
+        histogram VARCHAR(16) NOT NULL,
+        bucket TINYINT NOT NULL,
+        num_files BIGINT NOT NULL,
+        size BIGINT NOT NULL,
+        INDEX (record_date, base_directory_id)
+    )""")
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.directory_histogram (
+        directory_id INT NOT NULL,
+        histogram VARCHAR(16) NOT NULL,
+        bucket TINYINT NOT NULL,
+        num_files BIGINT NOT NULL,
+        size BIGINT NOT NULL,
+        INDEX (directory_id)
+    )""")
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.user_usage_histogram (
+        record_date DATE NOT NULL,
+        user_id INT,
+        group_id INT,
+        volume_id INT NOT NULL,
+        histogram VARCHAR(16) NOT NULL,
+        bucket TINYINT NOT NULL,
+        num_files BIGINT NOT NULL,
+        size BIGINT NOT NULL,
+        INDEX (record_date, volume_id)
+    )""")
+    cursor.executemany(f"""INSERT IGNORE INTO {SCHEMA}.histogram_bucket
+        (histogram, bucket, lower_bound) VALUES (%s, %s, %s)""", [
+        (name, bucket, lower_bound)
+        for name, buckets in HISTOGRAMS.items()
+        for bucket, lower_bound in enumerate(buckets)
+    ])
+    conn.commit()
+    _created = True
+
+
+def _insert(cursor: db.common.Cursor, table: str, columns: T.Tuple[str, ...],
+            key: T.Tuple[T.Any, ...], histograms: T.Optional[Histograms]) -> int:
+    """a row for each bucket of histograms, starting with key
+
+    :returns: how many rows it added
+    """
+    rows = [(*key, *row) for row in histograms.rows()] if histograms is not None else []
+    if len(rows) > 0:
+        cursor.executemany(f"""INSERT INTO {SCHEMA}.{table} ({', '.join(columns)},
+            histogram, bucket, num_files, size)
+            VALUES ({', '.join(['%s'] * (len(columns) + 4))})""", rows)
+    return len(rows)
+
+
+def insert_usage_histograms(cursor: db.common.Cursor, date: datetime.date,
+                            base_directory_id: int, group_id: T.Optional[int],
+                            histograms: Histograms) -> int:
+    """the rows for a lustre_usage row's histograms"""
+    return _insert(cursor, "usage_histogram", ("record_date", "base_directory_id", "unix_id"),
+                   (date, base_directory_id, group_id), histograms)
+
+
+def insert_directory_histograms(cursor: db.common.Cursor, directory_id: int,
+                                histograms: T.Optional[Histograms]) -> int:
+    """the rows for a directory row's histograms"""
+    return _insert(cursor, "directory_histogram", ("directory_id",),
+                   (directory_id,), histograms)
+
+
+def insert_user_histograms(cursor: db.common.Cursor, date: datetime.date,
+                           user_id: T.Optional[int], group_id: T.Optional[int],
+                           volume_id: int, histograms: Histograms) -> int:
+    """the rows for a user_usage row's histograms"""
+    return _insert(cursor, "user_usage_histogram",
+                   ("record_date", "user_id", "group_id", "volume_id"),
+                   (date, user_id, group_id, volume_id), histograms)
+
+
+def delete_old_directory_histograms(cursor: db.common.Cursor) -> None:
+    """the histograms of directories about to be deleted (see
+    db/group_reporter.py)"""
+    cursor.execute(f"""DELETE FROM {SCHEMA}.directory_histogram WHERE directory_id IN (
+        SELECT directory_id FROM {SCHEMA}.directory
+        WHERE directory_path LIKE '.hgi.old.%'
+    )""")
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import datetime
+import functools
+import sqlite3
+import typing as T
+from collections import defaultdict
+
+import db.common
+import db.warnings
+import db_config
+from db.warnings import History
+from directory_config import HISTORY_DB
+from utils.symlink import get_mdt_symlink
+
+if T.TYPE_CHECKING:
+    from lurge_types.group_report import GroupReport
+
+# The warning system only ever looks at the last two data points for each
+# (group, base directory), so rather than pulling every lustre_usage row
+# out of MySQL on every run, we keep a small local SQLite store.
+#  - usage_history is the append-only log of every point we've seen
+#  - recent_usage holds just the last two points per key, so loading
+#    everything the warnings need is a scan over the keys, not the history
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_history (
+    group_name TEXT NOT NULL,
+    base_path TEXT NOT NULL,
+    record_date TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (group_name, base_path, record_date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS recent_usage (
+    group_name TEXT NOT NULL,
+    base_path TEXT NOT NULL,
+    prev_date TEXT,
+    prev_used INTEGER,
+    last_date TEXT NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (group_name, base_path)
+) WITHOUT ROWID;
+"""
+
+UsagePoint = T.Tuple[str, str, datetime.date, int]
+
+
+class HistoryStore:
+    def __init__(self, path: str = HISTORY_DB) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_SCHEMA)
+
+    def is_empty(self) -> bool:
+        return self.conn.execute(
+            "SELECT 1 FROM recent_usage LIMIT 1").fetchone() is None
+
+    def record(self, points: T.Iterable[UsagePoint]) -> None:
+        """appends (group_name, base_path, date, used) points to the store,
+        and refreshes the last two points for every key we touched.
+        Recording the same point twice is harmless."""
+        touched: T.Set[T.Tuple[str, str]] = set()
+
+        with self.conn:
+            for group_name, base_path, date, used in points:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO usage_history VALUES (?, ?, ?, ?)",
+                    (group_name, base_path, date.isoformat(), used))
+                touched.add((group_name, base_path))
+
+            # points may not arrive in date order (i.e. backfills), so we
+            # look the latest two up again, which is an index seek per key
+            for group_name, base_path in touched:
+                latest = self.conn.execute(
+                    """SELECT record_date, used FROM usage_history
+                    WHERE group_name = ? AND base_path = ?
+                    ORDER BY record_date DESC LIMIT 2""",
+                    (group_name, base_path)).fetchall()
+                prev = latest[1] if len(latest) > 1 else (None, None)
+
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO recent_usage VALUES (?, ?, ?, ?, ?, ?)",
+                    (group_name, base_path, *prev, *latest[0]))
+
+    def record_history(self, history: History) -> None:
+        """bulk loads a History (as from db.warnings) into the store"""
+        self.record(
+            (group, path, date, usage)
+            for (group, path), points in history.items()
+            if group is not None and path is not None
+            for date, usage in points)
+
+    def recent_usage(self) -> History:
+        """the last two points for every key, oldest first, in the same
+        form as db.warnings.get_all_historical_usage_data"""
+        history: History = defaultdict(list)
+
+        for group_name, base_path, prev_date, prev_used, last_date, last_used in self.conn.execute(
+                "SELECT * FROM recent_usage"):
+            if prev_date is not None:
+                history[(group_name, base_path)].append(
+                    (datetime.date.fromisoformat(prev_date), prev_used))
+            history[(group_name, base_path)].append(
+                (datetime.date.fromisoformat(last_date), last_used))
+
+        return history
+
+    def usage_before(self, date: datetime.date) -> History:
+        """like recent_usage, but the last two points for every key from
+        before date - what the history looked like then, for backfills"""
+        history: History = defaultdict(list)
+
+        for group_name, base_path, record_date, used in self.conn.execute(
+                """SELECT group_name, base_path, record_date, used FROM (
+                    SELECT *, ROW_NUMBER() OVER (
+                        PARTITION BY group_name, base_path ORDER BY record_date DESC) AS n
+                    FROM usage_history WHERE record_date < ?
+                ) WHERE n <= 2 ORDER BY group_name, base_path, record_date""", (date.isoformat(),)):
+            history[(group_name, base_path)].append(
+                (datetime.date.fromisoformat(record_date), used))
+
+        return history
+
+
+@functools.lru_cache(maxsize=None)
+def get_historical_usage() -> History:
+    """the history the warnings are calculated from - loaded once per
+    process. The first time the store is used it's seeded from MySQL."""
+    store = HistoryStore()
+    if store.is_empty():
+        with db.common.get_sql_connection(db_config) as conn:
+            store.record_history(
+                db.warnings.get_all_historical_usage_data(conn))
+    return store.recent_usage()
+
+
+def record_reports(reports: T.List[T.List[GroupReport]]) -> None:
+    """adds the usage from a successful run into the history store"""
+    HistoryStore().record(
+        (report.group_name, get_mdt_symlink(report.base_path or ""),
+         datetime.date.fromtimestamp(report.wrstat_time), report.usage)
+        for _vol in reports
+        for report in _vol
+        if report.group_name is not None
+    )
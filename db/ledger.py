@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import typing as T
+
+import db.common
+import db.histograms
+from db_config import SCHEMA
+
+# The run ledger has a row for every reporter, volume and day it's loaded
+# (or started loading) into the DB, so checking whether we've already got a
+# day's data is a primary key lookup, rather than going through every date
+# in the usage tables.
+#
+# A run is marked "loading" before it's read its wrstat file, and
+# "complete" in the same transaction as the last of its rows. If a run finds
+# one that's still "loading", the last one died part way through, so
+# whatever it loaded is cleared out and it's done again.
+
+LOADING = "loading"
+COMPLETE = "complete"
+
+# reporter: the table its rows are in, and whether it has to go through
+# base_directory to get to the volume
+TABLES: T.Dict[str, T.Tuple[str, bool]] = {
+    "group_reporter": ("lustre_usage", True),
+    "user_reporter": ("user_usage", False),
+    "puppeteer": ("vault", False)
+}
+# and any other tables that have rows for the same days (in the same form)
+# - these are cleared out along with them
+ALSO_CLEARED: T.Dict[str, T.List[T.Tuple[str, bool]]] = {
+    "group_reporter": [("usage_histogram", True)],
+    "user_reporter": [("user_usage_histogram", False)]
+}
+
+Logger = T.Union[logging.Logger, logging.LoggerAdapter[logging.Logger]]
+
+_created = False
+
+
+def create_ledger(conn: db.common.Connection) -> None:
+    """creates the run_ledger table, if it isn't there yet"""
+    global _created
+    if _created:
+        return
+
+    conn.cursor().execute(f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.run_ledger (
+        reporter VARCHAR(64) NOT NULL,
+        volume VARCHAR(32) NOT NULL,
+        record_date DATE NOT NULL,
+        wrstat_path VARCHAR(1024),
+        wrstat_mtime BIGINT,
+        status VARCHAR(16) NOT NULL,
+        `rows` BIGINT,
+        started DATETIME NOT NULL,
+        finished DATETIME,
+        PRIMARY KEY (reporter, volume, record_date)
+    )""")
+    conn.commit()
+    _created = True
+
+
+def get_status(conn: db.common.Connection, reporter: str, volume: int,
+               date: datetime.date) -> T.Optional[str]:
+    """what the ledger says about a day, if anything"""
+    create_ledger(conn)
+    cursor = conn.cursor()
+    cursor.execute(f"""SELECT status FROM {SCHEMA}.run_ledger
+        WHERE reporter = %s AND volume = %s AND record_date = %s""",
+                   (reporter, f"scratch{volume}", date))
+    result = cursor.fetchone()
+    return result[0] if result is not None else None
+
+
+def _has_rows(conn: db.common.Connection, reporter: str, volume: int,
+              date: datetime.date) -> bool:
+    """whether the reporter's table has any rows for a volume on a day"""
+    table, base_dir_usage = TABLES[reporter]
+    cursor = conn.cursor()
+    cursor.execute(f"""SELECT 1 FROM {SCHEMA}.{table}
+        {f'INNER JOIN {SCHEMA}.base_directory USING (base_directory_id)' if base_dir_usage else ''}
+        INNER JOIN {SCHEMA}.volume USING (volume_id)
+        WHERE record_date = %s AND scratch_disk = %s LIMIT 1""", (date, f"scratch{volume}"))
+    return cursor.fetchone() is not None
+
+
+def _clear(conn: db.common.Connection, reporter: str, volume: int,
+           date: datetime.date) -> None:
+    """removes a day's rows for a volume from the reporter's tables"""
+    for table, base_dir_usage in [TABLES[reporter], *ALSO_CLEARED.get(reporter, [])]:
+        conn.cursor().execute(
+            f"""DELETE {SCHEMA}.{table} FROM {SCHEMA}.{table}
+            {f'INNER JOIN {SCHEMA}.base_directory USING (base_directory_id)' if base_dir_usage else ''}
+            INNER JOIN {SCHEMA}.volume USING (volume_id)
+            WHERE record_date = %s AND scratch_disk = %s""", (date, f"scratch{volume}"))
+
+
+def record(conn: db.common.Connection, reporter: str, volume: int, date: datetime.date,
+           status: str, rows: T.Optional[int] = None, wrstat_path: T.Optional[str] = None,
+           wrstat_mtime: T.Optional[int] = None, commit: bool = True) -> None:
+    """
+    Sets the ledger row for a day. With commit=False, it's left to go in
+    with whatever else is in the transaction (i.e. the rows themselves).
+    """
+    create_ledger(conn)
+    now = datetime.datetime.now()
+    conn.cursor().execute(f"""INSERT INTO {SCHEMA}.run_ledger (reporter, volume, record_date,
+        wrstat_path, wrstat_mtime, status, `rows`, started, finished)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            wrstat_path = COALESCE(VALUES(wrstat_path), wrstat_path),
+            wrstat_mtime = COALESCE(VALUES(wrstat_mtime), wrstat_mtime),
+            status = VALUES(status), `rows` = VALUES(`rows`),
+            started = IF(VALUES(status) = %s, VALUES(started), started),
+            finished = VALUES(finished)""", (
+        reporter, f"scratch{volume}", date, wrstat_path, wrstat_mtime, status, rows,
+        now, now if status == COMPLETE else None, LOADING))
+
+    if commit:
+        conn.commit()
+
+
+def begin_run(conn: db.common.Connection, reporter: str, volume: int, date: datetime.date,
+              wrstat_path: str, wrstat_mtime: int, logger: Logger,
+              take_over: bool = True) -> bool:
+    """
+    Checks the ledger for a day's data for a volume, and if we need to
+    load it, marks it as loading - clearing out anything a run that died
+    part way through left behind.
+
+    Days that were loaded before there was a ledger aren't in it, so if a
+    day isn't, we look in the reporter's table for it instead.
+
+    :param take_over: - whether a day that's marked as loading is taken to
+        be from a run that died, and loaded again. Without it, it's left
+        alone, as something else could still be loading it
+
+    :returns: whether the day needs loading
+    """
+    status = get_status(conn, reporter, volume, date)
+
+    if status is None and _has_rows(conn, reporter, volume, date):
+        record(conn, reporter, volume, date, COMPLETE,
+               wrstat_path=wrstat_path, wrstat_mtime=wrstat_mtime)
+        status = COMPLETE
+
+    if status == COMPLETE:
+        logger.warning(f"{volume} already has DB data for {date}")
+        return False
+
+    if status == LOADING and not take_over:
+        logger.warning(f"{volume} is already being loaded for {date} (or the run died)")
+        return False
+
+    if status == LOADING:
+        # so there's something to clear out of, even if it never got there
+        db.histograms.create_tables(conn)
+
+    def begin(conn: db.common.Connection) -> None:
+        if status == LOADING:
+            logger.warning(
+                f"{volume} was only partly loaded for {date} - clearing it out to load again")
+            _clear(conn, reporter, volume, date)
+        record(conn, reporter, volume, date, LOADING, wrstat_path=wrstat_path,
+               wrstat_mtime=wrstat_mtime, commit=False)
+
+    db.common.retry_transaction(conn, begin)
+    return True
+
+
+def abandon_run(conn: db.common.Connection, reporter: str, volume: int,
+                date: datetime.date) -> None:
+    """takes a day that's marked as loading out of the ledger, for when we
+    gave up on it before loading anything, so it isn't taken to be still
+    loading next time"""
+    create_ledger(conn)
+    conn.cursor().execute(f"""DELETE FROM {SCHEMA}.run_ledger
+        WHERE reporter = %s AND volume = %s AND record_date = %s AND status = %s""",
+                          (reporter, f"scratch{volume}", date, LOADING))
+    conn.commit()
+
+
+def complete_run(conn: db.common.Connection, reporter: str, volume: int,
+                 date: datetime.date, rows: int, commit: bool = True) -> None:
+    """marks a day as loaded - pass commit=False to commit it along with
+    the last of the rows"""
+    record(conn, reporter, volume, date, COMPLETE, rows=rows, commit=commit)
+
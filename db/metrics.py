@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import typing as T
+
+import db.common
+from db_config import SCHEMA
+from utils.metrics import Metrics
+
+
+def write_run_metrics(conn: db.common.Connection, metrics: Metrics,
+                      logger: T.Union[logging.Logger, logging.LoggerAdapter[logging.Logger]]) -> None:
+    """adds a row per stage per process of a run into the run_metrics table
+    (which we'll create if it isn't there yet)"""
+    def write(conn: db.common.Connection) -> None:
+        cursor = conn.cursor()
+        cursor.execute(f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.run_metrics (
+            run_metrics_id INT AUTO_INCREMENT PRIMARY KEY,
+            reporter VARCHAR(64) NOT NULL,
+            run_started DATETIME NOT NULL,
+            process VARCHAR(128) NOT NULL,
+            stage VARCHAR(128) NOT NULL,
+            wall_secs DOUBLE NOT NULL,
+            cpu_secs DOUBLE NOT NULL,
+            calls BIGINT NOT NULL,
+            `lines` BIGINT NOT NULL,
+            bytes BIGINT NOT NULL,
+            `rows` BIGINT NOT NULL,
+            INDEX (reporter, run_started)
+        )""")
+
+        run_started = datetime.datetime.fromtimestamp(metrics.started)
+        for process, stages in metrics.processes.items():
+            for name, stage in stages.items():
+                cursor.execute(f"""INSERT INTO {SCHEMA}.run_metrics (reporter, run_started, process,
+                stage, wall_secs, cpu_secs, calls, `lines`, bytes, `rows`)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", (
+                    metrics.reporter,
+                    run_started,
+                    process,
+                    name,
+                    stage.wall,
+                    stage.cpu,
+                    stage.calls,
+                    stage.lines,
+                    stage.bytes,
+                    stage.rows
+                ))
+
+    # it's all rows we've not got yet, so it can all go again if it fails
+    db.common.retry_transaction(conn, write)
+    logger.info(f"run metrics for {metrics.reporter} loaded into MySQL")
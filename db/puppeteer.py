@@ -5,15 +5,19 @@ import typing as T
 import mysql.connector
 
 import db.foreign
+import db.ledger
 from db_config import SCHEMA
 from lurge_types.vault import VaultPuppet
+from utils.metrics import Metrics
 
 
 def write_to_db(conn, vault_reports: T.List[T.Tuple[int, T.Dict[str, VaultPuppet]]],
-                wrstat_dates: T.Dict[int, datetime.date], logger: logging.Logger) -> None:
+                wrstat_dates: T.Dict[int, datetime.date], logger: logging.Logger,
+                metrics: T.Optional[Metrics] = None) -> None:
     logger.info("Writing results to MySQL database")
 
     cursor = conn.cursor()
+    metrics = metrics or Metrics("puppeteer")
 
     # First, we'll get all the foreign keys for volumes, groups and actions
     # Any missing groups or volumes can be added later
@@ -22,6 +26,7 @@ def write_to_db(conn, vault_reports: T.List[T.Tuple[int, T.Dict[str, VaultPuppet
 
     _, groups, volumes, actions, users, _, _ = db.foreign.get_db_foreign_keys(
         conn)
+    db.ledger.create_ledger(conn)
 
     # Now, we're going to go through all the VaultReports and add each as a DB
     # record
@@ -80,5 +85,11 @@ def write_to_db(conn, vault_reports: T.List[T.Tuple[int, T.Dict[str, VaultPuppet
                 volumes[f"scratch{volume}"]
             ))
 
-    conn.commit()
+    # the ledger's marked in the same transaction as the rows
+    for volume, reports in vault_reports:
+        db.ledger.complete_run(conn, "puppeteer", volume, wrstat_dates[volume],
+                               len(reports), commit=False)
+
+    with metrics.stage("db:commit"):
+        conn.commit()
     logger.info("Puppeteer data loaded into MySQL")
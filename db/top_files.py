@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import datetime
+import typing as T
+
+import db.common
+from db_config import SCHEMA
+from lurge_types.group_report import GroupReport
+from utils.symlink import get_mdt_symlink
+
+# The largest and least recently modified files under each base directory
+# (see lurge_types/top_files.py). Like the directory table, this only ever
+# has the latest run's - each volume's are replaced when it's loaded.
+#
+# kind is "largest" or "oldest", and file_rank is where it comes in that
+# list, from 1 (the largest, or the oldest).
+
+_created = False
+
+
+def create_table(conn: db.common.Connection) -> None:
+    """creates the top_file table, if it isn't there yet"""
+    global _created
+    if _created:
+        return
+
+    conn.cursor().execute(f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.top_file (
+        record_date DATE NOT NULL,
+        base_directory_id INT NOT NULL,
+        unix_id INT,
+        kind VARCHAR(8) NOT NULL,
+        file_rank INT NOT NULL,
+        file_path VARCHAR(4096) NOT NULL,
+        size BIGINT NOT NULL,
+        last_modified DATE NOT NULL,
+        INDEX (base_directory_id, unix_id)
+    )""")
+    conn.commit()
+    _created = True
+
+
+def delete_volume(cursor: db.common.Cursor, volume: int) -> None:
+    """clears out the last run's files for a volume"""
+    cursor.execute(f"""DELETE FROM {SCHEMA}.top_file WHERE base_directory_id IN (
+        SELECT base_directory_id FROM {SCHEMA}.base_directory
+        INNER JOIN {SCHEMA}.volume USING (volume_id)
+        WHERE scratch_disk = %s
+    )""", (f"scratch{volume}",))
+
+
+def insert_top_files(cursor: db.common.Cursor, report: GroupReport,
+                     base_directory_id: int, group_id: T.Optional[int]) -> int:
+    """the rows for a report's largest and oldest files
+
+    :returns: how many rows it added
+    """
+    date = datetime.date.fromtimestamp(report.wrstat_time)
+    rows = [
+        (date, base_directory_id, group_id, kind, rank, get_mdt_symlink(top_file.path),
+         top_file.size, datetime.date.fromtimestamp(top_file.mtime))
+        for kind, top_files in (("largest", report.top_files.largest_files()),
+                                ("oldest", report.top_files.oldest_files()))
+        for rank, top_file in enumerate(top_files, start=1)
+    ]
+    if len(rows) > 0:
+        cursor.executemany(f"""INSERT INTO {SCHEMA}.top_file (record_date, base_directory_id,
+            unix_id, kind, file_rank, file_path, size, last_modified)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""", rows)
+    return len(rows)
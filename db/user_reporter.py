@@ -3,25 +3,32 @@ import logging
 import typing as T
 
 import db.foreign
+import db.histograms
+import db.ledger
 from db_config import SCHEMA
 from lurge_types.user import UserReport
+from utils.metrics import Metrics
 
 
 def load_user_reports_to_db(
     conn,
-    volume_user_reports: T.Dict[int, T.DefaultDict[str, UserReport]],
+    volume_user_reports: T.Dict[int, T.Mapping[str, UserReport]],
     usernames: T.Dict[int, str],
     user_groups: T.Dict[str, T.Set[T.Tuple[str, str]]],
     wrstat_dates: T.Dict[int, datetime.date],
-    logger: logging.Logger
+    logger: logging.Logger,
+    metrics: T.Optional[Metrics] = None
 ):
     logger.info("Writing results to MySQL database")
 
     cursor = conn.cursor()
+    metrics = metrics or Metrics("user_reporter")
 
     # First, we'll get all the foreign keys
 
     _, groups, volumes, _, users, _, _ = db.foreign.get_db_foreign_keys(conn)
+    db.ledger.create_ledger(conn)
+    db.histograms.create_tables(conn)
 
     # Now, we'll go through every record (just like in the TSV generator) and
     # add a DB record for all of them
@@ -74,6 +81,16 @@ def load_user_reports_to_db(
                         report.size[gid],
                         report._mtime[gid]
                     ))
-    conn.commit()
+                    db.histograms.insert_user_histograms(
+                        cursor, wrstat_dates[volume], db_user, db_group,
+                        volumes[f"scratch{volume}"], report.histograms[gid])
+
+    # the ledger's marked in the same transaction as the rows
+    for volume, reports in volume_user_reports.items():
+        db.ledger.complete_run(conn, "user_reporter", volume, wrstat_dates[volume],
+                               sum(len(report.size) for report in reports.values()), commit=False)
+
+    with metrics.stage("db:commit"):
+        conn.commit()
 
     logger.info("Finished writing user reports to DB")
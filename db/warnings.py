@@ -2,8 +2,7 @@ import datetime
 import typing as T
 from collections import defaultdict
 
-import mysql.connector
-
+import db.common
 from db_config import SCHEMA
 
 History = T.DefaultDict[T.Tuple[T.Optional[str],
@@ -11,7 +10,7 @@ History = T.DefaultDict[T.Tuple[T.Optional[str],
 
 
 def get_all_historical_usage_data(
-        conn: mysql.connector.MySQLConnection) -> History:
+        conn: db.common.Connection) -> History:
     all_history: History = defaultdict(list)
 
     cursor = conn.cursor()
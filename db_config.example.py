@@ -4,3 +4,6 @@ DATABASE = "lustre_usage"
 USER = "pytest"
 PASSWORD = "pytest"
 SCHEMA = "hgi_lustre_usage_new"
+# optional - a SQLite file to use instead of MySQL, i.e. for testing (see
+# db/common.py)
+SQLITE = None
@@ -1,11 +1,124 @@
 import os
 
 # Global Config
-WRSTAT_DIR = "/lustre/scratch123/admin/team94/wrstat/output/"
+# LURGE_WRSTAT_DIR can point somewhere else, i.e. synthetic data for benchmarks
+WRSTAT_DIR = os.getenv("LURGE_WRSTAT_DIR",
+                       "/lustre/scratch123/admin/team94/wrstat/output/")
 REPORT_DIR = os.environ["REPORT_DIR"] + "/"
+# Where the index of WRSTAT_DIR is kept, so not every process has to list
+# it (see utils/catalogue.py)
+CATALOGUE_CACHE = REPORT_DIR + ".wrstat_catalogue.json"
 VOLUMES = [117, 118, 119, 123, 124, 125, 126]
 LOGGING_CONFIG = "/software/hgi/installs/lurge/etc/logging.conf"
 
+# Columnar (Parquet) exports of each night's aggregates, partitioned
+# by date and volume (see utils/export.py)
+EXPORT_DIR = REPORT_DIR + "exports/"
+
+# Query Service (see query_server.py)
+# Serves the latest exports over HTTP on localhost, checking for a new run
+# every QUERY_RELOAD_INTERVAL seconds
+QUERY_PORT = int(os.getenv("LURGE_QUERY_PORT", "8461"))
+QUERY_RELOAD_INTERVAL = 300
+
+# Run Metrics (see utils/metrics.py)
+# Every run writes a JSON summary of how long each stage took, and its
+# throughput, to METRICS_DIR. If METRICS_TO_DB, it also goes in the
+# run_metrics table
+METRICS_DIR = REPORT_DIR + "metrics/"
+METRICS_TO_DB = False
+
+# MySQL Connections (see db/common.py)
+# Each process keeps up to DB_POOL_SIZE connections to the DB open, and
+# statements that fail with a transient error (i.e. a dropped connection or
+# a deadlock) are tried again up to DB_RETRIES times, waiting
+# DB_RETRY_BACKOFF seconds the first time and twice as long each time after.
+# If they're all in use, getting one gives up after DB_POOL_TIMEOUT seconds
+DB_POOL_SIZE = 4
+DB_POOL_TIMEOUT = 300
+DB_RETRIES = 5
+DB_RETRY_BACKOFF = 1.0
+
+# Spill-to-disk Aggregation (see utils/spill.py)
+# If set, each reporter process writes its partial aggregates out to
+# SPILL_DIR (local scratch) whenever it's using more than this much memory,
+# and merges them back together at the end. None keeps everything in memory
+SPILL_MEMORY_LIMIT_MB = int(os.environ["LURGE_SPILL_MEMORY_MB"]) \
+    if "LURGE_SPILL_MEMORY_MB" in os.environ else None
+SPILL_DIR = os.getenv("TMPDIR", "/tmp")
+
+# Checkpointing (see utils/checkpoint.py)
+# Long volume scans save their progress and partial aggregates to
+# CHECKPOINT_DIR every CHECKPOINT_INTERVAL seconds, so a run that dies
+# can pick up where it left off. This has to be somewhere every MPI rank
+# can see. It's off (None) unless LURGE_CHECKPOINT_DIR is set
+CHECKPOINT_DIR = os.getenv("LURGE_CHECKPOINT_DIR")
+CHECKPOINT_INTERVAL = 1800
+
+# Drill-down Trees (see utils/drilldown.py)
+# If set, the group reporter also totals up every directory under each
+# base directory, down to DRILLDOWN_DEPTH levels, in the same pass, and
+# writes them to DRILLDOWN_DIR. None turns it off
+DRILLDOWN_DEPTH = int(os.environ["LURGE_DRILLDOWN_DEPTH"]) \
+    if "LURGE_DRILLDOWN_DEPTH" in os.environ else None
+DRILLDOWN_DIR = REPORT_DIR + "drilldown/"
+
+# Top Files (see lurge_types/top_files.py)
+# The group reporter keeps the TOP_FILES largest, and least recently
+# modified, files under each group's base directory, so when a group's
+# running out of space, we know where to start. None turns it off
+TOP_FILES = 20
+
+# Duplicate Candidates (see duplicate_reporter.py and utils/duplicates.py)
+# Files of at least DUPLICATE_MIN_SIZE bytes with exactly the same size
+# (and, if set, the same filetype from FILETYPES and the same name) are
+# reported as possible copies of each other, within and across volumes.
+# They're hash partitioned into DUPLICATE_PARTITIONS files on SPILL_DIR,
+# and each partition is grouped up on its own, so only one partition's
+# files are ever in memory - more partitions uses less memory
+DUPLICATE_MIN_SIZE = 2**30
+DUPLICATES_BY_FILETYPE = True
+DUPLICATES_BY_NAME = False
+DUPLICATE_PARTITIONS = 64
+
+# Vault Locations (see utils/vault_index.py)
+# puppeteer remembers where the .vault directories on each volume were last
+# time, in VAULT_INDEX, and only looks at the files under them (and at
+# directories, for any new ones). Every VAULT_SWEEP_DAYS days it looks at
+# everything with .vault in its path instead, in case it's missed any.
+# None always does
+VAULT_INDEX = REPORT_DIR + ".vault_index.json"
+VAULT_SWEEP_DAYS = 7
+
+# Sampling (see utils/sampling.py)
+# group_reporter.py --sample and user_reporter.py --sample estimate each
+# group's and user's usage from a stratified sample of the latest wrstat
+# files, in blocks of SAMPLE_BATCH_BYTES: all of the first
+# SAMPLE_STRATUM_BLOCKS blocks, then SAMPLE_PER_STRATUM blocks picked at
+# random from every SAMPLE_STRATUM_BLOCKS after that. Files of at least
+# SAMPLE_EXACT_SIZE are picked out of every block, and counted exactly, as
+# a few of them can be most of a volume. The estimates (with rough error
+# bounds) are written to ESTIMATES_DIR, and never go in the DB
+SAMPLE_BATCH_BYTES = 2**20
+SAMPLE_STRATUM_BLOCKS = 50
+SAMPLE_PER_STRATUM = 2
+SAMPLE_EXACT_SIZE = 10**8
+ESTIMATES_DIR = REPORT_DIR + "estimates/"
+
+# Subtree Indexes (see utils/subtree.py)
+# python -m utils.subtree build writes every line of each volume's latest
+# wrstat file to SUBTREE_DIR, sorted by path, so the totals (or a listing)
+# for any directory only need the part of the file it's in. They're
+# sorted on SPILL_DIR, with no more than SUBTREE_MEMORY_MB in memory at once
+SUBTREE_DIR = REPORT_DIR + "subtree/"
+SUBTREE_MEMORY_MB = 4096
+
+# Exact Hardlink Accounting (see utils/hardlinks.py)
+# Normally each link to a file counts for size // nlink of it. If set, each
+# (device, inode) is counted once, in full, by just one of its links,
+# which takes an extra pass over each wrstat file to work out
+EXACT_HARDLINKS = os.getenv("LURGE_EXACT_HARDLINKS", "") not in ("", "0")
+
 # Manager Config
 # max number of days ago to search for wrstat
 MAX_DAYS_AGO = 10
@@ -17,6 +130,9 @@ MAX_DAYS_AGO = 10
 # set of thresholds: (days from now, amount of quota to exceed)
 # The levels here must match the DB
 DEFAULT_WARNING = 1
+# Local store of the usage history the warnings are predicted from
+# (see db/history.py) - seeded from MySQL the first time it's used
+HISTORY_DB = REPORT_DIR + ".lurge_history.sqlite"
 WARNINGS = {
     2: {(7, 0.85)},
     3: {(3, 0.8), (7, 0.95)}
@@ -55,6 +171,12 @@ class Treeserve:
     OVERHEAD_SECS = 100
     EXTRA_NODES = 50
 
+    # If set (or with --snapshots), the splitter also writes a snapshot of
+    # each group's directory tree, that can be memory mapped rather than
+    # built from the lines (see utils/snapshot.py), and index.txt gets its
+    # exact size
+    SNAPSHOTS = False
+
     # Format is list of pairs (max percent: bytes per node)
     # This list MUST be in ascending percentage order
     # 100 is used as the default value
@@ -0,0 +1,121 @@
+import argparse
+import datetime
+import logging
+import logging.config
+import typing as T
+from collections import defaultdict
+
+import db.common
+import db.metrics
+import db_config as config
+import utils.export
+import utils.finder
+import utils.ldap
+import utils.pipeline
+from lurge_types.duplicates import DuplicateSet
+from utils.duplicates import CandidatePartitions, find_candidates
+from utils.metrics import Metrics
+from utils.pipeline import SharedMemoryPipeline
+from directory_config import (DUPLICATE_MIN_SIZE, DUPLICATES_BY_FILETYPE, DUPLICATES_BY_NAME,
+                              LOGGING_CONFIG, METRICS_TO_DB, VOLUMES, WRSTAT_DIR)
+
+
+def get_candidates_from_wrstat(
+        volume: int, partitions: CandidatePartitions, logger: logging.Logger,
+        pipeline: SharedMemoryPipeline) -> T.Tuple[datetime.date, Metrics]:
+    """Reads a wrstat file for a volume, and puts every file that's big
+    enough to be worth looking at in the hash partitions (see
+    utils/duplicates.py)
+
+    :returns: the date of the wrstat file, and the Metrics for this volume
+    """
+    metrics = Metrics("duplicate_reporter", f"Volume {volume}")
+
+    with metrics.stage("find_report"):
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
+    wr_date_str = report_path.split("/")[-1].split("_")[0]
+    wr_date = datetime.date(int(wr_date_str[:4]), int(
+        wr_date_str[4:6]), int(wr_date_str[6:8]))
+
+    _, lines_read = pipeline.run(
+        report_path, find_candidates,
+        (DUPLICATE_MIN_SIZE, DUPLICATES_BY_FILETYPE, DUPLICATES_BY_NAME),
+        lambda candidates: partitions.add(volume, candidates), metrics, "read_wrstat")
+    logger.debug(f"Read {lines_read} lines from {volume}")
+
+    logger.info(f"Finished processing {volume}")
+    return wr_date, metrics
+
+
+def main(volumes: T.List[int] = VOLUMES, processes: T.Optional[int] = None) -> None:
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+    metrics = Metrics("duplicate_reporter")
+
+    # sets (and the bytes we could get back) by volume, with the ones
+    # across volumes under None
+    sets: T.DefaultDict[T.Optional[int], int] = defaultdict(int)
+    reclaimable: T.DefaultDict[T.Optional[int], int] = defaultdict(int)
+
+    def tally(duplicate_sets: T.Iterator[DuplicateSet]) -> T.Iterator[DuplicateSet]:
+        for duplicate_set in duplicate_sets:
+            volume_reclaimable = duplicate_set.volume_reclaimable()
+            for volume, size in volume_reclaimable.items():
+                if size > 0:
+                    sets[volume] += 1
+                    reclaimable[volume] += size
+            if len(volume_reclaimable) > 1:
+                sets[None] += 1
+                reclaimable[None] += duplicate_set.reclaimable
+            yield duplicate_set
+
+    with CandidatePartitions() as partitions:
+        # every volume is read at once, sharing a pool of processes, and
+        # the candidates from all of them go in the same partitions
+        with metrics.stage("wait_for_volumes"):
+            results = utils.pipeline.run_volumes(
+                lambda volume, pipeline: get_candidates_from_wrstat(
+                    volume, partitions, logger, pipeline),
+                volumes, processes)
+
+        wrstat_dates: T.Dict[int, datetime.date] = {}
+        for volume, (wr_date, volume_metrics) in zip(volumes, results):
+            wrstat_dates[volume] = wr_date
+            metrics.merge(volume_metrics)
+        logger.info(f"{partitions.candidates} files of at least {DUPLICATE_MIN_SIZE} bytes")
+
+        with metrics.stage("ldap"):
+            ldap_conn = utils.ldap.get_ldap_connection()
+            _, groups = utils.ldap.get_groups_ldap_info(ldap_conn)
+
+        # the partitions are grouped up as they're exported, so we never
+        # have more than one in memory
+        with metrics.stage("export", rows=partitions.candidates):
+            utils.export.export_duplicates(
+                tally(partitions.duplicate_sets()), groups, wrstat_dates, logger)
+
+    for volume in volumes:
+        logger.info(f"scratch{volume}: {sets[volume]} sets of duplicate candidates, "
+                    f"{reclaimable[volume]} bytes reclaimable")
+    logger.info(f"across volumes: {sets[None]} sets of duplicate candidates, "
+                f"{reclaimable[None]} bytes reclaimable")
+
+    logger.info(f"run metrics written to {metrics.write_summary()}")
+    if METRICS_TO_DB:
+        db.metrics.write_run_metrics(
+            db.common.get_sql_connection(config), metrics, logger)
+
+
+if __name__ == "__main__":
+    """
+    Finds the duplicate candidates on some volumes (or all of them), i.e.:
+        python duplicate_reporter.py 123 124 --processes 16
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("volumes", type=int, nargs="*", default=VOLUMES)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of processes to read the files with (defaults to the number of CPUs)")
+    args = parser.parse_args()
+
+    main(args.volumes, args.processes)
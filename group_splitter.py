@@ -4,30 +4,69 @@ import glob
 import gzip
 import logging
 import logging.config
-import multiprocessing
 import os
 import subprocess
 import time
 import typing as T
+from array import array
 from collections import defaultdict
-from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 
+import db.common
+import db.metrics
+import db_config as config
 import utils.finder
 import utils.ldap
-from directory_config import (LOGGING_CONFIG, REPORT_DIR, VOLUMES, WRSTAT_DIR,
-                              Treeserve)
+import utils.pipeline
+import utils.snapshot
+from directory_config import (LOGGING_CONFIG, METRICS_TO_DB, REPORT_DIR,
+                              VOLUMES, WRSTAT_DIR, Treeserve)
 from lurge_types.splitter import GroupSplit
+from utils.filters import LineFilter
+from utils.metrics import Metrics
+from utils.pipeline import SharedMemoryPipeline
+from utils.wrstat import GID, TYPE, WrstatBlock
+
+
+def _split_by_group(data: bytes) -> T.Tuple[array, array, array, T.List[bytes]]:
+    """what the pool processes do with each batch of lines - splits them up
+    by group, and gzips each group's lines, so all we have to do with them
+    back in the main process is write them out. The lines stay as bytes
+    the whole way through (see utils/wrstat.py), and we only get the ones
+    for groups we've got a name for (see get_group_info_from_wrstat).
+
+    :returns: columns of group id, line count, directory count and the
+        gzipped lines
+    """
+    block = WrstatBlock(data)
+
+    # by the group id, as bytes
+    group_lines: T.DefaultDict[bytes, T.List[bytes]] = defaultdict(list)
+    directory_counts: T.DefaultDict[bytes, int] = defaultdict(int)
+    for group_id, file_type, line in zip(block.column(GID), block.column(TYPE), block.lines()):
+        group_lines[group_id].append(line)
+        if file_type == b"d":
+            directory_counts[group_id] += 1
+
+    return (array("q", (int(group_id) for group_id in group_lines)),
+            array("q", (len(split) for split in group_lines.values())),
+            array("q", (directory_counts[group_id] for group_id in group_lines)),
+            [gzip.compress(b"\n".join(split) + b"\n") for split in group_lines.values()])
 
 
 def get_group_info_from_wrstat(
-        volume: int, groups: T.Dict[str, str], logger: logging.Logger) -> T.DefaultDict[str, GroupSplit]:
+        volume: int, groups: T.Dict[str, str], logger: logging.Logger,
+        pipeline: T.Optional[SharedMemoryPipeline] = None) -> T.Tuple[T.DefaultDict[str, GroupSplit], Metrics]:
     """processes a wrstat file to get us group information
 
     :param volume: - the volume we're going to be searching through
     :param groups: - pairs of group ids to the group names
     :param logger: - a logging.Logger object to log to
+    :param pipeline: - the SharedMemoryPipeline to read the file with (see
+        utils/pipeline.py). If there isn't one, we'll make our own
 
-    :returns: DefaultDict[group_id (str), group_information (GroupSplit)]
+    :returns: DefaultDict[group_id (str), group_information (GroupSplit)],
+        and the Metrics for this volume
     example:
         {
             "12345": GroupSplit{
@@ -39,8 +78,15 @@ def get_group_info_from_wrstat(
             }
         }
     """
+    if pipeline is None:
+        with utils.pipeline.local_pipeline() as pipeline:
+            return get_group_info_from_wrstat(volume, groups, logger, pipeline)
+
+    metrics = Metrics("group_splitter", f"Volume {volume}")
 
-    report = utils.finder.find_report(f"scratch{volume}", WRSTAT_DIR, logger)
+    with metrics.stage("find_report"):
+        report = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
 
     if report is None:
         raise FileNotFoundError(
@@ -48,50 +94,43 @@ def get_group_info_from_wrstat(
 
     group_info: T.DefaultDict[str, GroupSplit] = defaultdict(GroupSplit)
 
-    with gzip.open(report, "rt") as wrstat:
-        lines_read: int = 0
-        for line in wrstat:
-
-            # Logging
-            lines_read += 1
-            if lines_read % 5000000 == 0:
-                logger.debug(f"Read {lines_read} from {volume}")
-
-            # Split all the line info
-            wr_line_info = line.split()
-            group_id: str = wr_line_info[3]
+    def merge(split: T.Tuple[array, array, array, T.List[bytes]]) -> None:
+        for gid, line_count, directory_count, data in zip(*split):
+            group_id = str(gid)
 
             if group_info[group_id].volume is None:
-                # unfortunately, this has to be like this
-                # because we need a constructor for defaultdict
-                # that isn't dependent on any variable in this
-                # function (like volume) :(
-                # normally this isn't the case, but because
-                # we're in multiprocessing, the constructor
-                # needs to be picklable
                 group_info[group_id].volume = volume
 
             if group_info[group_id].group_name is None:
-                try:
-                    group_info[group_id].group_name = groups[group_id]
-                except KeyError:
-                    continue
-
-            group_info[group_id].add_lines(line)
-            group_info[group_id].line_count += 1
-            if wr_line_info[7] == "d":
-                group_info[group_id].directory_count += 1
+                group_info[group_id].group_name = groups.get(group_id)
+
+            if line_count > 0:
+                group_info[group_id].add_compressed(data)
+                group_info[group_id].line_count += line_count
+                group_info[group_id].directory_count += directory_count
+
+    # the lines for each group are written out as we go, in the same order
+    # they're in the wrstat file. Groups we don't have a name for would
+    # only be thrown away at the end, so their lines are dropped before
+    # they get to _split_by_group (see utils/filters.py)
+    _, lines_read = pipeline.run(
+        report, _split_by_group, (), merge, metrics, "split_wrstat",
+        line_filter=LineFilter(gids=frozenset(int(gid) for gid in groups)))
+    logger.debug(f"Read {lines_read} from {volume}")
 
     logger.info(f"finished reading {volume}")
-    return group_info
+    return group_info, metrics
 
 
-def main(upload: bool = True) -> None:
+def main(upload: bool = True, processes: T.Optional[int] = None,
+         snapshots: bool = Treeserve.SNAPSHOTS) -> None:
     logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
     logger = logging.getLogger(__name__)
+    metrics = Metrics("group_splitter")
 
-    ldap_conn = utils.ldap.get_ldap_connection()
-    _, groups = utils.ldap.get_groups_ldap_info(ldap_conn)
+    with metrics.stage("ldap"):
+        ldap_conn = utils.ldap.get_ldap_connection()
+        _, groups = utils.ldap.get_groups_ldap_info(ldap_conn)
 
     date_str = datetime.datetime.now().strftime("%Y%m%d")
 
@@ -102,40 +141,63 @@ def main(upload: bool = True) -> None:
         logger.warning(f"data already exists for {date_str}")
         return
 
-    with multiprocessing.Pool(processes=max(len(VOLUMES), 1)) as pool:
-        reports_by_volume: T.List[T.DefaultDict[str, GroupSplit]] = pool.starmap(
-            get_group_info_from_wrstat, zip(VOLUMES, repeat(groups), repeat(logger)))
+    # every volume is read at once, sharing a pool of processes
+    with metrics.stage("wait_for_volumes"):
+        results: T.List[T.Tuple[T.DefaultDict[str, GroupSplit], Metrics]] = utils.pipeline.run_volumes(
+            lambda volume, pipeline: get_group_info_from_wrstat(
+                volume, groups, logger, pipeline),
+            VOLUMES, processes)
+
+    reports_by_volume: T.List[T.DefaultDict[str, GroupSplit]] = []
+    for volume_reports, volume_metrics in results:
+        reports_by_volume.append(volume_reports)
+        metrics.merge(volume_metrics)
 
     logger.info("flushing any remaining lines and totalling directory counts")
     all_group_info: T.DefaultDict[str, GroupSplit] = defaultdict(GroupSplit)
-    for volume in reports_by_volume:
-        for gid, report in volume.items():
-            report.flush_lines()
-            all_group_info[gid] += report
+    with metrics.stage("flush"):
+        for volume in reports_by_volume:
+            for gid, report in volume.items():
+                report.flush_lines()
+                all_group_info[gid] += report
 
     logger.info("concatenating all the files")
-    gids_to_delete: T.List[str] = []
-    for gid, total_report in all_group_info.items():
-        try:
-            total_report.group_name = groups[gid]
-            group_files = glob.glob(
-                f"{REPORT_DIR}groups/{date_str}/{groups[gid]}.*.dat.gz")
-            os.system(
-                f"cat {' '.join(group_files)} > {REPORT_DIR}groups/{date_str}/{groups[gid]}.dat.gz")
-            for f in group_files:
-                os.remove(f)
-        except KeyError:
-            gids_to_delete.append(gid)
-            continue
+    with metrics.stage("concatenate"):
+        gids_to_delete: T.List[str] = []
+        for gid, total_report in all_group_info.items():
+            try:
+                total_report.group_name = groups[gid]
+                group_files = glob.glob(
+                    f"{REPORT_DIR}groups/{date_str}/{groups[gid]}.*.dat.gz")
+                os.system(
+                    f"cat {' '.join(group_files)} > {REPORT_DIR}groups/{date_str}/{groups[gid]}.dat.gz")
+                for f in group_files:
+                    os.remove(f)
+            except KeyError:
+                gids_to_delete.append(gid)
+                continue
 
     for gid in gids_to_delete:
         del all_group_info[gid]
 
+    # each group's tree is built from its file, a group to a process, so
+    # we never have more than one group's tree per process in memory
+    snapshot_sizes: T.Dict[str, int] = {}
+    if snapshots:
+        logger.info("writing tree snapshots")
+        with metrics.stage("snapshots"), ProcessPoolExecutor(processes) as pool:
+            gids = list(all_group_info)
+            for gid, size in zip(gids, pool.map(utils.snapshot.write_snapshot, [
+                    f"{REPORT_DIR}groups/{date_str}/{groups[gid]}.dat.gz" for gid in gids], [
+                    f"{REPORT_DIR}groups/{date_str}/{groups[gid]}.tree" for gid in gids])):
+                snapshot_sizes[gid] = size
+
     logger.info("writing index file")
     with open(f"{REPORT_DIR}groups/{date_str}/index.txt", "w") as f:
-        f.write("Group\tBuild Time (sec)\tMemory Use(bytes)\n")
+        f.write("Group\tBuild Time (sec)\tMemory Use(bytes)" +
+                ("\tSnapshot (bytes)" if snapshots else "") + "\n")
 
-        for report in all_group_info.values():
+        for gid, report in all_group_info.items():
             build_time = Treeserve.OVERHEAD_SECS + \
                 report.line_count // Treeserve.LINES_PER_SECOND
 
@@ -147,8 +209,9 @@ def main(upload: bool = True) -> None:
             memory_use = (report.directory_count * 2 +
                           Treeserve.EXTRA_NODES) * bytes_per_node
 
-            f.write("\t".join([str(report.group_name), str(
-                build_time), str(memory_use)]) + "\n")
+            # a snapshot takes exactly as much memory as it is big
+            f.write("\t".join([str(report.group_name), str(build_time), str(memory_use)] + (
+                [str(snapshot_sizes[gid])] if snapshots else [])) + "\n")
 
     # Write group and passwd files
     os.system(f"getent group > {REPORT_DIR}groups/{date_str}/groupfile")
@@ -156,25 +219,35 @@ def main(upload: bool = True) -> None:
 
     if upload:
         logger.info("uploading to s3")
-        for _ in range(5):
-            proc = subprocess.run(
-                ["s3cmd", "sync", f"{REPORT_DIR}groups/{date_str}/", Treeserve.S3_UPLOAD_LOCATION], capture_output=True)
-            if proc.returncode == 0:
-                logger.info("successfully uploaded to S3")
-                break
+        with metrics.stage("s3_upload"):
+            for _ in range(5):
+                proc = subprocess.run(
+                    ["s3cmd", "sync", f"{REPORT_DIR}groups/{date_str}/", Treeserve.S3_UPLOAD_LOCATION], capture_output=True)
+                if proc.returncode == 0:
+                    logger.info("successfully uploaded to S3")
+                    break
+                else:
+                    logger.warning("s3cmd sync failed, retrying in two seconds")
+                    logger.debug(
+                        f"{proc.stdout.decode('UTF-8')}\n{proc.stderr.decode('UTF-8')}")
+                    time.sleep(2)
             else:
-                logger.warning("s3cmd sync failed, retrying in two seconds")
-                logger.debug(
-                    f"{proc.stdout.decode('UTF-8')}\n{proc.stderr.decode('UTF-8')}")
-                time.sleep(2)
-        else:
-            logger.warning(
-                "s3cmd sync failed five times in a row. didn't sync")
+                logger.warning(
+                    "s3cmd sync failed five times in a row. didn't sync")
+
+    logger.info(f"run metrics written to {metrics.write_summary()}")
+    if METRICS_TO_DB:
+        with db.common.get_sql_connection(config) as db_conn:
+            db.metrics.write_run_metrics(db_conn, metrics, logger)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--upload", action="store_true",
                         help="Upload the produced data to S3")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of processes to split the files with (defaults to the number of CPUs)")
+    parser.add_argument("--snapshots", action="store_true", default=Treeserve.SNAPSHOTS,
+                        help="also write a snapshot of each group's tree (see utils/snapshot.py)")
     args = parser.parse_args()
-    main(args.upload)
+    main(args.upload, args.processes, args.snapshots)
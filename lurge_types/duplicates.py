@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import hashlib
+import typing as T
+from collections import Counter
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class DuplicateFile:
+    volume: int
+    path: str
+    gid: int
+    mtime: int
+
+
+@dataclass
+class DuplicateSet:
+    """
+    Files that could be copies of each other - they've got the same size
+    (and filetype and name, if we're going by them, see
+    DUPLICATES_BY_FILETYPE and DUPLICATES_BY_NAME in directory_config.py).
+    Hardlinks to the same file are only in here once.
+
+    Nothing's actually been compared, so these are just candidates, for
+    someone to checksum before deleting anything.
+    """
+    size: int
+    filetype: T.Optional[str] = None
+    name: T.Optional[str] = None
+    files: T.List[DuplicateFile] = field(default_factory=lambda: [])
+
+    @property
+    def set_id(self) -> str:
+        """the same for the same set of files from one night to the next"""
+        return hashlib.blake2b(
+            f"{self.size}:{self.filetype}:{self.name}".encode("UTF-8", "replace"),
+            digest_size=8).hexdigest()
+
+    @property
+    def copies(self) -> int:
+        return len(self.files)
+
+    @property
+    def reclaimable(self) -> int:
+        """what we'd get back by only keeping one of them"""
+        return self.size * (self.copies - 1)
+
+    def volume_copies(self) -> T.Dict[int, int]:
+        """how many of them are on each volume"""
+        return dict(Counter(file.volume for file in self.files))
+
+    def volume_reclaimable(self) -> T.Dict[int, int]:
+        """what we'd get back by only keeping one of them on each volume"""
+        return {volume: self.size * (copies - 1)
+                for volume, copies in self.volume_copies().items()}
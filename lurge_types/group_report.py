@@ -5,8 +5,11 @@ import typing as T
 from collections import defaultdict
 from dataclasses import dataclass, field
 
-from db import historical_usage
+import db.history
 from directory_config import DEFAULT_WARNING, WARNINGS
+from lurge_types.histograms import Histograms
+from lurge_types.top_files import TopFiles
+from utils.symlink import get_mdt_symlink
 
 
 @dataclass
@@ -17,6 +20,9 @@ class DirectoryReport:
     num_files: int = 0
     filetypes: T.DefaultDict[str, int] = field(
         default_factory=lambda: defaultdict(int))
+    # size and age histograms of the files (see lurge_types/histograms.py) -
+    # the drill-down trees don't have them
+    histograms: T.Optional[Histograms] = None
 
     wrstat_time: int = int(datetime.datetime.now().timestamp())
 
@@ -25,6 +31,26 @@ class DirectoryReport:
         return max(0, round((self.wrstat_time - self.mtime) / 86400, 1))
 
 
+def _merge_directories(into: T.Dict[str, DirectoryReport],
+                       other: T.Dict[str, DirectoryReport]) -> None:
+    for subdir, subdir_report in other.items():
+        if subdir not in into:
+            into[subdir] = subdir_report
+        else:
+            into[subdir].size += subdir_report.size
+            into[subdir].num_files += subdir_report.num_files
+            into[subdir].mtime = max(
+                into[subdir].mtime, subdir_report.mtime)
+
+            for key, value in subdir_report.filetypes.items():
+                into[subdir].filetypes[key] += value
+
+            if into[subdir].histograms is None:
+                into[subdir].histograms = subdir_report.histograms
+            elif subdir_report.histograms is not None:
+                into[subdir].histograms += subdir_report.histograms
+
+
 @dataclass
 class GroupReport:
     volume: int
@@ -38,6 +64,15 @@ class GroupReport:
     quota: T.Optional[int] = None
 
     subdirs: T.Dict[str, DirectoryReport] = field(default_factory=lambda: {})
+    # every directory down to DRILLDOWN_DEPTH, by its path relative to the
+    # base directory ("" is the base directory itself), with the totals for
+    # everything under it - only if DRILLDOWN_DEPTH is set
+    tree: T.Dict[str, DirectoryReport] = field(default_factory=lambda: {})
+    # size and age histograms of the files (see lurge_types/histograms.py)
+    histograms: Histograms = field(default_factory=Histograms)
+    # the largest and least recently modified files (see
+    # lurge_types/top_files.py) - only if TOP_FILES is set
+    top_files: TopFiles = field(default_factory=TopFiles)
 
     _wrstat_time: int = int(datetime.datetime.now().timestamp())
 
@@ -45,18 +80,11 @@ class GroupReport:
         """combining GroupReport objects together"""
         self.usage += o.usage
         self.last_modified = max(self.last_modified, o.last_modified)
+        self.histograms += o.histograms
+        self.top_files += o.top_files
 
-        for subdir, subdir_report in o.subdirs.items():
-            if subdir not in self.subdirs:
-                self.subdirs[subdir] = subdir_report
-            else:
-                self.subdirs[subdir].size += subdir_report.size
-                self.subdirs[subdir].num_files += subdir_report.num_files
-                self.subdirs[subdir].mtime = max(
-                    self.subdirs[subdir].mtime, subdir_report.mtime)
-
-                for key, value in subdir_report.filetypes.items():
-                    self.subdirs[subdir].filetypes[key] += value
+        _merge_directories(self.subdirs, o.subdirs)
+        _merge_directories(self.tree, o.tree)
 
         return self
 
@@ -67,6 +95,14 @@ class GroupReport:
     @property
     def warning(self) -> T.Optional[int]:
         """returns the warning level for this group (as defined in the config)"""
+        return self.get_warning(db.history.get_historical_usage())
+
+    def get_warning(self, historical_usage: db.history.History,
+                    now: T.Optional[datetime.datetime] = None) -> T.Optional[int]:
+        """the warning level, given the usage history, as if it were now
+        (i.e. as it would have been at the time, when backfilling)"""
+        now = now or datetime.datetime.today()
+
         def _prediction(
                 history: T.List[T.Tuple[datetime.date, int]], days_from_now: int) -> float:
             points = min(len(history), 2)
@@ -74,15 +110,16 @@ class GroupReport:
                 return self.usage
             else:
                 delta_past_1 = (
-                    datetime.datetime.today() - datetime.datetime.fromtimestamp(self.wrstat_time)).days
-                delta_past_2 = (datetime.datetime.today(
-                ).date() - history[-points][0]).days
+                    now - datetime.datetime.fromtimestamp(self.wrstat_time)).days
+                delta_past_2 = (now.date() - history[-points][0]).days
 
                 prediction: float = self.usage + ((days_from_now + delta_past_1) / (
                     delta_past_2 - delta_past_1)) * (self.usage - history[-points][1])
                 return prediction
 
-        history = historical_usage[(self.group_name, self.base_path)]
+        # history is recorded against the human readable base path
+        history = historical_usage[
+            (self.group_name, get_mdt_symlink(self.base_path or ""))]
 
         prediction = max([DEFAULT_WARNING, *[level for level, criteria in WARNINGS.items() if True in map(
             lambda x: _prediction(history, x[0]) / self.quota > x[1] if self.quota is not None and self.quota > 0 else 0, criteria)]])
@@ -98,6 +135,8 @@ class GroupReport:
         self._wrstat_time = time
         for subdir_report in self.subdirs.values():
             subdir_report.wrstat_time = time
+        for tree_report in self.tree.values():
+            tree_report.wrstat_time = time
 
     col_headers = [
         "Top Level Path",
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import typing as T
+
+import numpy as np
+
+# Fixed histograms of file size, and of how long ago files were last
+# accessed (atime) and modified (mtime), built in the same pass as
+# everything else. For each bucket we keep the number of files and their
+# bytes, so both "how many tiny files" and "how much cold data" come
+# straight out of them.
+#
+# The buckets are the lower bound of each one - sizes go up in powers of 4
+# from 4KiB (so the first bucket is everything under 4KiB, and the last is
+# everything over 1TiB), and ages in days go up roughly logarithmically, on
+# boundaries people ask about. Changing them makes old histograms
+# meaningless, so don't, without clearing them out of the DB.
+SIZE_BUCKETS = [0] + [2**(12 + 2 * i) for i in range(15)]
+AGE_BUCKETS = [0, 1, 7, 30, 90, 180, 365, 730, 1095, 1825]
+
+HISTOGRAMS: T.Dict[str, T.List[int]] = {
+    "size": SIZE_BUCKETS,
+    "atime": AGE_BUCKETS,
+    "mtime": AGE_BUCKETS
+}
+
+# Each set of histograms is one int64 array. For each histogram in turn,
+# there's the number of files in each bucket, then their bytes
+_OFFSETS: T.Dict[str, int] = {}
+WIDTH = 0
+for _name, _buckets in HISTOGRAMS.items():
+    _OFFSETS[_name] = WIDTH
+    WIDTH += 2 * len(_buckets)
+
+# how far a file's bytes are from its count, for each histogram
+_BYTES_SHIFT = np.array([[len(buckets)] for buckets in HISTOGRAMS.values()])
+_SIZE_EDGES = np.array(SIZE_BUCKETS, dtype=np.int64)
+_AGE_EDGES = np.array(AGE_BUCKETS, dtype=np.int64) * 86400
+
+
+def slots(sizes: np.ndarray, atimes: np.ndarray, mtimes: np.ndarray,
+          as_of: int) -> np.ndarray:
+    """
+    Where each file goes in the histograms, for a block of them at once.
+    Ages are as of the unix time as_of - anything from after then is 0.
+
+    :returns: an array with a row per histogram (in HISTOGRAMS order), of
+        the place of each file's count in a Histograms array
+    """
+    def _ages(times: np.ndarray) -> np.ndarray:
+        return np.searchsorted(_AGE_EDGES, np.maximum(as_of - times, 0), side="right") - 1
+
+    return np.stack([
+        np.searchsorted(_SIZE_EDGES, np.maximum(sizes, 0), side="right") - 1 + _OFFSETS["size"],
+        _ages(atimes) + _OFFSETS["atime"],
+        _ages(mtimes) + _OFFSETS["mtime"]
+    ])
+
+
+def accumulate(into: np.ndarray, file_slots: np.ndarray, sizes: np.ndarray,
+               rows: T.Optional[np.ndarray] = None) -> None:
+    """
+    Adds files (from slots) and their sizes into histograms - either a
+    single Histograms array, or a matrix of them with one per row, in which
+    case rows is which row each file goes in.
+    """
+    counts = file_slots.ravel()
+    byte_slots = (file_slots + _BYTES_SHIFT).ravel()
+    weights = np.tile(sizes, len(HISTOGRAMS))
+
+    if rows is None:
+        np.add.at(into, counts, 1)
+        np.add.at(into, byte_slots, weights)
+    else:
+        into_rows = np.tile(rows, len(HISTOGRAMS))
+        np.add.at(into, (into_rows, counts), 1)
+        np.add.at(into, (into_rows, byte_slots), weights)
+
+
+class Histograms:
+    """the size and age histograms for one set of files"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, values: T.Optional[np.ndarray] = None) -> None:
+        self.values: np.ndarray = np.zeros(WIDTH, dtype=np.int64) \
+            if values is None else values.astype(np.int64)
+
+    @classmethod
+    def of(cls, file_slots: np.ndarray, sizes: np.ndarray,
+           lines: T.Optional[T.List[int]] = None) -> Histograms:
+        """the histograms for some of the files from slots (or all of them)"""
+        histograms = cls()
+        if lines is None:
+            accumulate(histograms.values, file_slots, sizes)
+        else:
+            accumulate(histograms.values, file_slots[:, lines], sizes[lines])
+        return histograms
+
+    def __iadd__(self, o: Histograms) -> Histograms:
+        self.values += o.values
+        return self
+
+    def __eq__(self, o: object) -> bool:
+        return isinstance(o, Histograms) and bool(np.array_equal(self.values, o.values))
+
+    def files(self, name: str) -> T.List[int]:
+        """the number of files in each bucket of a histogram"""
+        start = _OFFSETS[name]
+        return self.values[start:start + len(HISTOGRAMS[name])].tolist()
+
+    def bytes(self, name: str) -> T.List[int]:
+        """the bytes in each bucket of a histogram"""
+        start = _OFFSETS[name] + len(HISTOGRAMS[name])
+        return self.values[start:start + len(HISTOGRAMS[name])].tolist()
+
+    def rows(self) -> T.List[T.Tuple[str, int, int, int]]:
+        """(histogram, bucket, files, bytes) for every bucket with anything in it"""
+        return [
+            (name, bucket, files, size)
+            for name in HISTOGRAMS
+            for bucket, (files, size) in enumerate(zip(self.files(name), self.bytes(name)))
+            if files > 0
+        ]
+
+    def __repr__(self) -> str:
+        return f"Histograms({', '.join(f'{name}={self.files(name)}' for name in HISTOGRAMS)})"
@@ -14,11 +14,22 @@ class GroupSplit:
         self.group_name: T.Optional[str] = None
         self.volume: T.Optional[int] = None
 
+    @property
+    def path(self) -> str:
+        return f"{REPORT_DIR}groups/{datetime.datetime.now().strftime('%Y%m%d')}/{self.group_name}.{self.volume}.dat.gz"
+
     def flush_lines(self):
-        with gzip.open(f"{REPORT_DIR}groups/{datetime.datetime.now().strftime('%Y%m%d')}/{self.group_name}.{self.volume}.dat.gz", "at") as f:
+        with gzip.open(self.path, "at") as f:
             f.writelines(self.lines)
         self.lines = []
 
+    def add_compressed(self, data: bytes):
+        """adds lines that have already been gzipped (i.e. by a pool
+        process) - one gzip file tacked on the end of another is still a
+        valid gzip file"""
+        with open(self.path, "ab") as f:
+            f.write(data)
+
     def add_lines(self, line: str):
         self.lines.append(line)
         if len(self.lines) > MAX_LINES_PER_GROUP_PER_VOLUME:
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import heapq
+import typing as T
+from dataclasses import dataclass, field
+
+from directory_config import TOP_FILES
+
+# (size, path, mtime) for the largest, and (-mtime, path, size) for the
+# oldest - so in both, the one at the top of the heap is the first to go
+_Entry = T.Tuple[int, str, int]
+
+
+@dataclass(frozen=True)
+class TopFile:
+    path: str
+    size: int
+    mtime: int
+
+
+def _push(heap: T.List[_Entry], entry: _Entry, limit: int) -> None:
+    if len(heap) < limit:
+        heapq.heappush(heap, entry)
+    elif entry > heap[0]:
+        heapq.heapreplace(heap, entry)
+
+
+@dataclass
+class TopFiles:
+    """
+    The `limit` largest and least recently modified files we've seen, as
+    bounded heaps - so adding a file is O(log limit), and most files
+    aren't any bigger (or older) than the smallest we've got, so they're
+    just one comparison.
+
+    Ties are broken on the path, so whichever order the files come in (and
+    however they're split up and merged back together), we end up with
+    the same ones.
+    """
+    limit: int = TOP_FILES or 0
+
+    largest: T.List[_Entry] = field(default_factory=lambda: [])
+    oldest: T.List[_Entry] = field(default_factory=lambda: [])
+
+    def add(self, path: str, size: int, mtime: int) -> None:
+        if len(self.largest) < self.limit or size >= self.largest[0][0]:
+            _push(self.largest, (size, path, mtime), self.limit)
+        if len(self.oldest) < self.limit or -mtime >= self.oldest[0][0]:
+            _push(self.oldest, (-mtime, path, size), self.limit)
+
+    def __iadd__(self, o: TopFiles) -> TopFiles:
+        for entry in o.largest:
+            _push(self.largest, entry, self.limit)
+        for entry in o.oldest:
+            _push(self.oldest, entry, self.limit)
+        return self
+
+    def largest_files(self) -> T.List[TopFile]:
+        """the largest files, biggest first"""
+        return [TopFile(path, size, mtime)
+                for size, path, mtime in sorted(self.largest, reverse=True)]
+
+    def oldest_files(self) -> T.List[TopFile]:
+        """the least recently modified files, oldest first"""
+        return [TopFile(path, size, -mtime)
+                for mtime, path, size in sorted(self.oldest, reverse=True)]
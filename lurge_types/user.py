@@ -2,6 +2,8 @@ import datetime
 import typing as T
 from collections import defaultdict
 
+from lurge_types.histograms import Histograms
+
 
 def _datetime_constructor():
     return datetime.date(1970, 1, 1)
@@ -12,12 +14,25 @@ class UserReport:
         self.size: T.DefaultDict[str, int] = defaultdict(int)
         self._mtime: T.DefaultDict[str,
                                    datetime.date] = defaultdict(_datetime_constructor)
+        # size and age histograms of the files (see lurge_types/histograms.py)
+        self.histograms: T.DefaultDict[str, Histograms] = defaultdict(Histograms)
 
     def mtime(self, t, grp):
         new_date = datetime.datetime.fromtimestamp(t).date()
         if new_date > self._mtime[grp]:
             self._mtime[grp] = new_date
 
+    def __iadd__(self, o: "UserReport") -> "UserReport":
+        """combining UserReport objects together"""
+        for grp, size in o.size.items():
+            self.size[grp] += size
+        for grp, date in o._mtime.items():
+            if date > self._mtime[grp]:
+                self._mtime[grp] = date
+        for grp, histograms in o.histograms.items():
+            self.histograms[grp] += histograms
+        return self
+
     def __str__(self) -> str:
         return str({
             "size": self.size,
@@ -3,7 +3,6 @@ import typing as T
 
 import utils
 import utils.ldap
-from utils.symlink import get_mdt_symlink
 
 
 class VaultPuppet:
@@ -36,8 +35,6 @@ class VaultPuppet:
         except KeyError:
             self.group = None
 
-        self.full_path = get_mdt_symlink(self.full_path)
-
     @property
     def size(self) -> str:
         if self._size is not None:
@@ -27,6 +27,12 @@ def main(modes: T.Set[str]) -> None:
         import user_reporter
         user_reporter.main()
 
+    if "duplicates" in modes:
+        # Run the duplicate reporter - defaults to all volumes
+        logger.info("Running duplicate reporter")
+        import duplicate_reporter
+        duplicate_reporter.main()
+
     if "splitter" in modes:
         # Run the group splitter module - defaults to upload to S3
         logger.info("Running group splitter")
@@ -37,9 +43,9 @@ def main(modes: T.Set[str]) -> None:
 if __name__ == "__main__":
     if len(sys.argv) == 1:
         sys.exit(
-            "Running modes must be provided, inspector, reporter, puppeteer, users, splitter")
+            "Running modes must be provided, inspector, reporter, puppeteer, users, duplicates, splitter")
     for arg in sys.argv[1:]:
-        if arg not in ["puppeteer", "users", "splitter"]:
+        if arg not in ["puppeteer", "users", "duplicates", "splitter"]:
             sys.exit(
-                "Available running modes are puppeteer, users, splitter")
+                "Available running modes are puppeteer, users, duplicates, splitter")
     main(set(sys.argv[1:]))
@@ -1,33 +1,55 @@
 import base64
 import datetime
-import gzip
 import logging
-import multiprocessing
+import os
 import sys
 import typing as T
-from itertools import repeat
+from array import array
+from multiprocessing import shared_memory
+
+import numpy as np
 
 import db.common
+import db.ledger
+import db.metrics
 import db.puppeteer
 import db_config as config
+import utils.checkpoint
+import utils.export
 import utils.finder
 import utils.ldap
-from directory_config import LOGGING_CONFIG, VOLUMES, WRSTAT_DIR
+import utils.pipeline
+from directory_config import LOGGING_CONFIG, METRICS_TO_DB, VOLUMES, WRSTAT_DIR
 from lurge_types.vault import VaultPuppet
+from utils.checkpoint import Checkpoint
+from utils.metrics import Metrics
+from utils.pipeline import SharedMemoryPipeline
+from utils.symlink import get_mdt_symlink
+from utils.vault_index import SWEEP_FILTER, VaultIndex, files_under, vault_location
+from utils.wrstat import (GID, INODE, MTIME, PATH, SIZE, TYPE, UID,
+                          WrstatBlock, decode_path)
 
 # If Vault has Enter Sandman references in, I'm putting Master of Puppets references here,
 # because its the only other Metallica song I know
 
 
 def get_vaults_from_wrstat(
-        volume: int, logger: logging.Logger) -> T.Tuple[int, T.Dict[str, VaultPuppet]]:
+        volume: int, logger: logging.Logger, fresh: bool = False,
+        pipeline: T.Optional[SharedMemoryPipeline] = None,
+        sweep: bool = False) -> T.Tuple[int, T.Dict[str, VaultPuppet], Metrics]:
     """Reads a wrstat file, and returns information about the files in there that
     are getting tracked by Vault
 
     :param volume: - Which volume we're going to be looking for a wrstat report for
     :param logger: - A logging.Logger object to log to
+    :param fresh: - Ignore (and remove) any checkpoint from a previous run
+    :param pipeline: - The SharedMemoryPipeline to read the file with (see
+        utils/pipeline.py). If there isn't one, we'll make our own
+    :param sweep: - Look at everything with .vault in its path, rather than
+        just the .vault directories we found last time (see utils/vault_index.py)
 
-    :returns: volume (int), master_of_puppets (dict[inode (str), file_info (VaultPuppet)])
+    :returns: volume (int), master_of_puppets (dict[inode (str), file_info (VaultPuppet)]),
+        and the Metrics for this volume
 
     example:
         123,  {
@@ -46,108 +68,254 @@ def get_vaults_from_wrstat(
         }
 
     """
-    report_path = utils.finder.find_report(
-        f"scratch{volume}", WRSTAT_DIR, logger)
-    master_of_puppets: T.Dict[str, VaultPuppet] = {}
+    metrics = Metrics("puppeteer", f"Volume {volume}")
 
-    # 1st Run to Get Vaults
-    with gzip.open(report_path, "rt") as wrstat:
-        lines_read: int = 0
-        for line in wrstat:
+    with metrics.stage("find_report"):
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger)
 
-            # Logging
-            lines_read += 1
-            if lines_read % 5000000 == 0:
-                logger.debug(
-                    f"Read {lines_read} lines from {report_path} - Run 1")
+    wr_date_str = report_path.split("/")[-1].split("_")[0]
+    wr_date = datetime.date(int(wr_date_str[:4]), int(
+        wr_date_str[4:6]), int(wr_date_str[6:8]))
+    index = VaultIndex(volume, wr_date, sweep)
+    if index.sweep:
+        logger.info(f"sweeping {report_path} for .vault directories")
 
-            # Decode the Path, Split it and See If We Care
-            wr_line_info = line.split()
+    checkpoint = Checkpoint("puppeteer", volume, report_path)
+    if fresh:
+        checkpoint.clear()
+    master_of_puppets = find_vault_puppets(
+        report_path, logger, metrics, checkpoint, pipeline, index)
+    index.save()
+
+    with metrics.stage("ldap"):
+        ldap_conn = utils.ldap.get_ldap_connection()
+        _, group_info = utils.ldap.get_groups_ldap_info(ldap_conn)
+        for puppet in master_of_puppets.values():
+            puppet.pull_your_strings(ldap_conn, group_info)
+
+    logger.info(f"Done reading wrstat twice for {volume}")
+    return volume, master_of_puppets, metrics
+
+
+def _find_vaults(data: bytes) -> T.Tuple[array, T.List[str], T.List[str], T.Set[str], T.List[str]]:
+    """what the pool processes do with each batch of lines in the 1st run -
+    finds the files in .vault directories, and the .vault directories
+    themselves. We only get the lines that could be either (see
+    utils/vault_index.py), so the paths of anything else never get decoded.
+
+    :returns: columns of inode, vault state and (human readable) path for
+        each file, the (MDT) .vault directories, and any warnings to log
+    """
+    inodes = array("Q")
+    states: T.List[str] = []
+    full_paths: T.List[str] = []
+    locations: T.Set[str] = set()
+    warnings: T.List[str] = []
+
+    block = WrstatBlock(data)
+    for encoded_path, file_type in zip(block.column(PATH), block.column(TYPE)):
+        # Decode the Path, Split it and See If We Care
+        try:
+            filepath = decode_path(encoded_path)
+        except BaseException:
+            warnings.append(f"couldn't decode filepath {encoded_path.decode()}")
+            continue
 
+        location = vault_location(filepath)
+        if location is not None:
+            locations.add(location)
+
+        path_elems = filepath.split("/")
+        # we need a file in a .vault directory, and a `-` in the last
+        # part of the filename, so we know its a full file
+        if file_type == b"f" and location is not None:
+            vault_loc = path_elems.index(".vault")
             try:
-                filepath = base64.b64decode(
-                    wr_line_info[0]).decode("UTF-8", "replace")
+                rel_path = base64.b64decode(
+                    "".join(path_elems[vault_loc:]).split("-")[1]).decode("UTF-8", "replace").replace("_", "/")
             except BaseException:
-                logger.warning(f"couldn't decode filepath {wr_line_info[0]}")
+                warnings.append(
+                    f"couldn't decode original file path for vault key {filepath}")
+                continue
+
+            # Grab the inode
+            encoded_inode = "".join(
+                path_elems[vault_loc + 2:]).split("-")[0]
+            try:
+                inode = int(encoded_inode, 16)
+            except ValueError:
+                warnings.append(
+                    f"couldn't decode inode from base16 {encoded_inode}")
                 continue
 
-            path_elems = filepath.split("/")
-            # we need a file in a .vault directory, and a `-` in the last
-            # part of the filename, so we know its a full file
-            if ".vault" in path_elems and wr_line_info[7] == "f":
-                vault_loc = path_elems.index(".vault")
-                try:
-                    rel_path = base64.b64decode(
-                        "".join(path_elems[vault_loc:]).split("-")[1]).decode("UTF-8", "replace").replace("_", "/")
-                except BaseException:
-                    logger.warning(
-                        f"couldn't decode original file path for vault key {filepath}")
-                    continue
-
-                full_path = "/".join(path_elems[:vault_loc]) + "/" + rel_path
-
-                # Grab the inode
-                encoded_inode = "".join(
-                    path_elems[vault_loc + 2:]).split("-")[0]
-                try:
-                    inode = int(encoded_inode, 16)
-                except ValueError:
-                    logger.warning(
-                        f"couldn't decode inode from base16 {encoded_inode}")
-                    continue
-
-                master_of_puppets[inode] = VaultPuppet(
-                    full_path=full_path,
-                    state=path_elems[vault_loc + 1],
-                    inode=inode)
+            inodes.append(inode)
+            states.append(path_elems[vault_loc + 1])
+            # the human readable path, rather than the MDT one
+            full_paths.append(get_mdt_symlink(
+                "/".join(path_elems[:vault_loc]) + "/" + rel_path))
+
+    return inodes, states, full_paths, locations, warnings
+
+
+# the inodes we're looking for in the 2nd run, by the name of the shared
+# memory they came in - only read once per pool process
+_vault_inodes: T.Dict[str, np.ndarray] = {}
+
+
+def _find_inodes(data: bytes, inodes_name: str,
+                 inode_count: int) -> T.Tuple[np.ndarray, ...]:
+    """what the pool processes do with each batch of lines in the 2nd run -
+    finds the lines for the inodes the vaults are tracking. That's only
+    numbers, so it's done on whole columns at once (see utils/wrstat.py)
+
+    :returns: columns of inode, size, owner, group and mtime
+    """
+    if inodes_name not in _vault_inodes:
+        shm = shared_memory.SharedMemory(name=inodes_name)
+        try:
+            _vault_inodes[inodes_name] = np.frombuffer(
+                bytes(shm.buf[:8 * inode_count]), dtype=np.uint64)
+        finally:
+            shm.close()
+
+    block = WrstatBlock(data)
+    tracked = np.isin(block.ints(INODE, np.uint64), _vault_inodes[inodes_name])
+
+    return (block.ints(INODE, np.uint64)[tracked],
+            block.ints(SIZE)[tracked],
+            block.ints(UID)[tracked],
+            block.ints(GID)[tracked],
+            block.ints(MTIME)[tracked])
+
+
+def find_vault_puppets(report_path: str, logger: logging.Logger, metrics: Metrics,
+                       checkpoint: T.Optional[Checkpoint] = None,
+                       pipeline: T.Optional[SharedMemoryPipeline] = None,
+                       index: T.Optional[VaultIndex] = None) -> T.Dict[str, VaultPuppet]:
+    """The part of get_vaults_from_wrstat that goes over the wrstat file
+    (twice) - first finding the vaults, then the files they're tracking.
+    The VaultPuppets haven't had their strings pulled yet.
+
+    Both runs go through a SharedMemoryPipeline (see utils/pipeline.py) -
+    if we're not given one, we'll make our own.
+
+    If we're given a VaultIndex, the 1st run only reads the files under the
+    .vault directories it knows about (unless it's time to sweep), and
+    the .vault directories we find are put in it. If there are any new
+    ones, we go back for their files before the 2nd run.
+
+    If we're given a Checkpoint, every so often we save which run we're on,
+    how far through it we are and the puppets we've got so far, and if
+    there's a checkpoint from before, we start from there instead."""
+    if pipeline is None:
+        with utils.pipeline.local_pipeline() as pipeline:
+            return find_vault_puppets(report_path, logger, metrics, checkpoint, pipeline, index)
+
+    master_of_puppets: T.Dict[str, VaultPuppet] = {}
+    locations = index.found if index is not None else set()
+    # the .vault directories we're going back for, once we know them
+    catch_up: T.Optional[T.List[str]] = None
+    run, offset, lines_read, seq = 1, 0, 0, 0
+
+    manifest = checkpoint.load_manifest() if checkpoint is not None else None
+    if checkpoint is not None and manifest is not None:
+        logger.info(
+            f"resuming run {manifest['run']} of {report_path} from line {manifest['lines']}")
+        run, offset, lines_read, seq = \
+            manifest["run"], manifest["offset"], manifest["lines"], manifest["seq"]
+        locations.update(manifest.get("locations", []))
+        catch_up = manifest.get("catch_up")
+        master_of_puppets = checkpoint.load(f"puppets.{seq}")
+
+    def save_checkpoint(run: int, offset: int, lines_read: int) -> None:
+        nonlocal seq
+        if checkpoint is None:
+            return
+        seq += 1
+        checkpoint.save(f"puppets.{seq}", master_of_puppets)
+        checkpoint.save_manifest(
+            run=run, offset=offset, lines=lines_read, seq=seq,
+            locations=sorted(locations), catch_up=catch_up)
+        checkpoint.prune([f"puppets.{seq}"])
+
+    checkpoint_due = checkpoint.due if checkpoint is not None else None
+
+    # 1st Run to Get Vaults
+    def add_vaults(found: T.Tuple[array, T.List[str], T.List[str], T.Set[str], T.List[str]]) -> None:
+        inodes, states, full_paths, found_locations, warnings = found
+        for warning in warnings:
+            logger.warning(warning)
+        locations.update(found_locations)
+        for inode, state, full_path in zip(inodes, states, full_paths):
+            master_of_puppets[inode] = VaultPuppet(
+                full_path=full_path,
+                state=state,
+                inode=inode)
+
+    if run == 1 and catch_up is None:
+        offset, lines_read = pipeline.run(
+            report_path, _find_vaults, (), add_vaults, metrics, "vault_scan",
+            offset, lines_read, checkpoint_due,
+            lambda offset, lines_read: save_checkpoint(1, offset, lines_read),
+            index.line_filter() if index is not None else SWEEP_FILTER)
+        logger.debug(f"Read {lines_read} lines from {report_path} - Run 1")
+
+        # we skipped the files in any .vault directories we didn't know
+        # about, so we'll have to go back for them
+        catch_up = index.new_locations() if index is not None else []
+        offset, lines_read = 0, 0
+        save_checkpoint(run, offset, lines_read)
+
+    if run == 1 and catch_up:
+        logger.info(f"found {len(catch_up)} new .vault directories in {report_path}")
+        _, lines_read = pipeline.run(
+            report_path, _find_vaults, (), add_vaults, metrics, "vault_catch_up",
+            offset, lines_read, checkpoint_due,
+            lambda offset, lines_read: save_checkpoint(1, offset, lines_read),
+            files_under(catch_up))
+        logger.debug(f"Read {lines_read} lines from {report_path} - Run 1 (new vaults)")
+
+    if run == 1:
+        # we've found all the vaults, so if we die from here on we'll only
+        # need to do the 2nd run
+        run, offset, lines_read = 2, 0, 0
+        save_checkpoint(run, offset, lines_read)
 
     # 2nd. Run to Get File Information
-    with gzip.open(report_path, "rt") as wrstat:
-        lines_read = 0
-        for line in wrstat:
-            # Logging
-            lines_read += 1
-            if lines_read % 5000000 == 0:
-                logger.debug(
-                    f"Read {lines_read} lines from {report_path} - Run 2")
-
-            # Decode the Path, Split it and See If We Care
-            wr_line_info = line.split()
-
-            if int(wr_line_info[8]) in master_of_puppets:
-                """
-                wrstat lines
-                Index   Item
-                0       Filepath (base 64 encoded)
-                1       Size (bytes)
-                2       Owner (ID)
-                3       Group (Group ID)
-                ...
-                5       Last Modified Time (Unix)
-                ...
-                8       Inode ID
-                ...
-                """
-                puppet = master_of_puppets[int(wr_line_info[8])]
-                puppet.just_call_my_name(
-                    size=int(wr_line_info[1]),
-                    owner_id=int(wr_line_info[2]),
-                    mtime=int(wr_line_info[5]),
-                    group_id=int(wr_line_info[3])
-                )
-
-    ldap_conn = utils.ldap.get_ldap_connection()
-    _, group_info = utils.ldap.get_groups_ldap_info(ldap_conn)
-    for puppet in master_of_puppets.values():
-        puppet.pull_your_strings(ldap_conn, group_info)
+    def add_file_info(found: T.Tuple[np.ndarray, ...]) -> None:
+        for inode, size, owner_id, group_id, mtime in zip(*(column.tolist() for column in found)):
+            master_of_puppets[inode].just_call_my_name(
+                size=size,
+                owner_id=owner_id,
+                mtime=mtime,
+                group_id=group_id
+            )
 
-    logger.info(f"Done reading wrstat twice for {volume}")
-    return volume, master_of_puppets
+    # the pool processes get the inodes we're looking for through shared
+    # memory, rather than with every batch
+    inodes = array("Q", master_of_puppets.keys())
+    inodes_shm = shared_memory.SharedMemory(
+        create=True, size=max(len(inodes) * inodes.itemsize, 1))
+    try:
+        inodes_shm.buf[:len(inodes) * inodes.itemsize] = inodes.tobytes()
+        _, lines_read = pipeline.run(
+            report_path, _find_inodes, (inodes_shm.name, len(inodes)), add_file_info,
+            metrics, "inode_scan", offset, lines_read, checkpoint_due,
+            lambda offset, lines_read: save_checkpoint(2, offset, lines_read))
+        logger.debug(f"Read {lines_read} lines from {report_path} - Run 2")
+    finally:
+        inodes_shm.close()
+        inodes_shm.unlink()
 
+    return master_of_puppets
 
-def main(volumes: T.List[int] = VOLUMES) -> None:
+
+def main(volumes: T.List[int] = VOLUMES, fresh: bool = False,
+         processes: T.Optional[int] = None, sweep: bool = False) -> None:
     logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
     logger = logging.getLogger(__name__)
+    metrics = Metrics("puppeteer")
 
     # Creating SQL Connection
     db_conn = db.common.get_sql_connection(config)
@@ -164,24 +332,56 @@ def main(volumes: T.List[int] = VOLUMES) -> None:
         wr_date = datetime.date(int(wr_date_str[:4]), int(
             wr_date_str[4:6]), int(wr_date_str[6:8]))
 
-        if not db.common.check_date(db_conn, "vault", wr_date, volume, logger):
+        with metrics.stage("check_date"):
+            needs_loading = db.ledger.begin_run(
+                db_conn, "puppeteer", volume, wr_date, latest_wr,
+                int(os.stat(latest_wr).st_mtime), logger)
+
+        if needs_loading:
             volumes_to_check.append(volume)
             wrstat_dates[volume] = wr_date
 
-    with multiprocessing.Pool(processes=max(len(volumes), 1)) as pool:
-        vault_reports: T.List[T.Tuple[int, T.Dict[str, VaultPuppet]]] = pool.starmap(
-            get_vaults_from_wrstat, zip(volumes_to_check, repeat(logger)))
+    # every volume is read at once, sharing a pool of processes
+    with metrics.stage("wait_for_volumes"):
+        results: T.List[T.Tuple[int, T.Dict[str, VaultPuppet], Metrics]] = utils.pipeline.run_volumes(
+            lambda volume, pipeline: get_vaults_from_wrstat(
+                volume, logger, fresh, pipeline, sweep),
+            volumes_to_check, processes)
+
+    vault_reports: T.List[T.Tuple[int, T.Dict[str, VaultPuppet]]] = []
+    for volume, puppets, volume_metrics in results:
+        vault_reports.append((volume, puppets))
+        metrics.merge(volume_metrics)
+
+    # Export to Parquet, for the query service (see utils/query.py)
+    with metrics.stage("export"):
+        utils.export.export_vault_reports(vault_reports, wrstat_dates, logger)
 
     # Write to MySQL database
-    db.puppeteer.write_to_db(db_conn, vault_reports, wrstat_dates, logger)
+    with metrics.stage("db_load"), db.common.statement_metrics(metrics):
+        db.puppeteer.write_to_db(
+            db_conn, vault_reports, wrstat_dates, logger, metrics)
+
+    # everything's in, so we won't need to resume any of this
+    for volume in volumes_to_check:
+        utils.checkpoint.clear("puppeteer", volume)
+
+    logger.info(f"run metrics written to {metrics.write_summary()}")
+    if METRICS_TO_DB:
+        db.metrics.write_run_metrics(db_conn, metrics, logger)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        main()
+    # --fresh ignores any checkpoints from a previous run, and --sweep
+    # looks everywhere for vaults, not just where they were last time
+    fresh = "--fresh" in sys.argv
+    sweep = "--sweep" in sys.argv
+    args = [x for x in sys.argv[1:] if x not in ("--fresh", "--sweep")]
+    if len(args) == 0:
+        main(fresh=fresh, sweep=sweep)
     else:
         try:
-            volumes = [int(x) for x in sys.argv[1:]]
-            main(volumes)
+            volumes = [int(x) for x in args]
+            main(volumes, fresh, sweep=sweep)
         except ValueError:
             sys.exit("Arguments provided must be integers for volumes to search")
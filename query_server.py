@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import logging
+import logging.config
+import threading
+import typing as T
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from directory_config import LOGGING_CONFIG, QUERY_PORT, QUERY_RELOAD_INTERVAL
+from utils.query import QueryService
+
+# A read-only HTTP endpoint over the latest exports (see utils/query.py).
+# Everything's a GET, and comes back as a JSON list of rows:
+#     /groups?group=&pi=&volume=&prefix=
+#     /directories?group=&pi=&volume=&prefix=
+#     /top_files?group=&pi=&volume=&kind=&prefix=    kind is largest or oldest
+#     /users?user=&group=&volume=
+#     /vaults?user=&group=&volume=&prefix=
+#     /status                                 what's loaded, and when
+# Every parameter is optional, and they're combined with AND. prefix is
+# matched against the start of the (human readable) path.
+
+logger = logging.getLogger("query_server")
+
+# endpoint: (QueryService method, parameters it takes)
+ENDPOINTS: T.Dict[str, T.Tuple[str, T.Tuple[str, ...]]] = {
+    "/groups": ("groups", ("group", "pi", "volume", "prefix")),
+    "/directories": ("directories", ("group", "pi", "volume", "prefix")),
+    "/top_files": ("top_files", ("group", "pi", "volume", "kind", "prefix")),
+    "/users": ("users", ("user", "group", "volume")),
+    "/vaults": ("vaults", ("user", "group", "volume", "prefix"))
+}
+
+
+def _json_default(value: T.Any) -> T.Any:
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f"can't serialise {type(value)}")
+
+
+def make_handler(service: QueryService) -> T.Type[BaseHTTPRequestHandler]:
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: T.Any) -> None:
+            data = json.dumps(body, default=_json_default).encode("UTF-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            url = urllib.parse.urlparse(self.path)
+            if url.path == "/status":
+                self._send(200, service.snapshot.status)
+                return
+
+            if url.path not in ENDPOINTS:
+                self._send(404, {"error": f"no such endpoint {url.path}"})
+                return
+
+            method, allowed = ENDPOINTS[url.path]
+            params = {key: values[-1]
+                      for key, values in urllib.parse.parse_qs(url.query).items()}
+            unknown = set(params) - set(allowed)
+            if len(unknown) > 0:
+                self._send(400, {"error": f"unknown parameters {sorted(unknown)}"})
+                return
+
+            if "volume" in params:
+                try:
+                    params["volume"] = int(params["volume"].replace("scratch", ""))  # type: ignore
+                except ValueError:
+                    self._send(400, {"error": f"bad volume {params['volume']}"})
+                    return
+
+            self._send(200, getattr(service, method)(**params))
+
+        def log_message(self, format: str, *args: T.Any) -> None:
+            logger.debug(format % args)
+
+    return QueryHandler
+
+
+def main(port: int = QUERY_PORT, host: str = "127.0.0.1") -> None:
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+
+    logger.info("loading the latest exports")
+    service = QueryService()
+    logger.info(f"loaded {service.snapshot.status}")
+
+    # picks up new runs in the background
+    threading.Thread(target=service.watch, args=(QUERY_RELOAD_INTERVAL,),
+                     daemon=True).start()
+
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logger.info(f"serving on {host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=QUERY_PORT)
+    parser.add_argument('--host', default="127.0.0.1")
+    args = parser.parse_args()
+
+    main(args.port, args.host)
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import datetime
+import re
+import time
+import typing as T
+
+import numpy as np
+
+import lurge_types.histograms
+import utils.hardlinks
+import utils.wrstat as wrstat
+from directory_config import DRILLDOWN_DEPTH, FILETYPES, TOP_FILES
+from lurge_types.group_report import DirectoryReport, GroupReport
+from lurge_types.histograms import Histograms
+from utils.filters import LineFilter
+from utils.metrics import Metrics
+from utils.wrstat import WrstatBlock
+
+# The group reporting logic that doesn't care how the wrstat lines got to
+# us - it's used by the workers in group_reporter.py, but also anywhere
+# else we want to aggregate wrstat lines into GroupReports
+
+Reports = T.MutableMapping[T.Tuple[int, str], GroupReport]
+
+_FILETYPES = {filetype: re.compile(regex) for filetype, regex in FILETYPES.items()}
+
+
+def _add_to_tree(tree: T.Dict[str, DirectoryReport], parents: T.List[str],
+                 size: int, mtime: int, filetypes: T.List[str]) -> None:
+    """adds a file to the totals of the base directory, and each directory
+    (relative to it) it's in, down to DRILLDOWN_DEPTH"""
+    for depth in range(min(len(parents), T.cast(int, DRILLDOWN_DEPTH)) + 1):
+        directory = "/".join(parents[:depth])
+        if directory not in tree:
+            tree[directory] = DirectoryReport(mtime=mtime)
+
+        tree[directory].size += size
+        tree[directory].num_files += 1
+        if mtime > tree[directory].mtime:
+            tree[directory].mtime = mtime
+        for filetype in filetypes:
+            tree[directory].filetypes[filetype] += size
+
+
+def line_filter(base_directory_info: T.Set[T.Tuple[str, str]]) -> LineFilter:
+    """the lines process_block might want - ones with the group of a base
+    directory, under one of them. Anything else is ignored anyway, so
+    these can be dropped before they get to it (see utils/filters.py)"""
+    return LineFilter(
+        gids=frozenset(int(gid) for gid, _ in base_directory_info),
+        path_prefixes=tuple(sorted({path for _, path in base_directory_info})))
+
+
+def process_lines(lines: T.Collection[str], base_directory_info: T.Set[T.Tuple[str, str]],
+                  volume: int, new_reports: Reports, metrics: Metrics,
+                  hardlink_owners: T.Optional[np.ndarray] = None,
+                  as_of: T.Optional[int] = None) -> None:
+    """process_block, for wrstat lines that have already been decoded"""
+    process_block(WrstatBlock.from_lines(lines), base_directory_info,
+                  volume, new_reports, metrics, hardlink_owners, as_of)
+
+
+def process_block(block: WrstatBlock, base_directory_info: T.Set[T.Tuple[str, str]],
+                  volume: int, new_reports: Reports, metrics: Metrics,
+                  hardlink_owners: T.Optional[np.ndarray] = None,
+                  as_of: T.Optional[int] = None) -> None:
+    """
+    Adds a block of wrstat lines into the GroupReports in `new_reports`,
+    keyed by (gid, base_path). Lines that aren't under one of the group's
+    base directories are ignored.
+
+    Each link to a file counts for size // nlink of it, unless we're given
+    hardlink_owners, in which case only the link that owns each inode
+    counts, for all of it (see utils/hardlinks.py).
+
+    The files also go into the size and age histograms of their
+    GroupReport and subdirectory (see lurge_types/histograms.py), with ages
+    as of the unix time as_of - which is now, if we're not told - and, if
+    TOP_FILES is set, its largest and oldest files (see
+    lurge_types/top_files.py).
+
+    The layout of the lines is in utils/wrstat.py
+    """
+    _process_start = (time.perf_counter(), time.process_time())
+
+    # the numbers all get converted in one go, and the group ids are left
+    # as bytes to compare against the base directories
+    sizes = block.ints(wrstat.SIZE)
+    if hardlink_owners is None:
+        counted = [True] * len(block)
+        share_column = sizes // np.maximum(block.ints(wrstat.NLINK), 1)
+    else:
+        counted_lines = utils.hardlinks.counted(block, hardlink_owners)
+        counted = counted_lines.tolist()
+        share_column = np.where(counted_lines, sizes, 0)
+    shares = share_column.tolist()
+    file_sizes = sizes.tolist() if TOP_FILES else []
+    mtimes = block.ints(wrstat.MTIME).tolist()
+    gids = block.column(wrstat.GID)
+    types = block.column(wrstat.TYPE)
+    base_directories = [(grp_dir[0].encode(), grp_dir[1])
+                        for grp_dir in base_directory_info]
+    now = as_of if as_of is not None else int(datetime.datetime.now().timestamp())
+
+    # where each line goes in the histograms - they're added up for every
+    # subdirectory in one go at the end, rather than a line at a time, so
+    # we just keep track of which lines go in which (gid, base_path, subdir)
+    histogram_slots = lurge_types.histograms.slots(
+        sizes, block.ints(wrstat.ATIME), block.ints(wrstat.MTIME), now)
+    histogram_subdirs: T.Dict[T.Tuple[int, str, str], int] = {}
+    histogram_lines: T.List[int] = []
+    histogram_rows: T.List[int] = []
+
+    # decode the base64 encoded file paths (None for any we can't)
+    paths: T.List[T.Optional[str]] = []
+    for i in range(len(block)):
+        try:
+            paths.append(block.path(i))
+        except BaseException:
+            paths.append(None)
+
+    # find the appropriate base directory for each line - in a pass of its
+    # own, so it can be timed as a whole, rather than a line at a time
+    _match_start = time.perf_counter()
+    line_base_paths: T.List[T.Optional[str]] = [None] * len(block)
+    for i, path in enumerate(paths):
+        if path is None:
+            continue
+        for grp_dir in base_directories:
+            if grp_dir[0] == gids[i] and path.startswith(
+                    grp_dir[1]):
+                line_base_paths[i] = grp_dir[1]
+                break
+    _match_time = time.perf_counter() - _match_start
+
+    for i in range(len(block)):
+        base_path = line_base_paths[i]
+        if base_path is None:
+            continue
+        path = T.cast(str, paths[i])
+        gid = int(gids[i])
+
+        if (gid, base_path) not in new_reports:
+            new_reports[(gid, base_path)] = GroupReport(
+                volume=volume
+            )
+
+        # Update Size
+        new_reports[(gid, base_path)
+                    ].usage += shares[i]
+
+        # Update Last Modified Time
+        # this is either the time already in the record,
+        # the time from the wrstat (if its newer), but
+        # not if its in the future, then we set it to now
+        new_reports[(gid, base_path)].last_modified = max(
+            new_reports[(gid, base_path)].last_modified,
+            min(mtimes[i], now)
+        )
+
+        # find the subdirectory for this line
+        _subdir_split = path.replace(base_path, "").split("/")[1:3]
+        if len(_subdir_split) == 0:
+            continue
+        elif len(_subdir_split) == 1:
+            if types[i] == b"d":
+                subdir = _subdir_split[0]
+            else:
+                subdir = "."
+        else:
+            # if it's a users or projects directory, we'll go one
+            # level deeper
+            if _subdir_split[0] in ["users", "projects"]:
+                subdir = f"{_subdir_split[0]}/{_subdir_split[1]}"
+            else:
+                subdir = _subdir_split[0]
+
+        # we'll add all the info we can, i.e. size, (this is based
+        # on whether it is a directory or a file)
+        # (the links to a file that don't count, don't count as files
+        # either)
+        if types[i] == b"f" and counted[i]:
+            mtime = mtimes[i]
+            size = shares[i]
+
+            if subdir not in new_reports[(gid, base_path)].subdirs:
+                new_reports[(gid, base_path)].subdirs[subdir] = DirectoryReport(
+                    mtime=mtime
+                )
+
+            # Update Values
+            new_reports[(gid, base_path)].subdirs[subdir].size += size
+            new_reports[(gid, base_path)
+                        ].subdirs[subdir].num_files += 1
+
+            if mtime > new_reports[(gid, base_path)
+                                   ].subdirs[subdir].mtime:
+                new_reports[(gid, base_path)
+                            ].subdirs[subdir].mtime = mtime
+
+            # Filetype Sizes
+            filetypes = [filetype for filetype, regex in _FILETYPES.items()
+                         if regex.search(path)]
+            for filetype in filetypes:
+                new_reports[(
+                    gid, base_path)].subdirs[subdir].filetypes[filetype] += size
+
+            # and it might be one of the largest or oldest
+            if TOP_FILES:
+                new_reports[(gid, base_path)].top_files.add(
+                    path, file_sizes[i], mtime)
+
+            histogram_lines.append(i)
+            histogram_rows.append(histogram_subdirs.setdefault(
+                (gid, base_path, subdir), len(histogram_subdirs)))
+
+            # and every directory above it, as far down as we go
+            if DRILLDOWN_DEPTH is not None:
+                _add_to_tree(new_reports[(gid, base_path)].tree,
+                             path[len(base_path) + 1:].split("/")[:-1],
+                             size, mtime, filetypes)
+
+    # they go in as reports of their own, merged into the ones we've got -
+    # which might have been spilled to disk since we saw them
+    subdir_histograms = np.zeros(
+        (len(histogram_subdirs), lurge_types.histograms.WIDTH), dtype=np.int64)
+    lurge_types.histograms.accumulate(
+        subdir_histograms, histogram_slots[:, histogram_lines],
+        share_column[histogram_lines], np.array(histogram_rows, dtype=np.int64))
+
+    histogram_reports: T.Dict[T.Tuple[int, str], GroupReport] = {}
+    for (gid, base_path, subdir), row in histogram_subdirs.items():
+        if (gid, base_path) not in histogram_reports:
+            histogram_reports[(gid, base_path)] = GroupReport(volume=volume)
+        histograms = Histograms(subdir_histograms[row])
+        histogram_reports[(gid, base_path)].histograms += histograms
+        histogram_reports[(gid, base_path)].subdirs[subdir] = DirectoryReport(
+            mtime=0, histograms=histograms)
+
+    for key, histograms_report in histogram_reports.items():
+        if key in new_reports:
+            new_reports[key] += histograms_report
+        else:
+            new_reports[key] = histograms_report
+
+    metrics.add("process_block",
+                wall=time.perf_counter() - _process_start[0],
+                cpu=time.process_time() - _process_start[1],
+                lines=len(block))
+    metrics.add("basedir_match", wall=_match_time,
+                lines=len(block))
@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import abc
+import typing as T
+
+from lurge_types.group_report import GroupReport
+from utils.metrics import Metrics
+
+
+class Backend(abc.ABC):
+    """
+    How the group reporter gets every volume's wrstat file aggregated into
+    GroupReports - i.e. spread over MPI ranks (reporter/mpi.py), or a pool
+    of processes on one machine (reporter/pool.py). Whatever the backend,
+    the lines are aggregated by reporter.aggregate.process_lines, and the
+    reports are finished off by reporter.volume.finish_reports, so they
+    all give the same answer.
+    """
+
+    def __init__(self, start_days_ago: int = 0, fresh: bool = False) -> None:
+        """
+        :param start_days_ago: - how far back to start looking for wrstat files
+        :param fresh: - ignore (and remove) any checkpoints from a previous run
+        """
+        self.start_days_ago = start_days_ago
+        self.fresh = fresh
+
+    @abc.abstractmethod
+    def aggregate(self, names: T.Tuple[T.Dict[int, str], T.Dict[int, str]],
+                  metrics: Metrics) -> T.List[T.List[GroupReport]]:
+        """
+        :param names: - (group_id: pi name, group_id: group_name)
+        :param metrics: - the main process' Metrics, which every other
+            process' are merged into
+
+        :returns: the finished GroupReports, a list per volume (empty if
+            the DB already has that volume's latest data)
+        """
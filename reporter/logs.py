@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import logging
+import os
+import typing as T
+
+# Setting Up Logging
+# When developing, DEBUG level logging should be fine (in production, INFO level
+# should be used). However, by setting the environment variable LURGE_SUPER_DEBUG_LOG
+# to "1", you can enable even more debugging information, however this is very
+# overwheling, as it informs you when the workers request work (which is a lot)
+# DEBUG level logging is enabled in the INSTANCE environment variable (set in
+# cron.sh) == "dev"
+SUPER_DEBUG_LOG_LEVEL = 5
+logging.addLevelName(SUPER_DEBUG_LOG_LEVEL, "SUPER-DEBUG")
+
+LOG_LEVEL = SUPER_DEBUG_LOG_LEVEL if os.getenv("LURGE_SUPER_DEBUG_LOG") \
+    else logging.DEBUG if os.getenv("INSTANCE") == "dev" \
+    else logging.INFO
+
+logger = logging.getLogger("group_reporter")
+logger.setLevel(LOG_LEVEL)
+
+_log_handler = logging.StreamHandler()
+_log_handler.setLevel(LOG_LEVEL)
+
+_log_formatter = logging.Formatter(
+    "%(asctime)s|%(levelname)s|%(rank)s|%(purpose)s|%(message)s")
+_log_handler.setFormatter(_log_formatter)
+
+logger.addHandler(_log_handler)
+# the rank is filled in by the MPI backend (see reporter/mpi.py)
+logger = logging.LoggerAdapter(logger, {"rank": "", "purpose": ""})
+
+
+class LurgeLogger(logging.LoggerAdapter):
+    """
+    Each LogRecord will have come from a particular MPI process. Its rank
+    will be displayed in the log (see the LoggerAdapter), however, we want to
+    additionally add the purpose of that process, which we define when we
+    create a LurgeLogger object (this extends LoggerAdapter) by adding properties
+
+    We also define the `super_debug` method (see description of super debug above)
+    """
+
+    def process(self,
+                msg: T.Any,
+                kwargs: T.MutableMapping[str, T.Any]
+                ) -> tuple[T.Any, T.MutableMapping[str, T.Any]]:
+        logger.extra.update(self.extra)  # type: ignore
+        return super().process(msg, kwargs)
+
+    def super_debug(self, msg: str):
+        self.log(SUPER_DEBUG_LOG_LEVEL, msg)
+
@@ -0,0 +1,527 @@
+from __future__ import annotations
+
+import gzip
+import operator
+import os
+import time
+import typing as T
+from pathlib import Path
+
+from mpi4py import MPI
+import numpy as np
+import setproctitle
+
+import reporter.aggregate
+import reporter.volume
+import utils.finder
+import utils.hardlinks
+import utils.wrstat
+from directory_config import EXACT_HARDLINKS, VOLUMES, WRSTAT_DIR
+from lurge_types.group_report import GroupReport
+from reporter.backend import Backend
+from reporter.logs import LurgeLogger, logger
+from utils.checkpoint import Checkpoint
+from utils.metrics import Metrics
+from utils.spill import SpillingAggregator
+from utils.wrstat import WrstatBlock
+
+# The group reporter's MPI backend - run it with mpirun (see cron.sh)
+
+# Setting Up MPI
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+logger.extra["rank"] = f"Rank {rank}"  # type: ignore
+
+# specify how many workers will be requesting data from wrstat to process
+# PER VOLUME. If this is changed, so should the number of CPUs requested on
+# the compute farm - see cron.sh
+WORKERS_PER_VOLUME = 6
+
+# when workers are done, they send their reports back to the controller
+# in batches of this many, rather than all in one go
+REPORT_BATCH_SIZE = 1000
+
+
+def _split_volumes() -> T.Any:
+    """a communicator for each volume's controller and its workers (with
+    the controller as its rank 0), for sending them all the same thing at
+    once. Every rank has to call this - rank 0 just gets MPI.COMM_NULL"""
+    if rank == 0:
+        color = MPI.UNDEFINED
+    elif rank <= len(VOLUMES):
+        color = rank
+    else:
+        color = ((rank - len(VOLUMES) - 1) // WORKERS_PER_VOLUME) + 1
+    return comm.Split(color, 0 if rank <= len(VOLUMES) else rank)
+
+
+def _broadcast_owners(volume_comm: T.Any,
+                      owners: T.Optional[np.ndarray] = None) -> np.ndarray:
+    """sends the hardlink owners (see utils/hardlinks.py) from a controller
+    to all its workers at once, as a buffer rather than pickled. The
+    controller and every one of its workers call this together"""
+    count = volume_comm.bcast(len(owners) if owners is not None else None, root=0)
+    if owners is None:
+        owners = np.empty(count, dtype=np.uint64)
+    else:
+        owners = np.ascontiguousarray(owners, dtype=np.uint64)
+    volume_comm.Bcast(owners, root=0)
+    return owners
+
+
+class MPIBackend(Backend):
+    """
+    MPI Ranks
+    Rank 0: Process to spin up volume controller processes,
+    and eventually write everything to the database. This is the one
+    that calls `aggregate`.
+
+    Rank <= num of volumes: each of these will act as a
+    controller for the workers for each volume
+
+    Other rank: these will work as a worker, each associated
+    to a volume controller rank
+
+    Every rank other than 0 should call `serve` instead.
+    """
+
+    def aggregate(self, names: T.Tuple[T.Dict[int, str], T.Dict[int, str]],
+                  metrics: Metrics) -> T.List[T.List[GroupReport]]:
+        # (we're not in any of them, but every rank has to be there)
+        _split_volumes()
+
+        logger.info("Sending Info to Volume Controllers")
+        for idx, vol in enumerate(VOLUMES):
+            # send information to all the volume controllers
+            logger.debug(f"Sending to rank {idx+1} (volume {vol})")
+            comm.send({
+                "volume": vol,
+                "group_pi_names": names
+            }, dest=idx + 1)
+
+        logger.info("waiting on info from volume controllers")
+        all_reports: T.List[T.List[GroupReport]] = []
+        for idx, vol in enumerate(VOLUMES):
+            # wait for information back from these controllers
+            all_reports.append(comm.recv(source=idx + 1))
+            metrics.merge(comm.recv(source=idx + 1))
+            logger.debug(f"got info back from rank {idx + 1} (volume {vol})")
+
+        return all_reports
+
+    def serve(self) -> None:
+        """what every rank other than 0 does"""
+        volume_comm = _split_volumes()
+        if rank <= len(VOLUMES):
+            # main process for each volume
+            data = comm.recv(source=0)
+            reading_wrstat_controller(
+                data["volume"],
+                data["group_pi_names"],
+                start_days_ago=self.start_days_ago,
+                fresh=self.fresh,
+                volume_comm=volume_comm)
+
+        else:
+            # any of the worker processes
+            data = comm.recv()
+            wrstat_reader_worker(data["base_directories"], data["volume"], volume_comm)
+
+
+def wrstat_reader_worker(
+        base_directory_info: T.Set[T.Tuple[str, str]], volume: int,
+        volume_comm: T.Any = None):
+    """
+    These workers will each be associated to a controller for a particular
+    volume (we calculate the rank of what that controller will be).
+
+    When we're ready for work, we send a message to the controller with our
+    rank number. It'll send us back a block of up to 250 lines of wrstat to
+    process (as bytes) - only ones under a base directory, as the rest would
+    be ignored anyway
+
+    If we get a CHECKPOINT message, we save everything we've aggregated so
+    far to the path it gives us (see utils/checkpoint.py)
+
+    Before any data, we get a FILE message, with the wrstat file's time
+    (which file ages are worked out from, see lurge_types/histograms.py).
+    If we're counting hardlinks exactly (see utils/hardlinks.py), we then
+    get LINKS messages, with the hardlinked files' lines to hash, and then
+    an OWNERS message - when every worker has one, we all send what we
+    found to the controller, and get the links that count back from it
+    (through volume_comm, which is just this volume's ranks)
+
+    When we get a DONE message, we send all our reports back to the controller,
+    in batches of REPORT_BATCH_SIZE, followed by a DONE message of our own
+    (with our Metrics in it).
+    If we've been given a memory limit, our reports may have been spilled
+    to disk in the meantime (see utils/spill.py)
+
+    The lines themselves are processed by reporter.aggregate.process_block
+    """
+
+    setproctitle.setproctitle(f"Lurge - Volume {volume} Worker (Rank {rank})")
+    _logger = LurgeLogger(
+        logger, {
+            "purpose": f"Volume {volume} Worker"})  # type: ignore
+
+    new_reports: SpillingAggregator[T.Tuple[int, str], GroupReport] = \
+        SpillingAggregator(operator.iadd)
+    metrics = Metrics("group_reporter", f"Rank {rank} (Volume {volume} Worker)")
+    hardlink_owners: T.Optional[np.ndarray] = None
+    links = utils.hardlinks.HardlinkOwners()
+    as_of: T.Optional[int] = None
+
+    controller_rank: int = (
+        (rank - len(VOLUMES) - 1) // WORKERS_PER_VOLUME) + 1
+    _logger.debug(
+        f"I'm Rank {rank} for Volume {volume} - my controller is rank {controller_rank}")
+
+    while True:
+        _logger.super_debug("requesting work")
+        with metrics.stage("wait_for_work"):
+            comm.send(rank, dest=controller_rank)
+            data = comm.recv(source=controller_rank)
+
+        if data["msg"] == "DATA":
+            # we've received some lines of wrstat file
+            reporter.aggregate.process_block(
+                WrstatBlock(data["data"]), base_directory_info, volume, new_reports,
+                metrics, hardlink_owners, as_of)
+            new_reports.maybe_spill()
+
+        elif data["msg"] == "FILE":
+            as_of = data["as_of"]
+
+        elif data["msg"] == "LINKS":
+            with metrics.stage("hardlink_scan"):
+                links.add(utils.hardlinks.find_links(data["data"]))
+
+        elif data["msg"] == "OWNERS":
+            with metrics.stage("hardlink_owners"):
+                volume_comm.gather(links.links(), root=0)
+                links = utils.hardlinks.HardlinkOwners()
+                hardlink_owners = _broadcast_owners(volume_comm)
+
+        elif data["msg"] == "CHECKPOINT":
+            # everything we've aggregated so far, so the controller can
+            # resume from here if need be
+            _logger.debug(f"checkpointing to {data['path']}")
+            with metrics.stage("checkpoint"):
+                new_reports.save(data["path"])
+
+        elif data["msg"] == "DONE":
+            _logger.debug("Done - sending back data")
+            batch: T.Dict[T.Tuple[int, str], GroupReport] = {}
+            for key, report in new_reports.items():
+                batch[key] = report
+                if len(batch) == REPORT_BATCH_SIZE:
+                    comm.send({"msg": "REPORTS", "data": batch},
+                              dest=controller_rank)
+                    batch = {}
+
+            comm.send({"msg": "REPORTS", "data": batch}, dest=controller_rank)
+            comm.send({"msg": "DONE", "metrics": metrics},
+                      dest=controller_rank)
+            return
+
+
+def reading_wrstat_controller(
+    volume: int,
+    names: T.Tuple[T.Dict[int, str], T.Dict[int, str]],
+    start_days_ago: int = 0,
+    fresh: bool = False,
+    volume_comm: T.Any = None
+) -> None:
+    """
+    controls all the workers for a particular volume (rank <= num of volumes)
+
+    Params:
+        - volume: int - the volume to analyse
+        - names: Tuple[Dict[int, str], Dict[int, str]] -
+            (group_id: pi name, group_id: group_name)
+        - start_days_ago: int - how far back to start looking for a wrstat file
+        - fresh: bool - ignore (and remove) any checkpoint from a previous run
+        - volume_comm - a communicator for just us and our workers (see
+            _split_volumes)
+
+    Generates [GroupReport]
+    Example: [
+        GroupReport{
+            volume: 123,
+            group_name: "group_name",
+            pi_name: "pi_name",
+            base_path: "/lustre/scratch119/humgen/projects/project_a",
+            usage: 12345,
+            quota: 100000,
+            subdirs: {
+                "subdir_a": DirectoryReport{
+                    num_files: 3000,
+                    filetypes: {
+                        "BAM": 1200,
+                        "CRAM": 500
+                    },
+                }
+            }
+
+        }
+    ]
+
+    Once the reports are sent back to rank 0, we also send it our Metrics,
+    which include those from all our workers.
+
+    """
+
+    setproctitle.setproctitle(f"Lurge - Volume {volume} Controller")
+    _logger = LurgeLogger(
+        logger, {
+            "purpose": f"Volume {volume} Controller"})  # type: ignore
+    metrics = Metrics("group_reporter", f"Rank {rank} (Volume {volume} Controller)")
+
+    # range of the ranks of workers associated to this controller
+    workers = range(len(VOLUMES) + 1 + (WORKERS_PER_VOLUME *
+                    (rank - 1)), len(VOLUMES) + 1 + (WORKERS_PER_VOLUME * rank))
+
+    logger.debug(f"reading base directory info for volume {volume}")
+    try:
+        with metrics.stage("read_base_directories"):
+            base_directory_info = utils.finder.read_base_directories(
+                Path(WRSTAT_DIR))
+    except FileNotFoundError as err:
+        _logger.exception(err)
+        
+        # we won't be able to continue, so let's tidy up
+        for worker in workers:
+            comm.send({
+                "base_directories": set(),
+                "volume": volume
+            }, dest=worker)
+            comm.send({"msg": "DONE"}, dest=worker)
+        comm.send([], dest=0)
+        comm.send(metrics, dest=0)
+        raise err
+
+    # send important information to the workers
+    for worker in workers:
+        _logger.info(f"sending information to rank {worker}")
+        comm.send({
+            "base_directories": base_directory_info,
+            "volume": volume
+        }, dest=worker)
+
+    # Find the wrstat report, and check if the DB already has data for it.
+    # If it does, we'll tell the workers we're done (just so they don't
+    # hang waiting to do something), and send an empty array back to the
+    # rank 0 process, just so it's not waiting for us to produce some data
+    found = reporter.volume.find_wrstat(volume, start_days_ago, _logger, metrics)
+    if found is None:
+        comm.send([], dest=0)
+        comm.send(metrics, dest=0)
+        for worker in workers:
+            comm.send({"msg": "DONE"}, dest=worker)
+        return
+    report_path, wrstat_date = found
+
+    # If a previous run got part way through this wrstat file before it
+    # died, we'll pick up from its last checkpoint, and skip the lines it
+    # covered (see utils/checkpoint.py)
+    checkpoint = Checkpoint("group_reporter", volume, report_path)
+
+    # (gid, base_path)
+    reports: SpillingAggregator[T.Tuple[int, str], GroupReport] = \
+        SpillingAggregator(operator.iadd)
+
+    manifest = reporter.volume.resume(checkpoint, reports, fresh, _logger)
+    offset = 0
+    lines_read = 0
+    checkpoint_seq = 0
+    resumed_files: T.List[str] = []
+    already_read = manifest is not None and manifest.get("complete", False)
+    if manifest is not None:
+        offset = manifest["offset"]
+        lines_read = manifest["lines"]
+        checkpoint_seq = manifest["seq"]
+        resumed_files = manifest["files"]
+    resumed_lines = lines_read
+
+    # A checkpoint has to be consistent with the offset we save, so when one
+    # is due, each worker is asked to save its reports the next time it asks
+    # for work (so it's finished everything we sent it before then), and
+    # isn't sent anything new until it has. Once every worker has, we write
+    # the manifest, and get rid of the previous checkpoint's files
+    to_checkpoint: T.Set[int] = set()
+    writing: T.Set[int] = set()
+    round_offset, round_lines = 0, 0
+    _wait_time = 0.0
+
+    # every worker gets the time of the file the first time it asks for work
+    told: T.Set[int] = set()
+
+    def next_worker() -> int:
+        """waits for a worker (that knows which file it's on) to ask for
+        work"""
+        while True:
+            worker: int = comm.recv()
+            if worker in told:
+                return worker
+            told.add(worker)
+            comm.send({"msg": "FILE", "as_of": wrstat_date}, dest=worker)
+
+    # if we're counting hardlinks exactly, we find their owners before we
+    # send anything else out. They only depend on the file, so if we're
+    # resuming, they're just worked out again. The workers hash the links
+    # (which is most of the work), and once they're all done we put
+    # together what each of them found, and broadcast the owners to all of
+    # them at once
+    if EXACT_HARDLINKS and not already_read:
+        _logger.info(f"finding hardlinks in {report_path}")
+        owners = utils.hardlinks.HardlinkOwners()
+        with metrics.stage("hardlink_scan") as scan:
+            for block in utils.wrstat.read_blocks(report_path):
+                linked = utils.hardlinks.linked_lines(block)
+                for start in range(0, len(linked), 250):
+                    comm.send({
+                        "msg": "LINKS",
+                        "data": b"\n".join(linked[start:start + 250]) + b"\n"
+                    }, dest=next_worker())
+                scan.lines += len(block)
+
+            # each worker only gets one of these, as it doesn't ask for
+            # anything else until we've all broadcast the owners
+            for _ in workers:
+                comm.send({"msg": "OWNERS"}, dest=next_worker())
+            for links in volume_comm.gather(None, root=0)[1:]:
+                owners.add(links)
+            _broadcast_owners(volume_comm, owners.owners())
+
+    def _worker_files(seq: int) -> T.List[str]:
+        return [f"worker{worker}.{seq}" for worker in workers]
+
+    def send_block(block: bytes) -> None:
+        """waits for a worker to ask for work, and sends it block - unless
+        it owes us a checkpoint first"""
+        nonlocal _wait_time
+        while True:
+            _wait_start = time.perf_counter()
+            worker = next_worker()
+            _wait_time += time.perf_counter() - _wait_start
+
+            if worker in to_checkpoint:
+                to_checkpoint.remove(worker)
+                writing.add(worker)
+                comm.send({
+                    "msg": "CHECKPOINT",
+                    "path": checkpoint.path(f"worker{worker}.{checkpoint_seq}")
+                }, dest=worker)
+                continue
+
+            if worker in writing:
+                # it's asking for more, so it's done writing its checkpoint
+                writing.remove(worker)
+                if len(to_checkpoint) == 0 and len(writing) == 0:
+                    files = resumed_files + _worker_files(checkpoint_seq)
+                    checkpoint.save_manifest(
+                        offset=round_offset, lines=round_lines,
+                        seq=checkpoint_seq, files=files)
+                    checkpoint.prune(files)
+                    _logger.info(
+                        f"checkpoint {checkpoint_seq} saved at line {round_lines}")
+
+            _logger.super_debug(
+                f"Rank {worker} requested work - sending it some")
+            comm.send({
+                "msg": "DATA",
+                "data": block
+            }, dest=worker)
+            return
+
+    # Reading over the wrstat report a chunk at a time. Only the lines
+    # under a base directory are any use to the workers, so the rest are
+    # dropped here, without decoding them (see utils/filters.py), and we
+    # send workers blocks of 250 of what's left to process.
+    # This is so the workers aren't constantly asking for work
+    line_filter = reporter.aggregate.line_filter(base_directory_info)
+    _read_start = (time.perf_counter(), time.process_time())
+    if already_read:
+        _logger.info(f"already read all of {report_path} before")
+    else:
+        _logger.info(f"reading wrstat file {report_path}")
+        with gzip.open(report_path, "rb") as wrstat:
+            if offset > 0:
+                wrstat.seek(offset)
+
+            for chunk in utils.wrstat.read_chunks(wrstat):
+                wanted = line_filter.select(WrstatBlock(chunk))
+                for start in range(0, len(wanted), 250):
+                    send_block(b"\n".join(wanted[start:start + 250]) + b"\n")
+
+                previous_lines = lines_read
+                lines_read += chunk.count(b"\n")
+                offset += len(chunk)
+                if lines_read // 5000000 > previous_lines // 5000000:
+                    _logger.debug(f"read {lines_read} from {volume}")
+
+                # everything up to here has been sent out, so this is
+                # where a checkpoint can start
+                if checkpoint.due() and len(to_checkpoint) == 0 and len(writing) == 0:
+                    checkpoint_seq += 1
+                    round_offset, round_lines = offset, lines_read
+                    to_checkpoint.update(workers)
+
+    # time spent waiting on workers to ask for more isn't time spent reading
+    metrics.add("read_wrstat",
+                wall=time.perf_counter() - _read_start[0] - _wait_time,
+                cpu=time.process_time() - _read_start[1],
+                lines=lines_read - resumed_lines,
+                bytes=os.path.getsize(report_path))
+    metrics.add("wait_for_workers", wall=_wait_time)
+
+    # When we've sent the entire wrstat file to workers, we can iterate over every
+    # worker listening to this controller, and send a DONE message.
+    # If we were part way through a checkpoint, that's abandoned - any worker
+    # still writing one will just ask for work again, which we ignore.
+    _logger.info(
+        "we're done reading wrstat file - let's let all the workers know")
+    _collect_start = (time.perf_counter(), time.process_time())
+    for worker in workers:
+        _logger.debug(
+            f"letting rank {worker} know we're done, and waiting for response")
+        comm.send({"msg": "DONE"}, dest=worker)
+
+        # Then we can wait for responses from every worker, hopefully containing
+        # batches of GroupReports, until it tells us it's done.
+        # We ignore anything not of the right form incase a worker sends another
+        # request for work instead.
+        while True:
+            result: T.Union[int, T.Dict[str, T.Any]] = comm.recv(source=worker)
+            if not isinstance(result, dict):
+                continue
+            if result["msg"] == "DONE":
+                metrics.merge(result["metrics"])
+                break
+
+            # As a single report could have been worked on by different, separate,
+            # workers, we combine them when they come in, by totalling the sizes etc.
+            for id, report in result["data"].items():
+                reports.add(id, report)
+            reports.maybe_spill()
+
+    if not already_read:
+        reporter.volume.checkpoint_complete(
+            checkpoint, reports, checkpoint_seq + 1, offset, lines_read)
+
+    metrics.add("collect_reports",
+                wall=time.perf_counter() - _collect_start[0],
+                cpu=time.process_time() - _collect_start[1])
+
+    # Once we've got all the data from the workers collected, we can fill
+    # in some gaps, i.e. group name, and then send the finished reports back
+    # to the rank 0 node
+    _logger.info(
+        f"we've got all our reports back from workers for {volume}, so now we'll just add a bit more info")
+    finished_reports = reporter.volume.finish_reports(
+        reports, volume, names, wrstat_date, metrics)
+
+    _logger.info("done - sending data back to main controller")
+    comm.send(finished_reports, dest=0)
+    comm.send(metrics, dest=0)
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import contextlib
+import operator
+import os
+import typing as T
+from pathlib import Path
+
+import numpy as np
+
+import reporter.aggregate
+import reporter.volume
+import utils.finder
+import utils.hardlinks
+import utils.pipeline
+from directory_config import EXACT_HARDLINKS, VOLUMES, WRSTAT_DIR
+from lurge_types.group_report import GroupReport
+from reporter.backend import Backend
+from reporter.logs import LurgeLogger, logger
+from utils.checkpoint import Checkpoint
+from utils.filters import LineFilter
+from utils.metrics import Metrics
+from utils.spill import SpillingAggregator
+from utils.wrstat import WrstatBlock
+
+# The group reporter's process pool backend - for running on a single
+# machine, without MPI:
+#     python group_reporter.py --backend pool --processes 32
+
+logger.extra["rank"] = f"PID {os.getpid()}"  # type: ignore
+
+# set up in each pool process by _init_worker
+_base_directory_info: T.Set[T.Tuple[str, str]] = set()
+
+
+def _init_worker(base_directory_info: T.Set[T.Tuple[str, str]]) -> None:
+    global _base_directory_info
+    _base_directory_info = base_directory_info
+
+
+def _process_batch(data: bytes, volume: int,
+                   hardlinks: T.Optional[T.Tuple[str, int]] = None,
+                   as_of: T.Optional[int] = None
+                   ) -> T.Tuple[T.Dict[T.Tuple[int, str], GroupReport], Metrics]:
+    """aggregates a batch of lines from the pipeline - the reports we send
+    back are just for this batch. If we're counting hardlinks exactly,
+    hardlinks is where to find their owners (see utils/hardlinks.py), and
+    file ages are worked out as of the unix time as_of"""
+    reports: T.Dict[T.Tuple[int, str], GroupReport] = {}
+    metrics = Metrics("group_reporter", f"PID {os.getpid()} (Pool Worker)")
+    reporter.aggregate.process_block(
+        WrstatBlock(data), _base_directory_info, volume, reports, metrics,
+        utils.hardlinks.attach(*hardlinks) if hardlinks is not None else None,
+        as_of)
+    return reports, metrics
+
+
+class PoolBackend(Backend):
+    """
+    Every volume has a thread in the main process reading its wrstat file
+    through a SharedMemoryPipeline (see utils/pipeline.py), with a pool of
+    processes shared by all the volumes aggregating it, and the partial
+    reports they send back for each batch are merged in as they come.
+
+    It checkpoints the same way as the MPI backend (see utils/checkpoint.py),
+    so either can resume from the other.
+    """
+
+    def __init__(self, start_days_ago: int = 0, fresh: bool = False,
+                 processes: T.Optional[int] = None,
+                 batch_bytes: int = utils.pipeline.BATCH_BYTES) -> None:
+        super().__init__(start_days_ago, fresh)
+        self.processes = processes
+        self.batch_bytes = batch_bytes
+
+    def aggregate(self, names: T.Tuple[T.Dict[int, str], T.Dict[int, str]],
+                  metrics: Metrics) -> T.List[T.List[GroupReport]]:
+        with metrics.stage("read_base_directories"):
+            base_directory_info = utils.finder.read_base_directories(
+                Path(WRSTAT_DIR))
+        # the pool processes only get the lines under a base directory
+        line_filter = reporter.aggregate.line_filter(base_directory_info)
+
+        results = utils.pipeline.run_volumes(
+            lambda volume, pipeline: self._volume(volume, names, pipeline, line_filter),
+            VOLUMES, self.processes, self.batch_bytes,
+            initializer=_init_worker, initargs=(base_directory_info,))
+
+        all_reports: T.List[T.List[GroupReport]] = []
+        for volume_reports, volume_metrics in results:
+            all_reports.append(volume_reports)
+            metrics.merge(volume_metrics)
+
+        return all_reports
+
+    def _volume(self, volume: int, names: T.Tuple[T.Dict[int, str], T.Dict[int, str]],
+                pipeline: utils.pipeline.SharedMemoryPipeline,
+                line_filter: T.Optional[LineFilter] = None) -> T.Tuple[T.List[GroupReport], Metrics]:
+        _logger = LurgeLogger(logger, {"purpose": f"Volume {volume}"})
+        metrics = Metrics("group_reporter", f"Volume {volume} Reader")
+
+        found = reporter.volume.find_wrstat(
+            volume, self.start_days_ago, _logger, metrics)
+        if found is None:
+            return [], metrics
+        report_path, wrstat_date = found
+
+        # (gid, base_path)
+        reports: SpillingAggregator[T.Tuple[int, str], GroupReport] = \
+            SpillingAggregator(operator.iadd)
+
+        checkpoint = Checkpoint("group_reporter", volume, report_path)
+        manifest = reporter.volume.resume(
+            checkpoint, reports, self.fresh, _logger)
+
+        if manifest is None or not manifest.get("complete", False):
+            # the owners only depend on the file, so if we're resuming,
+            # they're just worked out again
+            hardlink_owners = None
+            if EXACT_HARDLINKS:
+                _logger.info(f"finding hardlinks in {report_path}")
+                hardlink_owners = utils.hardlinks.find_owners(
+                    report_path, pipeline, metrics)
+
+            _logger.info(f"reading wrstat file {report_path}")
+            offset, lines, seq = self.aggregate_volume(
+                volume, report_path, pipeline, reports, metrics, checkpoint,
+                offset=manifest["offset"] if manifest else 0,
+                lines=manifest["lines"] if manifest else 0,
+                seq=manifest["seq"] if manifest else 0,
+                hardlink_owners=hardlink_owners, as_of=wrstat_date, line_filter=line_filter)
+
+            reporter.volume.checkpoint_complete(
+                checkpoint, reports, seq + 1, offset, lines)
+
+        _logger.info(f"done reading {volume}, so now we'll just add a bit more info")
+        return reporter.volume.finish_reports(
+            reports, volume, names, wrstat_date, metrics), metrics
+
+    def aggregate_volume(self, volume: int, report_path: str,
+                         pipeline: utils.pipeline.SharedMemoryPipeline,
+                         reports: SpillingAggregator[T.Tuple[int, str], GroupReport],
+                         metrics: Metrics, checkpoint: T.Optional[Checkpoint] = None,
+                         offset: int = 0, lines: int = 0, seq: int = 0,
+                         hardlink_owners: T.Optional[np.ndarray] = None,
+                         as_of: T.Optional[int] = None,
+                         line_filter: T.Optional[LineFilter] = None) -> T.Tuple[int, int, int]:
+        """
+        Aggregates a wrstat file (from offset bytes into the uncompressed
+        data) into reports. If we're given hardlink_owners, only they count
+        for their inodes (see utils/hardlinks.py), and file ages are worked
+        out as of the unix time as_of (now, if it's not given). If we're
+        given a line_filter, only the lines it wants get aggregated (see
+        reporter.aggregate.line_filter).
+
+        :returns: how far through the file we got (in bytes and lines), and
+            the last checkpoint's number
+        """
+        def merge(result: T.Tuple[T.Dict[T.Tuple[int, str], GroupReport], Metrics]) -> None:
+            batch_reports, batch_metrics = result
+            for key, report in batch_reports.items():
+                reports.add(key, report)
+            reports.maybe_spill()
+            metrics.merge(batch_metrics)
+
+        def save_checkpoint(offset: int, lines: int) -> None:
+            nonlocal seq
+            if checkpoint is None:
+                return
+            # the reports include anything we resumed from
+            seq += 1
+            reports.save(checkpoint.path(f"controller.{seq}"))
+            checkpoint.save_manifest(
+                offset=offset, lines=lines, seq=seq,
+                files=[f"controller.{seq}"])
+            checkpoint.prune([f"controller.{seq}"])
+
+        with contextlib.ExitStack() as stack:
+            hardlinks = stack.enter_context(utils.hardlinks.shared(hardlink_owners)) \
+                if hardlink_owners is not None else None
+            offset, lines = pipeline.run(
+                report_path, _process_batch, (volume, hardlinks, as_of), merge, metrics, "read_wrstat",
+                offset, lines,
+                checkpoint_due=checkpoint.due if checkpoint is not None else None,
+                save_checkpoint=save_checkpoint, line_filter=line_filter)
+
+        return offset, lines, seq
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import typing as T
+
+import db.common
+import db.ledger
+import db_config as config
+import utils.finder
+from directory_config import WRSTAT_DIR
+from lurge_types.group_report import GroupReport
+from utils.checkpoint import Checkpoint
+from utils.metrics import Metrics
+from utils.quota import QuotaReader
+from utils.spill import SpillingAggregator
+
+# The steps for each volume that every group reporter backend does the
+# same way, either side of aggregating the wrstat file
+
+Logger = T.Union[logging.Logger, logging.LoggerAdapter[logging.Logger]]
+Reports = SpillingAggregator[T.Tuple[int, str], GroupReport]
+
+
+def find_wrstat(volume: int, start_days_ago: int, logger: Logger,
+                metrics: Metrics) -> T.Optional[T.Tuple[str, int]]:
+    """
+    Finds the wrstat file for a volume, and checks the run ledger for
+    whether the DB already has data for it (see db/ledger.py). If it does,
+    there's no point going over the file, we're not going to get any new
+    data - otherwise, it's marked as loading.
+
+    :returns: the path to the wrstat file and its mtime, or None if the DB
+        already has its data
+    """
+    with metrics.stage("find_report"):
+        report_path = utils.finder.find_report(
+            f"/lustre/scratch{volume}", WRSTAT_DIR, logger, days_ago=start_days_ago)
+        wrstat_date = int(os.stat(report_path).st_mtime)
+
+    with metrics.stage("check_date"), db.common.get_sql_connection(config) as db_conn:
+        needs_loading = db.ledger.begin_run(
+            db_conn,
+            "group_reporter",
+            volume,
+            datetime.date.fromtimestamp(wrstat_date),
+            report_path,
+            wrstat_date,
+            logger)
+
+    return (report_path, wrstat_date) if needs_loading else None
+
+
+def resume(checkpoint: Checkpoint, reports: Reports, fresh: bool,
+           logger: Logger) -> T.Optional[T.Dict[str, T.Any]]:
+    """
+    If a previous run got part way through this wrstat file before it died,
+    everything it had aggregated by its last checkpoint goes straight into
+    reports (see utils/checkpoint.py).
+
+    :returns: the checkpoint's manifest, if there was one. `offset` and
+        `lines` are how far through the file it got, and if `complete` is
+        set, it got all the way
+    """
+    if fresh:
+        checkpoint.clear()
+
+    manifest = checkpoint.load_manifest()
+    if manifest is not None:
+        logger.info(
+            f"resuming from checkpoint {manifest['seq']} at line {manifest['lines']}")
+        for name in manifest["files"]:
+            reports.load(checkpoint.path(name))
+
+    return manifest
+
+
+def checkpoint_complete(checkpoint: Checkpoint, reports: Reports,
+                        seq: int, offset: int, lines: int) -> None:
+    """
+    Checkpoints everything from the whole wrstat file, so if anything goes
+    wrong from here on (i.e. loading into the DB), we won't need to go over
+    it again
+    """
+    if not checkpoint.enabled:
+        return
+
+    reports.save(checkpoint.path(f"controller.{seq}"))
+    checkpoint.save_manifest(
+        offset=offset, lines=lines, seq=seq,
+        files=[f"controller.{seq}"], complete=True)
+    checkpoint.prune([f"controller.{seq}"])
+
+
+def finish_reports(reports: Reports, volume: int,
+                   names: T.Tuple[T.Dict[int, str], T.Dict[int, str]],
+                   wrstat_date: int, metrics: Metrics) -> T.List[GroupReport]:
+    """
+    Once we've got all the data collected, we can fill in some gaps, i.e.
+    group name and quota, and put the finished reports in a list.
+
+    :param names: - (group_id: pi name, group_id: group_name)
+    """
+    pis, groups = names
+
+    with metrics.stage("quota"):
+        quota_reader = QuotaReader(volume)
+
+    finished_reports: T.List[GroupReport] = []
+    for key, report in reports.items():
+        report.pi_name = pis.get(key[0])
+        report.group_name = groups.get(key[0])
+        if report.group_name:
+            with metrics.stage("quota"):
+                report.quota = quota_reader.get_quota(report.group_name)
+        report.wrstat_time = wrstat_date
+        report.base_path = key[1]
+        finished_reports.append(report)
+
+    return finished_reports
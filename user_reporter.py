@@ -1,30 +1,97 @@
+import contextlib
 import datetime
-import gzip
 import logging
-import multiprocessing
+import os
 import sys
 import typing as T
 from collections import defaultdict
-from itertools import repeat
+
+import numpy as np
 
 import db.common
+import db.ledger
+import db.metrics
 import db.user_reporter
 import db_config as config
+import lurge_types.histograms
+import utils.export
 import utils.finder
+import utils.hardlinks
 import utils.ldap
+import utils.pipeline
 import utils.tsv
-from directory_config import LOGGING_CONFIG, VOLUMES, WRSTAT_DIR
+from utils.metrics import Metrics
+from utils.pipeline import SharedMemoryPipeline
+from utils.spill import SpilledRun, SpillingAggregator
+from utils.wrstat import ATIME, GID, MTIME, NLINK, SIZE, TYPE, UID, WrstatBlock
+from directory_config import EXACT_HARDLINKS, LOGGING_CONFIG, METRICS_TO_DB, VOLUMES, WRSTAT_DIR
+from lurge_types.histograms import Histograms
 from lurge_types.user import UserReport
 
 
+def _sum_by_user(data: bytes, as_of: int, hardlinks: T.Optional[T.Tuple[str, int]] = None
+                 ) -> T.Tuple[np.ndarray, ...]:
+    """what the pool processes do with each batch of lines - sums them up
+    by (user, group), and sends them back as columns of user id, group id,
+    total size and latest mtime, rather than as UserReports. The size and
+    age histograms of their files (with ages as of the unix time as_of)
+    come back as a matrix, with a row for each (user, group) - see
+    lurge_types/histograms.py
+
+    This only needs the numbers, so it's all done on whole columns at once
+    (see utils/wrstat.py), without decoding any paths - unless we're
+    counting hardlinks exactly, when hardlinks is where to find the links
+    that count (see utils/hardlinks.py)"""
+    block = WrstatBlock(data)
+    # unsigned, so (uid << 32) doesn't overflow for uids of 2^31 and up
+    # (i.e. nfsnobody's, 4294967294)
+    uids = block.ints(UID, np.uint64)
+    gids = block.ints(GID, np.uint64)
+    sizes = block.ints(SIZE)
+    nlinks = block.ints(NLINK)
+    mtimes = block.ints(MTIME)
+
+    # files with no links don't count towards the size
+    if hardlinks is None:
+        counted = np.ones(len(block), dtype=bool)
+        shares = np.zeros_like(sizes)
+        np.floor_divide(sizes, nlinks, out=shares, where=nlinks != 0)
+    else:
+        counted = utils.hardlinks.counted(block, utils.hardlinks.attach(*hardlinks))
+        shares = np.where(counted & (nlinks != 0), sizes, 0)
+
+    # user and group ids are 32 bits, so (user, group) fits in one uint64
+    users_groups, which = np.unique((uids << 32) | gids, return_inverse=True)
+    totals = np.zeros(len(users_groups), dtype=np.int64)
+    np.add.at(totals, which, shares)
+    latest = np.zeros(len(users_groups), dtype=np.int64)
+    np.maximum.at(latest, which, mtimes)
+
+    files = np.flatnonzero((np.array(block.column(TYPE)) == b"f") & counted)
+    histograms = np.zeros((len(users_groups), lurge_types.histograms.WIDTH), dtype=np.int64)
+    lurge_types.histograms.accumulate(
+        histograms,
+        lurge_types.histograms.slots(
+            sizes[files], block.ints(ATIME)[files], mtimes[files], as_of),
+        shares[files], which[files])
+
+    return users_groups >> 32, users_groups & 0xFFFFFFFF, totals, latest, histograms
+
+
 def get_user_info_from_wrstat(
-        volume: int, logger: logging.Logger) -> T.DefaultDict[str, UserReport]:
+        volume: int, logger: logging.Logger,
+        pipeline: T.Optional[SharedMemoryPipeline] = None
+) -> T.Tuple[T.Mapping[str, UserReport], Metrics]:
     """Reads a wrstat file for a volume, and collates the information by user and group
 
     :param volume: - which volume we're going to look for the wrstat report for
     :param logger: - logging.Logger object to log to
+    :param pipeline: - the SharedMemoryPipeline to read the file with (see
+        utils/pipeline.py). If there isn't one, we'll make our own
 
-    :returns: DefaultDict[user_id (str), UserReport]
+    :returns: a mapping of user_id (str) to UserReport (read back from
+        scratch as it's needed, if we had to spill - see utils/spill.py), and
+        the Metrics for this volume
 
     Example:
     {
@@ -41,42 +108,56 @@ def get_user_info_from_wrstat(
     In a UserReport object, size and mtime are DefaultDict[group id (str), value (int/date)]
 
     """
-    report_path = utils.finder.find_report(
-        f"scratch{volume}", WRSTAT_DIR, logger
-    )
+    if pipeline is None:
+        with utils.pipeline.local_pipeline() as pipeline:
+            return get_user_info_from_wrstat(volume, logger, pipeline)
 
-    user_reports = defaultdict(UserReport)
+    metrics = Metrics("user_reporter", f"Volume {volume}")
 
-    with gzip.open(report_path, "rt") as wrstat:
-        lines_read: int = 0
-        for line in wrstat:
+    with metrics.stage("find_report"):
+        report_path = utils.finder.find_report(
+            f"scratch{volume}", WRSTAT_DIR, logger
+        )
 
-            # Logging
-            lines_read += 1
-            if lines_read % 5000000 == 0:
-                logger.debug(f"Read {lines_read} lines from {volume}")
+    # if we've got a memory limit, partial reports may be spilled to
+    # disk as we go, and merged back together at the end
+    user_reports: SpillingAggregator[str, UserReport] = SpillingAggregator(
+        UserReport.__iadd__, factory=UserReport)
 
-            # Split all the line info
-            wr_line_info = line.split()
+    def merge(totals: T.Tuple[np.ndarray, ...]) -> None:
+        *columns, histograms = totals
+        for i, (user_id, group_id, size, mtime) in enumerate(
+                zip(*(column.tolist() for column in columns))):
+            report = user_reports[str(user_id)]
+            report.size[str(group_id)] += size
+            report.mtime(mtime, str(group_id))
+            report.histograms[str(group_id)] += Histograms(histograms[i])
+        user_reports.maybe_spill()
 
-            user_id = wr_line_info[2]
-            group_id = wr_line_info[3]
+    with contextlib.ExitStack() as stack:
+        hardlinks = None
+        if EXACT_HARDLINKS:
+            hardlinks = stack.enter_context(utils.hardlinks.shared(
+                utils.hardlinks.find_owners(report_path, pipeline, metrics)))
 
-            try:
-                user_reports[user_id].size[group_id] += int(
-                    wr_line_info[1]) // int(wr_line_info[9])
-            except ZeroDivisionError:
-                pass
+        _, lines_read = pipeline.run(
+            report_path, _sum_by_user, (int(os.stat(report_path).st_mtime), hardlinks),
+            merge, metrics, "read_wrstat")
+    logger.debug(f"Read {lines_read} lines from {volume}")
 
-            user_reports[user_id].mtime(int(wr_line_info[5]), group_id)
+    # if we've spilled, the runs are merged as a stream into one more on
+    # scratch, which is only read back as it's needed
+    with metrics.stage("merge_reports"):
+        merged_reports = user_reports.merged()
 
     logger.info(f"Finished processing {volume}")
-    return user_reports
+    return merged_reports, metrics
 
 
-def main(volumes: T.List[int] = VOLUMES) -> None:
+def main(volumes: T.List[int] = VOLUMES, processes: T.Optional[int] = None) -> None:
     logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
     logger = logging.getLogger(__name__)
+    metrics = Metrics("user_reporter")
 
     db_conn = db.common.get_sql_connection(config)
 
@@ -90,53 +171,90 @@ def main(volumes: T.List[int] = VOLUMES) -> None:
         wr_date = datetime.date(int(wr_date_str[:4]), int(
             wr_date_str[4:6]), int(wr_date_str[6:8]))
 
-        if not db.common.check_date(
-                db_conn, "user_usage", wr_date, volume, logger):
+        with metrics.stage("check_date"):
+            needs_loading = db.ledger.begin_run(
+                db_conn, "user_reporter", volume, wr_date, latest_wr,
+                int(os.stat(latest_wr).st_mtime), logger)
+
+        if needs_loading:
             volumes_to_check.append(volume)
             wrstat_dates[volume] = wr_date
 
-    with multiprocessing.Pool(processes=max(len(volumes_to_check), 1)) as pool:
-        user_reports = pool.starmap(get_user_info_from_wrstat, zip(
-            volumes_to_check, repeat(logger)
-        ))
+    # every volume is read at once, sharing a pool of processes
+    with metrics.stage("wait_for_volumes"):
+        results = utils.pipeline.run_volumes(
+            lambda volume, pipeline: get_user_info_from_wrstat(
+                volume, logger, pipeline),
+            volumes_to_check, processes)
+
+    user_reports: T.List[T.Mapping[str, UserReport]] = []
+    for volume_reports, volume_metrics in results:
+        user_reports.append(volume_reports)
+        metrics.merge(volume_metrics)
 
     # Get some information from LDAP
-    ldap_conn = utils.ldap.get_ldap_connection()
-    _, groups = utils.ldap.get_groups_ldap_info(ldap_conn)
+    with metrics.stage("ldap"):
+        ldap_conn = utils.ldap.get_ldap_connection()
+        _, groups = utils.ldap.get_groups_ldap_info(ldap_conn)
 
-    volume_user_reports: T.Dict[int, T.DefaultDict[str, UserReport]] = {}
+    volume_user_reports: T.Dict[int, T.Mapping[str, UserReport]] = {}
     for i, rep in enumerate(volumes_to_check):
         volume_user_reports[rep] = user_reports[i]
 
     # For every user, get their username and the groups they're in
-    unique_uids = set([int(x) for y in user_reports for x in y.keys()])
-    usernames: T.Dict[int, str] = {}
-    user_groups: T.Dict[str, T.Set[T.Tuple[str, str]]] = {}
-    for uid in unique_uids:
-        usernames[uid] = utils.ldap.get_username(ldap_conn, uid)
-        user_groups[str(uid)] = set([(groups[int(key)], key)
+    # (in one pass over each volume's reports, as they may be on scratch)
+    user_groups: T.Dict[str, T.Set[T.Tuple[str, str]]] = defaultdict(set)
+    for vol in user_reports:
+        for user, report in vol.items():
+            user_groups[user].update((groups[int(key)], key)
                                      if int(key) in groups else ("-", key)
-                                     for vol in user_reports
-                                     for (user, report) in vol.items()
-                                     for key in list(report.size.keys())
-                                     if user == str(uid)
-                                     ])
+                                     for key in report.size.keys())
+
+    usernames: T.Dict[int, str] = {}
+    for uid in {int(user) for user in user_groups}:
+        with metrics.stage("ldap"):
+            usernames[uid] = utils.ldap.get_username(ldap_conn, uid)
 
     # Adding data to DB
-    db.user_reporter.load_user_reports_to_db(
-        db_conn, volume_user_reports, usernames, user_groups, wrstat_dates, logger)
+    with metrics.stage("db_load"), db.common.statement_metrics(metrics):
+        db.user_reporter.load_user_reports_to_db(
+            db_conn, volume_user_reports, usernames, user_groups, wrstat_dates, logger, metrics)
+
+    # Exporting exact figures to Parquet
+    with metrics.stage("export"):
+        utils.export.export_user_reports(
+            volume_user_reports, usernames, user_groups, wrstat_dates, logger)
 
     # Creating TSV of data
-    utils.tsv.create_tsv_user_report(
-        volume_user_reports, usernames, user_groups, logger)
+    with metrics.stage("tsv"):
+        utils.tsv.create_tsv_user_report(
+            volume_user_reports, usernames, user_groups, logger)
+
+    for reports in user_reports:
+        if isinstance(reports, SpilledRun):
+            reports.close()
+
+    logger.info(f"run metrics written to {metrics.write_summary()}")
+    if METRICS_TO_DB:
+        db.metrics.write_run_metrics(db_conn, metrics, logger)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        main()
+    # --sample just estimates usage by user, from a sample of the wrstat
+    # files (see utils/sampling.py)
+    def run(volumes: T.List[int] = VOLUMES) -> None:
+        if "--sample" in sys.argv:
+            import utils.sampling
+            utils.sampling.main("user", volumes)
+        else:
+            main(volumes)
+
+    args = [x for x in sys.argv[1:] if x != "--sample"]
+    if len(args) == 0:
+        run()
     else:
         try:
-            volumes = [int(x) for x in sys.argv[1:]]
-            main(volumes)
+            volumes = [int(x) for x in args]
+            run(volumes)
         except ValueError:
             sys.exit("Arguments provided must be integers for volumes to search")
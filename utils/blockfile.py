@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import struct
+import tempfile
+import typing as T
+import zlib
+
+# Block files
+#
+# The drill-down trees (utils/drilldown.py) and the subtree indexes
+# (utils/subtree.py) are both a sorted run of things, laid out as:
+#     MAGIC, block, block, ..., index, trailer, MAGIC
+#
+# Each block is compressed on its own, so a lookup only has to decompress
+# the one or two blocks it needs. The index is compressed JSON - whatever
+# the file wants to say about itself, and a "blocks" list with an entry
+# per block, which is the block's first key (and anything else about it),
+# with where the block is and how long it is as the third and fourth
+# things in it. The trailer says where the index is, and how long.
+#
+# Within a block, the keys are usually front coded (front_code) - sorted
+# paths share most of their prefix, so each one only stores what's
+# different from the one before it.
+
+_TRAILER = struct.Struct("<QQ")
+
+V = T.TypeVar("V")
+
+
+@contextlib.contextmanager
+def atomic_write(path: str) -> T.Iterator[T.BinaryIO]:
+    """opens a temporary file next to path, which replaces path once it's
+    all been written (or is removed if it never is), so anything reading
+    the last one never sees half of it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def front_code(keys: T.Sequence[T.AnyStr]) -> T.List[T.Tuple[int, T.AnyStr]]:
+    """how much of each key it shares with the one before it, and the rest
+    of it"""
+    coded: T.List[T.Tuple[int, T.AnyStr]] = []
+    for i, key in enumerate(keys):
+        shared = len(os.path.commonprefix([keys[i - 1], key])) if i > 0 else 0
+        coded.append((shared, key[shared:]))
+    return coded
+
+
+def front_decode(coded: T.Iterable[T.Tuple[int, T.AnyStr]]) -> T.List[T.AnyStr]:
+    """the keys back from front_code"""
+    keys: T.List[T.AnyStr] = []
+    for shared, suffix in coded:
+        keys.append(keys[-1][:shared] + suffix if keys else suffix)
+    return keys
+
+
+class BlockWriter:
+    """writes the blocks of a block file, then (once they're all written)
+    its index"""
+
+    def __init__(self, f: T.BinaryIO, magic: bytes) -> None:
+        self._file = f
+        self._magic = magic
+        self.finished = False
+        f.write(magic)
+
+    def write(self, data: bytes) -> T.Tuple[int, int]:
+        """compresses and writes a block
+
+        :returns: where it is in the file, and how long it is
+        """
+        block = zlib.compress(data)
+        offset = self._file.tell()
+        self._file.write(block)
+        return offset, len(block)
+
+    def finish(self, index: T.Dict[str, T.Any]) -> None:
+        encoded = zlib.compress(json.dumps(index).encode("UTF-8"))
+        index_offset = self._file.tell()
+        self._file.write(encoded)
+        self._file.write(_TRAILER.pack(index_offset, len(encoded)))
+        self._file.write(self._magic)
+        self.finished = True
+
+
+@contextlib.contextmanager
+def write_block_file(path: str, magic: bytes) -> T.Iterator[BlockWriter]:
+    """a BlockWriter for path (see atomic_write) - the file only replaces
+    path if its index gets written"""
+    with atomic_write(path) as f:
+        writer = BlockWriter(f, magic)
+        yield writer
+        if not writer.finished:
+            raise ValueError(f"never wrote the index for {path}")
+
+
+class BlockFile(T.Generic[V]):
+    """
+    Reads a block file. Only the index is read when it's opened - blocks
+    are read, decompressed and given to `decode` (with their entry in the
+    index) as they're asked for, and the last few are kept around.
+    """
+
+    def __init__(self, path: str, magic: bytes, description: str,
+                 decode: T.Callable[[T.List[T.Any], bytes], V],
+                 cached_blocks: int = 16) -> None:
+        self.path = path
+        self._file = open(path, "rb")
+        self._decode = decode
+        self._cached_blocks = cached_blocks
+        self._cache: T.Dict[int, V] = {}
+
+        try:
+            self._file.seek(-(_TRAILER.size + len(magic)), os.SEEK_END)
+            trailer = self._file.read(_TRAILER.size + len(magic))
+            if trailer[_TRAILER.size:] != magic:
+                raise ValueError(f"{path} isn't a {description}")
+            index_offset, index_length = _TRAILER.unpack(trailer[:_TRAILER.size])
+
+            self._file.seek(index_offset)
+            self.index: T.Dict[str, T.Any] = json.loads(
+                zlib.decompress(self._file.read(index_length)))
+        except BaseException:
+            self._file.close()
+            raise
+
+        self.blocks: T.List[T.List[T.Any]] = self.index["blocks"]
+
+    def __enter__(self) -> BlockFile[V]:
+        return self
+
+    def __exit__(self, *_: T.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def block(self, i: int) -> V:
+        if i not in self._cache:
+            if len(self._cache) >= self._cached_blocks:
+                del self._cache[next(iter(self._cache))]
+
+            offset, length = self.blocks[i][2:4]
+            self._file.seek(offset)
+            self._cache[i] = self._decode(
+                self.blocks[i], zlib.decompress(self._file.read(length)))
+
+        return self._cache[i]
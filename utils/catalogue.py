@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import re
+import typing as T
+from dataclasses import asdict, dataclass
+
+from directory_config import CATALOGUE_CACHE
+
+# {date}_scratch{volume}.{hash}.{hash}.stats.gz
+_WRSTAT_NAME = re.compile(r"^(\d{8})_scratch(\d+)\..+\..+\.stats\.gz$")
+
+_catalogues: T.Dict[str, WrstatCatalogue] = {}
+
+
+@dataclass(frozen=True)
+class CatalogueEntry:
+    path: str
+    size: int
+    mtime: float
+    # wrstat files only - base directory files don't have either
+    date: T.Optional[str] = None
+    volume: T.Optional[int] = None
+
+    @property
+    def record_date(self) -> datetime.date:
+        return datetime.datetime.strptime(T.cast(str, self.date), "%Y%m%d").date()
+
+
+class WrstatCatalogue:
+    """
+    An index of everything in the wrstat output directory we care about -
+    the `*.stats.gz` files (by date and volume) and the `*.basedirs` files.
+
+    The directory is listed once, rather than globbing it for every day and
+    volume and stat-ing every match, which is a lot of metadata operations
+    against a busy MDT. The index is also saved to CATALOGUE_CACHE along with
+    the directory's mtime, and as that changes whenever a file is added,
+    removed or renamed in it, other processes (i.e. every MPI rank, or the
+    next reporter) can use the saved index without listing the directory.
+    """
+
+    def __init__(self, wrstat_dir: str, cache_path: T.Optional[str] = CATALOGUE_CACHE) -> None:
+        self.wrstat_dir = wrstat_dir
+        self.cache_path = cache_path
+
+        dir_mtime = os.stat(wrstat_dir).st_mtime
+        entries = self._load_cache(dir_mtime)
+        if entries is None:
+            entries = self._scan()
+            self._save_cache(dir_mtime, entries)
+
+        # (volume, date): newest first
+        self.reports: T.Dict[T.Tuple[int, str], T.List[CatalogueEntry]] = {}
+        # newest first
+        self.base_directories: T.List[CatalogueEntry] = []
+
+        for entry in sorted(entries, key=lambda e: e.mtime, reverse=True):
+            if entry.volume is None:
+                self.base_directories.append(entry)
+            else:
+                self.reports.setdefault(
+                    (entry.volume, T.cast(str, entry.date)), []).append(entry)
+
+    def _scan(self) -> T.List[CatalogueEntry]:
+        entries: T.List[CatalogueEntry] = []
+        with os.scandir(self.wrstat_dir) as directory:
+            for dir_entry in directory:
+                match = _WRSTAT_NAME.match(dir_entry.name)
+                if match is None and not dir_entry.name.endswith(".basedirs"):
+                    continue
+
+                stat = dir_entry.stat()
+                entries.append(CatalogueEntry(
+                    path=os.path.join(self.wrstat_dir, dir_entry.name),
+                    size=stat.st_size,
+                    mtime=stat.st_mtime,
+                    date=match.group(1) if match else None,
+                    volume=int(match.group(2)) if match else None))
+
+        return entries
+
+    def _load_cache(self, dir_mtime: float) -> T.Optional[T.List[CatalogueEntry]]:
+        if self.cache_path is None:
+            return None
+
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if cache.get("wrstat_dir") != self.wrstat_dir or cache.get("dir_mtime") != dir_mtime:
+            return None
+
+        return [CatalogueEntry(**entry) for entry in cache["entries"]]
+
+    def _save_cache(self, dir_mtime: float, entries: T.List[CatalogueEntry]) -> None:
+        if self.cache_path is None:
+            return
+
+        # if we can't save it, the next process will just have to list
+        # the directory again
+        try:
+            with open(f"{self.cache_path}.{os.getpid()}.tmp", "w") as f:
+                json.dump({
+                    "wrstat_dir": self.wrstat_dir,
+                    "dir_mtime": dir_mtime,
+                    "entries": [asdict(entry) for entry in entries]
+                }, f)
+            os.replace(f"{self.cache_path}.{os.getpid()}.tmp", self.cache_path)
+        except OSError:
+            pass
+
+    def report(self, volume: int, date: datetime.date) -> T.Optional[CatalogueEntry]:
+        """the wrstat file for a volume on a date - if there's more than
+        one, the most recently edited"""
+        matching = self.reports.get((volume, date.strftime("%Y%m%d")))
+        return matching[0] if matching else None
+
+    def base_directories_as_of(self, as_of: T.Optional[float] = None) -> T.Optional[CatalogueEntry]:
+        """the most recent base directories file, or if as_of (a timestamp)
+        is given, the most recent from no later than that (or the oldest
+        one, if they're all newer)"""
+        if len(self.base_directories) == 0:
+            return None
+        if as_of is None:
+            return self.base_directories[0]
+
+        return next((entry for entry in self.base_directories if entry.mtime <= as_of),
+                    self.base_directories[-1])
+
+
+def get_catalogue(wrstat_dir: str) -> WrstatCatalogue:
+    """the catalogue of wrstat_dir - only built once per process"""
+    wrstat_dir = os.path.normpath(wrstat_dir)
+    if wrstat_dir not in _catalogues:
+        _catalogues[wrstat_dir] = WrstatCatalogue(wrstat_dir)
+    return _catalogues[wrstat_dir]
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import os
+import pickle
+import shutil
+import time
+import typing as T
+
+from directory_config import CHECKPOINT_DIR, CHECKPOINT_INTERVAL
+
+
+class Checkpoint:
+    """
+    Where one reporter saves its progress through one volume's wrstat file.
+
+    The manifest records how far through the (uncompressed) wrstat file
+    we'd got, along with whatever else the reporter wants to resume from,
+    and any other state (i.e. partial aggregates) goes in files alongside
+    it. The manifest is written last, and atomically, so whatever it says
+    is always backed by complete files.
+
+    A checkpoint is only any use for the wrstat file it was taken from -
+    if there's a newer one, we start again.
+    """
+
+    def __init__(self, reporter: str, volume: int, report_path: str,
+                 checkpoint_dir: T.Optional[str] = CHECKPOINT_DIR,
+                 interval: T.Optional[int] = CHECKPOINT_INTERVAL) -> None:
+        self.enabled = checkpoint_dir is not None and interval is not None
+        self.directory = os.path.join(
+            checkpoint_dir or "", reporter, f"scratch{volume}")
+        self.report_path = report_path
+        self.interval = interval
+        self._last = time.monotonic()
+
+    @property
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def path(self, name: str) -> str:
+        """where a piece of state called name lives"""
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, name)
+
+    def due(self) -> bool:
+        """whether it's been long enough since the last checkpoint"""
+        return self.enabled and self.interval is not None and \
+            time.monotonic() - self._last >= self.interval
+
+    def load_manifest(self) -> T.Optional[T.Dict[str, T.Any]]:
+        """the last checkpoint's manifest, if there is one for this wrstat
+        file"""
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self._manifest_path) as f:
+                manifest: T.Dict[str, T.Any] = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if manifest.get("report_path") != self.report_path or \
+                manifest.get("report_mtime") != os.stat(self.report_path).st_mtime:
+            return None
+
+        return manifest
+
+    def save_manifest(self, **state: T.Any) -> None:
+        manifest_path = self.path("manifest.json")
+        with open(f"{manifest_path}.tmp", "w") as f:
+            json.dump({
+                "report_path": self.report_path,
+                "report_mtime": os.stat(self.report_path).st_mtime,
+                "saved": time.time(),
+                **state
+            }, f)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+        self._last = time.monotonic()
+
+    def save(self, name: str, state: T.Any) -> None:
+        """pickles some state next to the manifest"""
+        path = self.path(name)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, name: str) -> T.Any:
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return pickle.load(f)
+
+    def prune(self, keep: T.Iterable[str]) -> None:
+        """removes any state files the latest manifest doesn't need"""
+        keep = set(keep) | {"manifest.json"}
+        for name in os.listdir(self.directory):
+            if name not in keep:
+                os.remove(os.path.join(self.directory, name))
+
+    def clear(self) -> None:
+        if self.enabled:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self._last = time.monotonic()
+
+
+def clear(reporter: str, volume: int,
+          checkpoint_dir: T.Optional[str] = CHECKPOINT_DIR) -> None:
+    """removes a reporter's checkpoint for a volume, once it's been
+    completely dealt with"""
+    if checkpoint_dir is not None:
+        shutil.rmtree(os.path.join(checkpoint_dir, reporter,
+                      f"scratch{volume}"), ignore_errors=True)
+
+
+def open_wrstat(report_path: str, offset: int = 0) -> T.TextIO:
+    """
+    Opens a wrstat file for reading from offset bytes into the uncompressed
+    data. gzip can't jump straight there, but skipping forward just
+    decompresses and throws away, which is much quicker than going through
+    it line by line.
+
+    wrstat lines are all ASCII, so the length of a line is its size in bytes.
+    """
+    wrstat = gzip.open(report_path, "rb")
+    if offset > 0:
+        wrstat.seek(offset)
+    return io.TextIOWrapper(wrstat, encoding="ascii")
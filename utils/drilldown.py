@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import argparse
+import bisect
+import datetime
+import glob
+import json
+import logging
+import os
+import typing as T
+from dataclasses import dataclass
+
+from directory_config import DRILLDOWN_DEPTH, DRILLDOWN_DIR
+from lurge_types.group_report import GroupReport
+from utils.blockfile import BlockFile, front_code, front_decode, write_block_file
+from utils.symlink import get_mdt_symlink
+
+# The drill-down trees the group reporter builds (if DRILLDOWN_DEPTH is set)
+# go in one file per volume per day:
+#     {DRILLDOWN_DIR}2022-06-01/scratch123.tree
+#
+# The file is a sorted run of entries, one per (directory, group), split
+# into blocks of BLOCK_ENTRIES (see utils/blockfile.py). A block is an
+# entry per line, as JSON, with each path only storing what's different
+# from the one before it, and the index has the first path (and group) in
+# every block.
+#
+# Entries are sorted by their path's components (then group), so
+# everything under a directory comes straight after it, and subtree queries
+# are a single scan.
+
+MAGIC = b"LURGETREE1\n"
+BLOCK_ENTRIES = 64
+
+# (path components, group name)
+_Key = T.Tuple[T.List[str], str]
+
+
+@dataclass(frozen=True)
+class DrilldownEntry:
+    path: str
+    group_name: T.Optional[str]
+    size: int
+    num_files: int
+    mtime: int
+    filetypes: T.Dict[str, int]
+
+
+def _split(path: str) -> T.List[str]:
+    return path.rstrip("/").split("/")
+
+
+def _entries(reports: T.List[GroupReport]) -> T.List[DrilldownEntry]:
+    entries: T.List[DrilldownEntry] = []
+    for report in reports:
+        # the paths people know, rather than the MDT ones
+        base_path = get_mdt_symlink(report.base_path or "")
+        for directory, directory_report in report.tree.items():
+            entries.append(DrilldownEntry(
+                path=f"{base_path}/{directory}" if directory else base_path,
+                group_name=report.group_name,
+                size=directory_report.size,
+                num_files=directory_report.num_files,
+                mtime=directory_report.mtime,
+                filetypes=dict(directory_report.filetypes)))
+
+    entries.sort(key=lambda entry: (_split(entry.path), entry.group_name or ""))
+    return entries
+
+
+def write_tree(path: str, entries: T.List[DrilldownEntry], volume: int,
+               wrstat_time: int, depth: T.Optional[int]) -> None:
+    """writes (already sorted) entries to path"""
+    with write_block_file(path, MAGIC) as writer:
+        blocks: T.List[T.Tuple[str, T.Optional[str], int, int]] = []
+
+        for start in range(0, len(entries), BLOCK_ENTRIES):
+            block_entries = entries[start:start + BLOCK_ENTRIES]
+            lines = [
+                json.dumps([shared, suffix, entry.group_name, entry.size,
+                            entry.num_files, entry.mtime, entry.filetypes],
+                           separators=(",", ":"))
+                for entry, (shared, suffix) in zip(
+                    block_entries, front_code([entry.path for entry in block_entries]))]
+
+            offset, length = writer.write("\n".join(lines).encode("UTF-8"))
+            blocks.append((block_entries[0].path, block_entries[0].group_name, offset, length))
+
+        writer.finish({
+            "volume": volume,
+            "wrstat_time": wrstat_time,
+            "depth": depth,
+            "entries": len(entries),
+            "blocks": blocks
+        })
+
+
+def write_trees(reports: T.List[T.List[GroupReport]], logger: T.Union[
+        logging.Logger, logging.LoggerAdapter[logging.Logger]]) -> T.List[str]:
+    """
+    Writes a tree file for each volume's reports, under the date of its
+    wrstat file.
+
+    :returns: the paths of the files written
+    """
+    written: T.List[str] = []
+    for volume_reports in reports:
+        if len(volume_reports) == 0:
+            continue
+
+        volume = volume_reports[0].volume
+        wrstat_time = volume_reports[0].wrstat_time
+        date = datetime.date.fromtimestamp(wrstat_time).isoformat()
+        path = f"{DRILLDOWN_DIR}{date}/scratch{volume}.tree"
+
+        entries = _entries(volume_reports)
+        write_tree(path, entries, volume, wrstat_time, DRILLDOWN_DEPTH)
+        logger.info(f"wrote {len(entries)} directories to {path}")
+        written.append(path)
+
+    return written
+
+
+def _decode_block(_: T.List[T.Any], data: bytes) -> T.List[DrilldownEntry]:
+    rows = [json.loads(line) for line in data.decode("UTF-8").split("\n")]
+    paths = front_decode([(shared, suffix) for shared, suffix, *_ in rows])
+    return [DrilldownEntry(path, *row[2:]) for path, row in zip(paths, rows)]
+
+
+class DrilldownIndex:
+    """
+    Reads a tree file written by write_tree - only the blocks a query
+    needs get read (see utils/blockfile.BlockFile).
+
+    All the paths are the human readable ones (see utils/symlink.py).
+    """
+
+    def __init__(self, path: str, cached_blocks: int = 16) -> None:
+        self.path = path
+        self._file: BlockFile[T.List[DrilldownEntry]] = BlockFile(
+            path, MAGIC, "drill-down tree file", _decode_block, cached_blocks)
+
+        index = self._file.index
+        self.volume: int = index["volume"]
+        self.wrstat_time: int = index["wrstat_time"]
+        self.depth: T.Optional[int] = index["depth"]
+        self.entries: int = index["entries"]
+
+        self._first_keys: T.List[_Key] = [
+            (_split(path), group_name or "") for path, group_name, _, _ in self._file.blocks]
+
+    def __enter__(self) -> DrilldownIndex:
+        return self
+
+    def __exit__(self, *_: T.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _scan(self, parts: T.List[str]) -> T.Iterator[DrilldownEntry]:
+        """every entry at or under the directory with these components, in
+        order"""
+        # the block before the first one that starts after parts - that's
+        # the first one that could have it
+        start = max(0, bisect.bisect_left(self._first_keys, (parts, "")) - 1)
+        for i in range(start, len(self._file)):
+            for entry in self._file.block(i):
+                entry_parts = _split(entry.path)
+                if entry_parts[:len(parts)] == parts:
+                    yield entry
+                elif entry_parts > parts:
+                    return
+
+    def lookup(self, path: str) -> T.List[DrilldownEntry]:
+        """the totals for a directory - one for each group with data there"""
+        parts = _split(path)
+        entries: T.List[DrilldownEntry] = []
+        for entry in self._scan(parts):
+            if len(_split(entry.path)) != len(parts):
+                break
+            entries.append(entry)
+        return entries
+
+    def children(self, path: str) -> T.List[DrilldownEntry]:
+        """the totals for each directory directly under path"""
+        return self.subtree(path, 1, include_self=False)
+
+    def subtree(self, path: str, depth: T.Optional[int] = None,
+                include_self: bool = True) -> T.List[DrilldownEntry]:
+        """everything under path, down to depth levels below it, with each
+        directory straight before the ones under it"""
+        parts = _split(path)
+        return [
+            entry for entry in self._scan(parts)
+            if (include_self or len(_split(entry.path)) > len(parts))
+            and (depth is None or len(_split(entry.path)) - len(parts) <= depth)
+        ]
+
+    def __iter__(self) -> T.Iterator[DrilldownEntry]:
+        for i in range(len(self._file)):
+            yield from self._file.block(i)
+
+
+def find_index(volume: int, date: T.Optional[str] = None,
+               drilldown_dir: str = DRILLDOWN_DIR) -> T.Optional[DrilldownIndex]:
+    """the tree file for a volume on a date (as an ISO date string), or the
+    most recent one if there's no date"""
+    if date is not None:
+        path = f"{drilldown_dir}{date}/scratch{volume}.tree"
+        return DrilldownIndex(path) if os.path.exists(path) else None
+
+    found = sorted(glob.glob(f"{drilldown_dir}*/scratch{volume}.tree"))
+    return DrilldownIndex(found[-1]) if len(found) > 0 else None
+
+
+if __name__ == "__main__":
+    """
+    Looks things up in the drill-down trees, i.e.:
+        python -m utils.drilldown 123 /lustre/scratch123/hgi/projects/foo --depth 2
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("volume", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--date", default=None,
+                        help="the date of the wrstat file (YYYY-MM-DD), defaults to the latest")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="how many levels below path to show")
+    args = parser.parse_args()
+
+    index = find_index(args.volume, args.date)
+    if index is None:
+        raise SystemExit(f"no drill-down tree for scratch{args.volume}")
+
+    with index:
+        for entry in index.subtree(args.path, args.depth):
+            print("\t".join([
+                entry.path, entry.group_name or "-",
+                str(entry.size), str(entry.num_files),
+                datetime.date.fromtimestamp(entry.mtime).isoformat()]))
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import typing as T
+
+import numpy as np
+
+from directory_config import (DUPLICATE_PARTITIONS, DUPLICATES_BY_NAME, FILETYPES,
+                              SPILL_DIR)
+from lurge_types.duplicates import DuplicateFile, DuplicateSet
+from utils.hardlinks import path_hashes
+from utils.wrstat import DEV, GID, INODE, MTIME, PATH, SIZE, TYPE, WrstatBlock, decode_path
+
+# Duplicate candidates (see duplicate_reporter.py)
+#
+# Finding copies by comparing every file with every other is out of the
+# question, but copies have to be the same size, so we only need to look
+# at files that are. The pool processes pick out the files that are big
+# enough to be worth it (DUPLICATE_MIN_SIZE), and send them back as
+# columns - size, filetype and name hash (the key), plus where they are.
+#
+# Rather than sorting all of them at once, they're hash partitioned on
+# the key into DUPLICATE_PARTITIONS files on scratch as they come in, so
+# files with the same key always end up in the same partition. Then each
+# partition is read back and grouped up on its own - so we only ever have
+# one partition's files in memory, and volumes share partitions, so we
+# find copies across volumes too.
+
+CandidateColumns = T.Dict[str, np.ndarray]
+
+# the filetypes in FILETYPES order - a file's filetype is the first that
+# matches it, as an index into this (or -1)
+_FILETYPES = [(filetype, re.compile(regex)) for filetype, regex in FILETYPES.items()]
+
+# spreads sizes out over the hash partitions, so files of similar sizes
+# don't all end up in the same one
+_SPREAD = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _filetype(path: str) -> int:
+    for i, (_, regex) in enumerate(_FILETYPES):
+        if regex.search(path):
+            return i
+    return -1
+
+
+def find_candidates(data: bytes, min_size: int, by_filetype: bool,
+                    by_name: bool) -> CandidateColumns:
+    """what the pool processes do with each batch of lines - picks out the
+    files of at least min_size, and sends back their size, filetype and
+    name hash (-1 and 0 if we're not going by them), device, inode, group,
+    mtime and (still encoded) path.
+
+    Only those files' paths get decoded, and only if we need their
+    filetype or name."""
+    block = WrstatBlock(data)
+    if len(block) == 0:
+        return _empty()
+
+    sizes = block.ints(SIZE)
+    found = np.flatnonzero((sizes >= min_size) & (np.array(block.column(TYPE)) == b"f"))
+    encoded = block.column(PATH)
+    paths = [encoded[i] for i in found.tolist()]
+
+    filetypes = np.full(len(found), -1, dtype=np.int8)
+    names = np.zeros(len(found), dtype=np.uint64)
+    if by_filetype or by_name:
+        decoded = [decode_path(path) for path in paths]
+        if by_filetype:
+            filetypes = np.array([_filetype(path) for path in decoded], dtype=np.int8)
+        if by_name and len(decoded) > 0:
+            names = path_hashes([os.path.basename(path).encode("UTF-8", "replace")
+                                 for path in decoded])
+
+    return {
+        "size": sizes[found],
+        "filetype": filetypes,
+        "name": names,
+        "dev": block.ints(DEV, np.uint64)[found],
+        "inode": block.ints(INODE, np.uint64)[found],
+        "gid": block.ints(GID)[found],
+        "mtime": block.ints(MTIME)[found],
+        "path": np.array(paths, dtype=object)
+    }
+
+
+def _empty() -> CandidateColumns:
+    return {
+        "size": np.empty(0, dtype=np.int64),
+        "filetype": np.empty(0, dtype=np.int8),
+        "name": np.empty(0, dtype=np.uint64),
+        "dev": np.empty(0, dtype=np.uint64),
+        "inode": np.empty(0, dtype=np.uint64),
+        "gid": np.empty(0, dtype=np.int64),
+        "mtime": np.empty(0, dtype=np.int64),
+        "path": np.empty(0, dtype=object)
+    }
+
+
+def _concatenate(chunks: T.List[CandidateColumns]) -> CandidateColumns:
+    return {name: np.concatenate([chunk[name] for chunk in chunks])
+            for name in chunks[0]}
+
+
+def _partitions(columns: CandidateColumns, partitions: int) -> np.ndarray:
+    """which partition each file goes in - it only depends on the key"""
+    key = columns["size"].astype(np.uint64) * _SPREAD
+    key ^= columns["name"]
+    key ^= columns["filetype"].astype(np.uint64)
+    return ((key >> np.uint64(32)) % np.uint64(partitions)).astype(np.int64)
+
+
+class CandidatePartitions:
+    """
+    The hash partitions, as files in a directory of their own on scratch.
+    Candidates from each volume (which can be coming in from a thread per
+    volume at once) are held until there are buffer_rows of them, and then
+    appended to their partitions' files.
+    """
+
+    def __init__(self, partitions: int = DUPLICATE_PARTITIONS,
+                 scratch_dir: str = SPILL_DIR, buffer_rows: int = 2**16) -> None:
+        self.partitions = partitions
+        self.buffer_rows = buffer_rows
+        self.candidates = 0
+
+        self._dir = tempfile.mkdtemp(prefix="lurge-duplicates-", dir=scratch_dir)
+        self._lock = threading.Lock()
+        self._pending: T.List[CandidateColumns] = []
+        self._pending_rows = 0
+
+    def __enter__(self) -> CandidatePartitions:
+        return self
+
+    def __exit__(self, *_: T.Any) -> None:
+        self.close()
+
+    def _path(self, partition: int) -> str:
+        return f"{self._dir}/partition-{partition}"
+
+    def add(self, volume: int, candidates: CandidateColumns) -> None:
+        rows = len(candidates["size"])
+        if rows == 0:
+            return
+
+        with self._lock:
+            self._pending.append(
+                {**candidates, "volume": np.full(rows, volume, dtype=np.int64)})
+            self._pending_rows += rows
+            self.candidates += rows
+            if self._pending_rows >= self.buffer_rows:
+                self._flush()
+
+    def _flush(self) -> None:
+        if len(self._pending) == 0:
+            return
+
+        columns = _concatenate(self._pending)
+        self._pending, self._pending_rows = [], 0
+
+        which = _partitions(columns, self.partitions)
+        for partition in np.unique(which).tolist():
+            rows = which == partition
+            with open(self._path(partition), "ab") as out:
+                pickle.dump({name: column[rows] for name, column in columns.items()},
+                            out, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _read(path: str) -> T.Iterator[CandidateColumns]:
+        with open(path, "rb") as partition:
+            while True:
+                try:
+                    yield pickle.load(partition)
+                except EOFError:
+                    return
+
+    def duplicate_sets(self, by_name: bool = DUPLICATES_BY_NAME) -> T.Iterator[DuplicateSet]:
+        """every set of candidates, a partition at a time. This consumes
+        the partitions."""
+        with self._lock:
+            self._flush()
+
+        for partition in range(self.partitions):
+            path = self._path(partition)
+            if not os.path.exists(path):
+                continue
+            yield from duplicate_sets(_concatenate(list(self._read(path))), by_name)
+            os.remove(path)
+
+    def close(self) -> None:
+        """removes the partitions from scratch"""
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def duplicate_sets(columns: CandidateColumns,
+                   by_name: bool = DUPLICATES_BY_NAME) -> T.Iterator[DuplicateSet]:
+    """the sets of files in one partition with the same key"""
+    if len(columns["size"]) == 0:
+        return
+
+    # hardlinks to a file aren't copies of it, so each inode is only in
+    # a set once, as whichever of its links has the lowest path. (Its
+    # links can have different names and filetypes, and so be in
+    # different sets, but they'll never be in the same one.)
+    order = np.lexsort((columns["path"], columns["inode"], columns["dev"],
+                        columns["name"], columns["filetype"], columns["size"]))
+    columns = {name: column[order] for name, column in columns.items()}
+    first = np.zeros(len(order), dtype=bool)
+    first[0] = True
+    for name in ("size", "filetype", "name", "dev", "inode"):
+        first[1:] |= columns[name][1:] != columns[name][:-1]
+    columns = {name: column[first] for name, column in columns.items()}
+
+    # sorted by the key, and then by volume and path, so the sets (and the
+    # files in them) come out in the same order however the lines came in
+    order = np.lexsort((columns["path"], columns["volume"], columns["name"],
+                        columns["filetype"], columns["size"]))
+    columns = {name: column[order] for name, column in columns.items()}
+    same = np.ones(len(order) - 1, dtype=bool)
+    for name in ("size", "filetype", "name"):
+        same &= columns[name][1:] == columns[name][:-1]
+    ends = [*(np.flatnonzero(~same) + 1).tolist(), len(order)]
+
+    start = 0
+    for end in ends:
+        if end - start > 1:
+            files = [DuplicateFile(volume, decode_path(path), gid, mtime)
+                     for volume, path, gid, mtime in zip(
+                         columns["volume"][start:end].tolist(), columns["path"][start:end],
+                         columns["gid"][start:end].tolist(), columns["mtime"][start:end].tolist())]
+            filetype = int(columns["filetype"][start])
+            yield DuplicateSet(
+                size=int(columns["size"][start]),
+                filetype=_FILETYPES[filetype][0] if filetype >= 0 else None,
+                name=os.path.basename(files[0].path) if by_name else None,
+                files=files)
+        start = end
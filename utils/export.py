@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import contextlib
+import datetime
+import logging
+import os
+import typing as T
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from directory_config import EXPORT_DIR
+from lurge_types.duplicates import DuplicateSet
+from lurge_types.group_report import GroupReport
+from lurge_types.histograms import HISTOGRAMS, Histograms
+from lurge_types.user import UserReport
+from lurge_types.vault import VaultPuppet
+from utils.symlink import get_mdt_symlink
+
+# The exports are Hive-style partitioned Parquet datasets, so they can be
+# read straight into pyarrow.dataset, pandas, DuckDB etc. like:
+#   {EXPORT_DIR}group_usage/date=2022-06-01/volume=scratch123/part-0.parquet
+# All sizes are exact byte counts, and times are unix timestamps, unlike the
+# rounded values we put in MySQL.
+
+# The size and age histograms (see lurge_types/histograms.py) are a list
+# column each for the files and the bytes in every bucket, i.e. size_files
+# and size_bytes
+HISTOGRAM_FIELDS = [
+    (f"{name}_{kind}", pa.list_(pa.int64()))
+    for name in HISTOGRAMS for kind in ("files", "bytes")
+]
+
+GROUP_USAGE_SCHEMA = pa.schema([
+    ("base_path", pa.string()),
+    ("directory_path", pa.string()),
+    ("group_name", pa.string()),
+    ("pi_name", pa.string()),
+    ("usage", pa.int64()),
+    ("quota", pa.int64()),
+    ("last_modified", pa.int64()),
+    ("wrstat_time", pa.int64()),
+    *HISTOGRAM_FIELDS
+])
+
+DIRECTORY_USAGE_SCHEMA = pa.schema([
+    ("base_path", pa.string()),
+    ("subdir", pa.string()),
+    ("group_name", pa.string()),
+    ("pi_name", pa.string()),
+    ("size", pa.int64()),
+    ("num_files", pa.int64()),
+    ("last_modified", pa.int64()),
+    *HISTOGRAM_FIELDS
+])
+
+FILETYPE_USAGE_SCHEMA = pa.schema([
+    ("base_path", pa.string()),
+    ("subdir", pa.string()),
+    ("filetype", pa.string()),
+    ("size", pa.int64())
+])
+
+# the largest and least recently modified files under each base directory
+# (see lurge_types/top_files.py) - kind is "largest" or "oldest", and rank
+# is where it comes in that list, from 1
+TOP_FILES_SCHEMA = pa.schema([
+    ("base_path", pa.string()),
+    ("directory_path", pa.string()),
+    ("group_name", pa.string()),
+    ("pi_name", pa.string()),
+    ("kind", pa.string()),
+    ("rank", pa.int64()),
+    ("path", pa.string()),
+    ("size", pa.int64()),
+    ("last_modified", pa.int64())
+])
+
+USER_USAGE_SCHEMA = pa.schema([
+    ("uid", pa.int64()),
+    ("username", pa.string()),
+    ("gid", pa.int64()),
+    ("group_name", pa.string()),
+    ("size", pa.int64()),
+    ("last_modified", pa.date32()),
+    *HISTOGRAM_FIELDS
+])
+
+# a row per file in every set of duplicate candidates (see
+# lurge_types/duplicates.py), in its volume's partition - so a set across
+# volumes is in each of their partitions, with the same set_id. copies and
+# reclaimable are for the whole set, and volume_copies and
+# volume_reclaimable for just the files on that volume
+DUPLICATES_SCHEMA = pa.schema([
+    ("set_id", pa.string()),
+    ("size", pa.int64()),
+    ("filetype", pa.string()),
+    ("name", pa.string()),
+    ("copies", pa.int64()),
+    ("reclaimable", pa.int64()),
+    ("volume_copies", pa.int64()),
+    ("volume_reclaimable", pa.int64()),
+    ("path", pa.string()),
+    ("gid", pa.int64()),
+    ("group_name", pa.string()),
+    ("last_modified", pa.int64())
+])
+
+VAULT_USAGE_SCHEMA = pa.schema([
+    ("full_path", pa.string()),
+    ("state", pa.string()),
+    ("size", pa.int64()),
+    ("owner", pa.string()),
+    ("group_name", pa.string()),
+    ("last_modified", pa.date32())
+])
+
+
+def _add_histograms(rows: T.Dict[str, T.List[T.Any]],
+                    histograms: T.Optional[Histograms]) -> None:
+    for name in HISTOGRAMS:
+        rows[f"{name}_files"].append(histograms.files(name) if histograms is not None else None)
+        rows[f"{name}_bytes"].append(histograms.bytes(name) if histograms is not None else None)
+
+
+def _write_partition(dataset: str, date: str, volume: int,
+                     rows: T.Dict[str, T.List[T.Any]], schema: pa.Schema) -> str:
+    """writes one date/volume partition of a dataset, replacing any
+    existing partition for that date and volume"""
+    partition_dir = f"{EXPORT_DIR}{dataset}/date={date}/volume=scratch{volume}"
+    os.makedirs(partition_dir, exist_ok=True)
+
+    # write to a temporary file first, so anyone reading the dataset
+    # never sees half a file
+    final_path = f"{partition_dir}/part-0.parquet"
+    tmp_path = f"{final_path}.tmp"
+    pq.write_table(pa.Table.from_pydict(rows, schema=schema), tmp_path)
+    os.replace(tmp_path, final_path)
+
+    return final_path
+
+
+@contextlib.contextmanager
+def _partition_writer(dataset: str, date: str, volume: int,
+                      schema: pa.Schema) -> T.Iterator[pq.ParquetWriter]:
+    """like _write_partition, for when there are too many rows to hold at
+    once - they're written a batch at a time, and the partition is only
+    replaced if we get to the end"""
+    partition_dir = f"{EXPORT_DIR}{dataset}/date={date}/volume=scratch{volume}"
+    os.makedirs(partition_dir, exist_ok=True)
+
+    final_path = f"{partition_dir}/part-0.parquet"
+    tmp_path = f"{final_path}.tmp"
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        yield writer
+    os.replace(tmp_path, final_path)
+
+
+def export_group_reports(group_reports: T.List[T.List[GroupReport]],
+                         logger: logging.LoggerAdapter[logging.Logger]) -> None:
+    """
+    Writes the GroupReports (and their DirectoryReports, filetype
+    breakdowns and top files) into the group_usage, directory_usage,
+    filetype_usage and top_files datasets, partitioned by the wrstat date
+    and volume.
+
+    :param group_reports: volume -> list of GroupReports, as the reporter has them
+    """
+    for _vol in group_reports:
+        if len(_vol) == 0:
+            continue
+
+        volume = _vol[0].volume
+        date = datetime.date.fromtimestamp(_vol[0].wrstat_time).isoformat()
+
+        group_rows: T.Dict[str, T.List[T.Any]] = {
+            name: [] for name in GROUP_USAGE_SCHEMA.names}
+        directory_rows: T.Dict[str, T.List[T.Any]] = {
+            name: [] for name in DIRECTORY_USAGE_SCHEMA.names}
+        filetype_rows: T.Dict[str, T.List[T.Any]] = {
+            name: [] for name in FILETYPE_USAGE_SCHEMA.names}
+        top_file_rows: T.Dict[str, T.List[T.Any]] = {
+            name: [] for name in TOP_FILES_SCHEMA.names}
+
+        for report in _vol:
+            group_rows["base_path"].append(report.base_path)
+            group_rows["directory_path"].append(
+                get_mdt_symlink(report.base_path or ""))
+            group_rows["group_name"].append(report.group_name)
+            group_rows["pi_name"].append(report.pi_name)
+            group_rows["usage"].append(report.usage)
+            group_rows["quota"].append(report.quota)
+            group_rows["last_modified"].append(report.last_modified)
+            group_rows["wrstat_time"].append(report.wrstat_time)
+            _add_histograms(group_rows, report.histograms)
+
+            for kind, top_files in (("largest", report.top_files.largest_files()),
+                                    ("oldest", report.top_files.oldest_files())):
+                for rank, top_file in enumerate(top_files, start=1):
+                    top_file_rows["base_path"].append(report.base_path)
+                    top_file_rows["directory_path"].append(
+                        get_mdt_symlink(report.base_path or ""))
+                    top_file_rows["group_name"].append(report.group_name)
+                    top_file_rows["pi_name"].append(report.pi_name)
+                    top_file_rows["kind"].append(kind)
+                    top_file_rows["rank"].append(rank)
+                    top_file_rows["path"].append(get_mdt_symlink(top_file.path))
+                    top_file_rows["size"].append(top_file.size)
+                    top_file_rows["last_modified"].append(top_file.mtime)
+
+            for subdir, subdir_report in report.subdirs.items():
+                directory_rows["base_path"].append(report.base_path)
+                directory_rows["subdir"].append(subdir)
+                directory_rows["group_name"].append(report.group_name)
+                directory_rows["pi_name"].append(report.pi_name)
+                directory_rows["size"].append(int(subdir_report.size))
+                directory_rows["num_files"].append(subdir_report.num_files)
+                directory_rows["last_modified"].append(subdir_report.mtime)
+                _add_histograms(directory_rows, subdir_report.histograms)
+
+                for filetype, size in subdir_report.filetypes.items():
+                    filetype_rows["base_path"].append(report.base_path)
+                    filetype_rows["subdir"].append(subdir)
+                    filetype_rows["filetype"].append(filetype)
+                    filetype_rows["size"].append(int(size))
+
+        _write_partition("group_usage", date, volume,
+                         group_rows, GROUP_USAGE_SCHEMA)
+        _write_partition("directory_usage", date, volume,
+                         directory_rows, DIRECTORY_USAGE_SCHEMA)
+        _write_partition("filetype_usage", date, volume,
+                         filetype_rows, FILETYPE_USAGE_SCHEMA)
+        _write_partition("top_files", date, volume,
+                         top_file_rows, TOP_FILES_SCHEMA)
+
+        logger.info(f"exported group reports for scratch{volume} ({date})")
+
+
+def export_user_reports(volume_user_reports: T.Dict[int, T.Mapping[str, UserReport]],
+                        usernames: T.Dict[int, str],
+                        user_groups: T.Dict[str, T.Set[T.Tuple[str, str]]],
+                        wrstat_dates: T.Dict[int, datetime.date],
+                        logger: logging.Logger) -> None:
+    """
+    Writes the UserReports into the user_usage dataset, a row per
+    user/group pair, partitioned by wrstat date and volume.
+    """
+    for volume, reports in volume_user_reports.items():
+        rows: T.Dict[str, T.List[T.Any]] = {
+            name: [] for name in USER_USAGE_SCHEMA.names}
+
+        for uid, report in reports.items():
+            group_names = {gid: grp_name for grp_name,
+                           gid in user_groups.get(uid, set())}
+
+            for gid, size in report.size.items():
+                rows["uid"].append(int(uid))
+                rows["username"].append(usernames.get(int(uid)))
+                rows["gid"].append(int(gid))
+                rows["group_name"].append(group_names.get(gid))
+                rows["size"].append(size)
+                rows["last_modified"].append(report._mtime[gid])
+                _add_histograms(rows, report.histograms.get(gid))
+
+        date = wrstat_dates[volume].isoformat()
+        _write_partition("user_usage", date, volume, rows, USER_USAGE_SCHEMA)
+        logger.info(f"exported user reports for scratch{volume} ({date})")
+
+
+def export_vault_reports(vault_reports: T.List[T.Tuple[int, T.Dict[str, VaultPuppet]]],
+                         wrstat_dates: T.Dict[int, datetime.date],
+                         logger: logging.Logger) -> None:
+    """
+    Writes the vault puppets into the vault_usage dataset, a row per
+    vaulted file, partitioned by wrstat date and volume.
+    """
+    for volume, puppets in vault_reports:
+        rows: T.Dict[str, T.List[T.Any]] = {
+            name: [] for name in VAULT_USAGE_SCHEMA.names}
+
+        for puppet in puppets.values():
+            rows["full_path"].append(puppet.full_path)
+            rows["state"].append(puppet.state)
+            rows["size"].append(puppet._size)
+            rows["owner"].append(puppet.owner)
+            rows["group_name"].append(puppet.group)
+            rows["last_modified"].append(puppet._mtime)
+
+        date = wrstat_dates[volume].isoformat()
+        _write_partition("vault_usage", date, volume, rows, VAULT_USAGE_SCHEMA)
+        logger.info(f"exported vault reports for scratch{volume} ({date})")
+
+
+def export_duplicates(duplicate_sets: T.Iterable[DuplicateSet],
+                      group_names: T.Dict[int, str],
+                      wrstat_dates: T.Dict[int, datetime.date],
+                      logger: logging.Logger, batch_rows: int = 2**16) -> None:
+    """
+    Writes sets of duplicate candidates into the duplicates dataset, a row
+    per file, partitioned by wrstat date and volume. They're written as
+    they come, batch_rows at a time, so they never all have to be in memory.
+    """
+    rows: T.Dict[int, T.Dict[str, T.List[T.Any]]] = {}
+
+    with contextlib.ExitStack() as stack:
+        writers = {
+            volume: stack.enter_context(_partition_writer(
+                "duplicates", date.isoformat(), volume, DUPLICATES_SCHEMA))
+            for volume, date in wrstat_dates.items()
+        }
+
+        def flush(volume: int) -> None:
+            writers[volume].write_table(
+                pa.Table.from_pydict(rows.pop(volume), schema=DUPLICATES_SCHEMA))
+
+        for duplicate_set in duplicate_sets:
+            set_id = duplicate_set.set_id
+            volume_copies = duplicate_set.volume_copies()
+            volume_reclaimable = duplicate_set.volume_reclaimable()
+
+            for file in duplicate_set.files:
+                volume_rows = rows.setdefault(
+                    file.volume, {name: [] for name in DUPLICATES_SCHEMA.names})
+                volume_rows["set_id"].append(set_id)
+                volume_rows["size"].append(duplicate_set.size)
+                volume_rows["filetype"].append(duplicate_set.filetype)
+                volume_rows["name"].append(duplicate_set.name)
+                volume_rows["copies"].append(duplicate_set.copies)
+                volume_rows["reclaimable"].append(duplicate_set.reclaimable)
+                volume_rows["volume_copies"].append(volume_copies[file.volume])
+                volume_rows["volume_reclaimable"].append(volume_reclaimable[file.volume])
+                volume_rows["path"].append(get_mdt_symlink(file.path))
+                volume_rows["gid"].append(file.gid)
+                volume_rows["group_name"].append(group_names.get(file.gid))
+                volume_rows["last_modified"].append(file.mtime)
+                if len(volume_rows["set_id"]) >= batch_rows:
+                    flush(file.volume)
+
+        for volume in list(rows):
+            flush(volume)
+
+    for volume, date in wrstat_dates.items():
+        logger.info(f"exported duplicate candidates for scratch{volume} ({date.isoformat()})")
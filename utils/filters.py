@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import base64
+import functools
+import re
+import typing as T
+from dataclasses import dataclass
+
+import numpy as np
+
+from utils.wrstat import GID, INODE, PATH, TYPE, WrstatBlock, decode_path
+
+# Push-down filtering of wrstat lines
+#
+# Most of what we do with a wrstat file only needs some of its lines - the
+# group reporter only wants lines under a base directory, puppeteer only
+# wants files in vaults, the splitter only wants groups we know about - but
+# working out which those are used to mean decoding every path. A
+# LineFilter says what a reader wants, as a few simple predicates, and
+# they're worked out on the lines as they came out of the gzip file, so
+# lines nobody wants never get decoded, handed to a task or sent over MPI.
+#
+# The numbers (group ids and inodes) and file types are checked a whole
+# column at a time. Paths are checked while they're still base 64: every
+# path starting with a prefix starts with the same base 64 (apart from the
+# last character or so, which we work out the possibilities for), so
+# prefixes are matched exactly without decoding anything. A string
+# anywhere in a path can turn up in the base 64 three ways, depending on
+# where it starts, so we look for those and only decode the paths that
+# have one of them, to be sure. Either way, a block's paths are searched
+# all at once, as one string, rather than a path at a time.
+
+_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+
+def encoded_prefix(prefix: str) -> bytes:
+    """a regex (as bytes) that the base 64 of every path starting with
+    prefix matches from the start, and no other path's does"""
+    raw = prefix.encode("UTF-8")
+    decided = len(raw) * 8 // 6
+    pattern = re.escape(base64.b64encode(raw)[:decided])
+
+    # the next character has the last few bits of the prefix at the top of
+    # it, and anything at all below them
+    bits = len(raw) * 8 % 6
+    if bits > 0:
+        known = raw[-1] & ((1 << bits) - 1)
+        pattern += b"[" + re.escape(bytes(
+            char for value, char in enumerate(_ALPHABET) if value >> (6 - bits) == known)) + b"]"
+    return pattern
+
+
+def encoded_substrings(substring: str) -> T.List[bytes]:
+    """what the base 64 of a path with substring in it has to have in it,
+    for each of the three places it could start within a group of three
+    bytes. (For a short enough substring, that can be nothing at all)"""
+    raw = substring.encode("UTF-8")
+    found: T.List[bytes] = []
+    for offset in range(3):
+        encoded = base64.b64encode(b"\0" * offset + raw + b"\0" * 2)
+        # the characters that only come from bits of the substring
+        first = -(-offset * 8 // 6)
+        last = (offset + len(raw)) * 8 // 6
+        found.append(encoded[first:last])
+    return found
+
+
+class Filter:
+    """what LineFilter and AnyFilter have in common - they just need to say
+    which lines in a block they want"""
+
+    def mask(self, block: WrstatBlock) -> np.ndarray:
+        """which lines in a block we want"""
+        raise NotImplementedError
+
+    def select(self, block: WrstatBlock) -> T.List[bytes]:
+        """the lines we want from a block, without their newlines"""
+        lines = block.lines()
+        return [lines[i] for i in np.flatnonzero(self.mask(block)).tolist()]
+
+    def apply(self, data: bytes) -> bytes:
+        """just the lines we want from some lines (as bytes)"""
+        block = WrstatBlock(data)
+        keep = self.mask(block)
+        if keep.all():
+            return data
+
+        lines = block.lines()
+        return b"".join(lines[i] + b"\n" for i in np.flatnonzero(keep).tolist())
+
+
+@dataclass(frozen=True)
+class LineFilter(Filter):
+    """
+    The lines a reader wants - ones matching every predicate that's set:
+        gids            the group is one of these
+        types           the file type is one of these (i.e. "f" or "d")
+        path_prefixes   the path starts with one of these
+        path_contains   the path has one of these in it somewhere
+        inodes          the inode is one of these
+
+    It's sent to wherever the lines are (the pool processes, or the MPI
+    controllers), so keep it small - a large set of inodes is better off
+    in shared memory, like puppeteer does it.
+    """
+    gids: T.Optional[T.FrozenSet[int]] = None
+    types: T.Optional[T.FrozenSet[str]] = None
+    path_prefixes: T.Optional[T.Tuple[str, ...]] = None
+    path_contains: T.Optional[T.Tuple[str, ...]] = None
+    inodes: T.Optional[T.FrozenSet[int]] = None
+
+    @functools.cached_property
+    def _columns(self) -> T.List[T.Tuple[int, T.Any, np.ndarray]]:
+        """(column, dtype, values to look for) for the column-at-a-time
+        predicates"""
+        columns: T.List[T.Tuple[int, T.Any, np.ndarray]] = []
+        if self.gids is not None:
+            columns.append((GID, np.int64, np.array(sorted(self.gids), dtype=np.int64)))
+        if self.inodes is not None:
+            columns.append((INODE, np.uint64, np.array(sorted(self.inodes), dtype=np.uint64)))
+        return columns
+
+    @functools.cached_property
+    def _prefixes(self) -> T.Optional[T.Pattern[bytes]]:
+        # matched just after each newline (see _matching) - which is a lot
+        # quicker to look for than the start of a line
+        if self.path_prefixes is None:
+            return None
+        return re.compile(b"\n(?:" + b"|".join(
+            encoded_prefix(prefix) for prefix in sorted(set(self.path_prefixes))) + b")")
+
+    @functools.cached_property
+    def _substrings(self) -> T.Optional[T.List[bytes]]:
+        # None if any of them could be in any path at all
+        encoded = [encoded for substring in self.path_contains or ()
+                   for encoded in encoded_substrings(substring)]
+        if len(encoded) == 0 or not all(encoded):
+            return None
+        return sorted(set(encoded))
+
+    def mask(self, block: WrstatBlock) -> np.ndarray:
+        keep = np.ones(len(block), dtype=bool)
+        if len(block) == 0:
+            return keep
+
+        for column, dtype, values in self._columns:
+            keep &= np.isin(block.ints(column, dtype), values)
+        if self.types is not None:
+            keep &= np.isin(np.array(block.column(TYPE)),
+                            [file_type.encode() for file_type in self.types])
+
+        if self.path_prefixes is None and self.path_contains is None:
+            return keep
+
+        paths = block.column(PATH)
+        if self._prefixes is not None:
+            candidates = np.flatnonzero(keep)
+            keep[candidates[~self._matching(paths, candidates, prefixes=self._prefixes)]] = False
+
+        if self.path_contains is not None:
+            candidates = np.flatnonzero(keep)
+            if self._substrings is not None:
+                matching = self._matching(paths, candidates, substrings=self._substrings)
+                keep[candidates[~matching]] = False
+                candidates = candidates[matching]
+            for i in candidates.tolist():
+                keep[i] = self._contains(paths[i])
+        return keep
+
+    @staticmethod
+    def _matching(paths: T.List[bytes], candidates: np.ndarray,
+                  prefixes: T.Optional[T.Pattern[bytes]] = None,
+                  substrings: T.Sequence[bytes] = ()) -> np.ndarray:
+        """which of the candidates' paths start with one of prefixes, or
+        have one of substrings in them. They're searched all at once, as
+        lines of one string (each after a newline), rather than one at a
+        time"""
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=bool)
+
+        encoded = [paths[i] for i in candidates.tolist()]
+        joined = b"\n" + b"\n".join(encoded)
+
+        found: T.List[int] = []
+        if prefixes is not None:
+            found.extend(match.start() for match in prefixes.finditer(joined))
+        for substring in substrings:
+            position = joined.find(substring)
+            while position >= 0:
+                found.append(position)
+                position = joined.find(substring, position + 1)
+
+        # where each line ends (and the next one's newline is)
+        ends = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)) + 1)
+        matching = np.zeros(len(candidates), dtype=bool)
+        matching[np.searchsorted(ends, np.array(found, dtype=np.int64), side="right")] = True
+        return matching
+
+    def _contains(self, encoded: bytes) -> bool:
+        # a path we can't decode is kept, so whatever wanted it can warn
+        # about it
+        try:
+            path = decode_path(encoded)
+        except ValueError:
+            return True
+        return any(contained in path for contained in self.path_contains or ())
+
+
+@dataclass(frozen=True)
+class AnyFilter(Filter):
+    """the lines any of filters want, i.e. files under some directories, or
+    directories with a particular name anywhere"""
+    filters: T.Tuple[LineFilter, ...]
+
+    def mask(self, block: WrstatBlock) -> np.ndarray:
+        keep = np.zeros(len(block), dtype=bool)
+        for line_filter in self.filters:
+            keep |= line_filter.mask(block)
+        return keep
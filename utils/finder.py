@@ -1,39 +1,46 @@
 from __future__ import annotations
 
 import datetime
-import glob
 import logging
-import os
 import typing as T
 from pathlib import Path
 
 from directory_config import MAX_DAYS_AGO
+from utils.catalogue import get_catalogue
 
 
 def find_report(scratch_disk: str, report_dir: str,
                 logger: T.Optional[logging.LoggerAdapter[logging.Logger]] = None, days_ago: int = 0) -> str:
-    def _mtime(f: str):
-        return os.stat(f).st_mtime
-
-    volume = scratch_disk[-3:]
+    # wrstat files are looked up in the catalogue of report_dir, which
+    # only gets listed once (see utils/catalogue.py)
+    catalogue = get_catalogue(report_dir)
+    volume = int(scratch_disk[-3:])
     while days_ago < MAX_DAYS_AGO:
         date = datetime.date.today() - datetime.timedelta(days=days_ago)
-        matching_files = glob.glob(
-            f"{report_dir}{date.strftime('%Y%m%d')}_scratch{volume}.*.*.stats.gz")  # wrstat
-        # f"{report_dir}{date.strftime('%Y%m%d')}_{volume}.*.*.stats.gz") # mpistat
-        if len(matching_files) == 0:
+        # If there's multiple files, we get the most recently edited
+        report = catalogue.report(volume, date)
+        if report is None:
             days_ago += 1
         else:
-            # If there's multiple files, we'll grab the most recently edited
-            matching_files.sort(reverse=True, key=_mtime)
             if logger:
                 logger.info(
                     f"{scratch_disk}: using wrstat output for {date.strftime('%Y%m%d')}")
-            return matching_files[0]
+            return report.path
 
     raise FileNotFoundError
 
 
+def find_reports(scratch_disk: str, report_dir: str, start: datetime.date,
+                 end: datetime.date) -> T.List[T.Tuple[datetime.date, str]]:
+    """every day between start and end (inclusive) that there's a wrstat
+    file for, oldest first, with the most recently edited file for each"""
+    volume = int(scratch_disk[-3:])
+    return sorted(
+        (entry.record_date, entry.path)
+        for (entry_volume, _), (entry, *_) in get_catalogue(report_dir).reports.items()
+        if entry_volume == volume and start <= entry.record_date <= end)
+
+
 def getParents(directory: str) -> T.List[str]:
     """
         Returns a list of directories parent to parameter directory
@@ -43,17 +50,19 @@ def getParents(directory: str) -> T.List[str]:
     return ["/".join(split_dir[:i]) for i in range(1, len(split_dir))]
 
 
-def read_base_directories(wrstat_dir: Path) -> T.Set[T.Tuple[str, str]]:
-    def _mtime(f: str) -> float:
-        return os.stat(f).st_mtime
-
-    _base_dir_files = glob.glob(f"{wrstat_dir}/*.basedirs")
-    _base_dir_files.sort(reverse=True, key=_mtime)
-    
-    if len(_base_dir_files) == 0:
+def read_base_directories(wrstat_dir: Path,
+                          as_of: T.Optional[float] = None) -> T.Set[T.Tuple[str, str]]:
+    """
+    Reads the most recent base directories file. If as_of (a timestamp) is
+    given, it's the most recent one from no later than that (or the oldest
+    one we've got, if they're all newer) - i.e. for going over old wrstat
+    files
+    """
+    base_directories = get_catalogue(str(wrstat_dir)).base_directories_as_of(as_of)
+    if base_directories is None:
         raise FileNotFoundError("Base Directories File Not Found")
 
-    with open(_base_dir_files[0]) as f:
+    with open(base_directories.path) as f:
         # One Line is a Group:Base Directory Pairing
         # (group being gid)
         # there can be many groups to one base directory,
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import typing as T
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import utils.wrstat
+from utils.metrics import Metrics
+from utils.pipeline import SharedMemoryPipeline
+from utils.wrstat import DEV, INODE, NLINK, PATH, TYPE, WrstatBlock
+
+# Exact hardlink accounting (see EXACT_HARDLINKS in directory_config.py)
+#
+# Normally every link to a file counts for size // nlink of it, which adds
+# up right when all the links are under the same base directory, but not
+# when they're split between base directories (or some are outside them
+# altogether). In exact mode, each (device, inode) is counted once, in full,
+# by one of its links - its "owner" - and the others count for nothing.
+#
+# The owner is the link whose path hashes lowest, so it doesn't matter
+# which worker sees which link, or in what order (the MPI workers get
+# their lines as unordered sets). Working out the owners takes a pass over
+# the wrstat file before the real one, only looking at files with more
+# than one link, and ends up as a sorted array of the owners' path hashes -
+# 8 bytes per hardlinked inode, rather than anything per file.
+#
+# The hashes are 64 bits, so two links colliding is vanishingly unlikely
+# (and would only mean a link being counted when it shouldn't be).
+
+# how many links we collect before boiling them down to one per inode
+COMPACT_EVERY = 2**22
+
+
+def path_hashes(encoded: T.List[bytes]) -> np.ndarray:
+    """64 bit hashes of (base 64 encoded) paths, as a np.uint64 array"""
+    return np.frombuffer(b"".join(
+        hashlib.blake2b(path, digest_size=8).digest() for path in encoded
+    ), dtype="<u8").astype(np.uint64)
+
+
+def _linked(block: WrstatBlock) -> np.ndarray:
+    """which lines in a block are files with more than one link"""
+    return (block.ints(NLINK) > 1) & (np.array(block.column(TYPE)) == b"f")
+
+
+def linked_lines(block: WrstatBlock) -> T.List[bytes]:
+    """just the hardlinked files' lines from a block - all the first pass
+    needs to see"""
+    lines = block.lines()
+    return [lines[i] for i in np.flatnonzero(_linked(block)).tolist()]
+
+
+def find_links(data: bytes) -> T.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """what the pool processes do with each batch of lines in the first
+    pass - the device, inode and path hash of every hardlinked file"""
+    return _find_links(WrstatBlock(data))
+
+
+def _find_links(block: WrstatBlock) -> T.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if len(block) == 0:
+        empty = np.empty(0, dtype=np.uint64)
+        return empty, empty, empty
+
+    linked = np.flatnonzero(_linked(block))
+    paths = block.column(PATH)
+    return (block.ints(DEV, np.uint64)[linked],
+            block.ints(INODE, np.uint64)[linked],
+            path_hashes([paths[i] for i in linked.tolist()]))
+
+
+class HardlinkOwners:
+    """
+    Collects the links found in the first pass, keeping the lowest path
+    hash for each (device, inode). Links are added in batches, and every
+    COMPACT_EVERY of them we boil everything down to one per inode, so it
+    never holds much more than the inodes themselves.
+    """
+
+    def __init__(self) -> None:
+        self._pending: T.List[T.Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._pending_links = 0
+        empty = np.empty(0, dtype=np.uint64)
+        self._devs, self._inodes, self._hashes = empty, empty, empty
+
+    def add(self, links: T.Tuple[np.ndarray, np.ndarray, np.ndarray]) -> None:
+        self._pending.append(links)
+        self._pending_links += len(links[0])
+        if self._pending_links >= COMPACT_EVERY:
+            self._compact()
+
+    def _compact(self) -> None:
+        devs, inodes, hashes = (np.concatenate([column, *(links[i] for links in self._pending)])
+                                for i, column in enumerate((self._devs, self._inodes, self._hashes)))
+        self._pending, self._pending_links = [], 0
+
+        # sorted by inode, then the hash, so the first of each inode is
+        # the one we want
+        order = np.lexsort((hashes, inodes, devs))
+        devs, inodes, hashes = devs[order], inodes[order], hashes[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (devs[1:] != devs[:-1]) | (inodes[1:] != inodes[:-1])
+        self._devs, self._inodes, self._hashes = devs[first], inodes[first], hashes[first]
+
+    def __len__(self) -> int:
+        self._compact()
+        return len(self._inodes)
+
+    def links(self) -> T.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """the lowest hashed link of every inode so far, as something
+        another HardlinkOwners can add - i.e. to put together what
+        different processes found"""
+        self._compact()
+        return self._devs, self._inodes, self._hashes
+
+    def owners(self) -> np.ndarray:
+        """the (sorted) path hashes of the links that count"""
+        self._compact()
+        return np.sort(self._hashes)
+
+
+def counted(block: WrstatBlock, owners: np.ndarray) -> np.ndarray:
+    """which lines in a block count towards usage - anything that isn't a
+    hardlinked file, and the owners of the ones that are"""
+    linked = np.flatnonzero(_linked(block))
+    keep = np.ones(len(block), dtype=bool)
+    if len(linked) == 0:
+        return keep
+    if len(owners) == 0:
+        keep[linked] = False
+        return keep
+
+    paths = block.column(PATH)
+    hashes = path_hashes([paths[i] for i in linked.tolist()])
+    found = np.minimum(np.searchsorted(owners, hashes), len(owners) - 1)
+    keep[linked] = owners[found] == hashes
+    return keep
+
+
+def find_owners(report_path: str, pipeline: SharedMemoryPipeline,
+                metrics: Metrics, stage: str = "hardlink_scan") -> np.ndarray:
+    """the first pass, through a SharedMemoryPipeline (see
+    utils/pipeline.py)"""
+    owners = HardlinkOwners()
+    pipeline.run(report_path, find_links, (), owners.add, metrics, stage)
+    return owners.owners()
+
+
+def scan_owners(report_path: str, metrics: Metrics,
+                stage: str = "hardlink_scan") -> np.ndarray:
+    """the first pass, in this process - for the MPI controllers and
+    backfill, which don't have a pool to do it with"""
+    owners = HardlinkOwners()
+    with metrics.stage(stage) as scan:
+        for block in utils.wrstat.read_blocks(report_path):
+            owners.add(_find_links(block))
+            scan.lines += len(block)
+    return owners.owners()
+
+
+@contextlib.contextmanager
+def shared(owners: np.ndarray) -> T.Iterator[T.Tuple[str, int]]:
+    """puts the owners in shared memory for the pool processes, rather
+    than sending them with every batch
+
+    :returns: the name of the shared memory, and how many owners are in it
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(owners.nbytes, 1))
+    try:
+        shm.buf[:owners.nbytes] = owners.astype("<u8").tobytes()
+        yield shm.name, len(owners)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+# the owners each pool process has been sent, by the name of the shared
+# memory they came in - only read once per process. Only the latest few
+# are kept, as each one is only used for one volume
+_attached: T.Dict[str, np.ndarray] = {}
+_ATTACHED_MAX = 8
+
+
+def attach(name: str, count: int) -> np.ndarray:
+    """the owners from shared(), in a pool process"""
+    if name not in _attached:
+        if len(_attached) >= _ATTACHED_MAX:
+            del _attached[next(iter(_attached))]
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            _attached[name] = np.frombuffer(
+                bytes(shm.buf[:8 * count]), dtype="<u8").astype(np.uint64)
+        finally:
+            shm.close()
+    return _attached[name]
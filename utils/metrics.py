@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import contextlib
+import datetime
+import json
+import os
+import time
+import typing as T
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+
+from directory_config import METRICS_DIR
+
+
+@dataclass
+class StageMetrics:
+    """what we've measured for one stage of a run, in one process"""
+    wall: float = 0.0
+    cpu: float = 0.0
+    calls: int = 0
+    lines: int = 0
+    bytes: int = 0
+    rows: int = 0
+
+    def __iadd__(self, o: StageMetrics) -> StageMetrics:
+        self.wall += o.wall
+        self.cpu += o.cpu
+        self.calls += o.calls
+        self.lines += o.lines
+        self.bytes += o.bytes
+        self.rows += o.rows
+        return self
+
+    @property
+    def summary(self) -> T.Dict[str, float]:
+        summary: T.Dict[str, float] = asdict(self)
+        if self.wall > 0:
+            for unit in ["lines", "bytes", "rows"]:
+                if summary[unit] > 0:
+                    summary[f"{unit}_per_sec"] = round(
+                        summary[unit] / self.wall, 2)
+        return summary
+
+
+class Metrics:
+    """
+    Records wall time, CPU time and throughput (lines, bytes, DB rows) for
+    the stages of a run. Each process (i.e. MPI rank, or pool process) keeps
+    its own, and they're sent back and merged into the main process' Metrics,
+    so the summary has both per-process and total figures.
+
+    Usage:
+        with metrics.stage("read_wrstat") as stage:
+            ...
+            stage.lines += 1
+    """
+
+    def __init__(self, reporter: str, process: str = "main") -> None:
+        self.reporter = reporter
+        self.process = process
+        self.started = time.time()
+        self.processes: T.Dict[str, T.DefaultDict[str, StageMetrics]] = {
+            process: defaultdict(StageMetrics)}
+
+    @property
+    def stages(self) -> T.DefaultDict[str, StageMetrics]:
+        return self.processes[self.process]
+
+    @contextlib.contextmanager
+    def stage(self, name: str, lines: int = 0, bytes: int = 0,
+              rows: int = 0) -> T.Iterator[StageMetrics]:
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield self.stages[name]
+        finally:
+            self.add(name, wall=time.perf_counter() - wall,
+                     cpu=time.process_time() - cpu,
+                     lines=lines, bytes=bytes, rows=rows)
+
+    def add(self, name: str, wall: float = 0.0, cpu: float = 0.0, calls: int = 1,
+            lines: int = 0, bytes: int = 0, rows: int = 0) -> None:
+        self.stages[name] += StageMetrics(wall, cpu, calls, lines, bytes, rows)
+
+    def merge(self, o: Metrics) -> None:
+        """adds another process' metrics into this one"""
+        for process, stages in o.processes.items():
+            ours = self.processes.setdefault(process, defaultdict(StageMetrics))
+            for name, stage in stages.items():
+                ours[name] += stage
+
+    @property
+    def summary(self) -> T.Dict[str, T.Any]:
+        totals: T.DefaultDict[str, StageMetrics] = defaultdict(StageMetrics)
+        for stages in self.processes.values():
+            for name, stage in stages.items():
+                totals[name] += stage
+
+        return {
+            "reporter": self.reporter,
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(),
+            "wall": round(time.time() - self.started, 2),
+            "stages": {name: stage.summary for name, stage in totals.items()},
+            "processes": {
+                process: {name: stage.summary for name, stage in stages.items()}
+                for process, stages in self.processes.items()
+            }
+        }
+
+    def write_summary(self, metrics_dir: str = METRICS_DIR) -> str:
+        """writes the summary as JSON, and returns where it went"""
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, "{}-{}.json".format(
+            self.reporter,
+            datetime.datetime.fromtimestamp(self.started).strftime("%Y%m%d-%H%M%S")))
+
+        with open(path, "w") as f:
+            json.dump(self.summary, f, indent=2)
+
+        return path
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import multiprocessing
+import os
+import time
+import typing as T
+from multiprocessing import shared_memory
+
+import utils.wrstat
+from utils.filters import Filter
+from utils.metrics import Metrics
+
+# how much of the (uncompressed) wrstat file goes in each batch
+BATCH_BYTES = 4 * 2**20
+# room in each shared memory block for the end of the last line
+BATCH_SLACK = 2**20
+
+# The pool processes are started by a fork server, rather than forked from
+# us - run_volumes' pool starts them from one of the reader threads, and
+# forking while the others are holding locks (i.e. logging's or gzip's) can
+# leave a process stuck waiting on one that's never let go of
+_CONTEXT = multiprocessing.get_context("forkserver")
+
+P = T.TypeVar("P")
+R = T.TypeVar("R")
+
+
+def _run_task(task: T.Callable[..., P], shm_name: str, length: int,
+              args: T.Tuple[T.Any, ...], line_filter: T.Optional[Filter] = None) -> P:
+    """what the pool processes actually run - copies a batch of lines out
+    of shared memory and hands them (or just the ones line_filter wants)
+    to the task"""
+    batch = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = bytes(batch.buf[:length])
+    finally:
+        batch.close()
+
+    if line_filter is not None:
+        data = line_filter.apply(data)
+    return task(data, *args)
+
+
+class SharedMemoryPipeline:
+    """
+    Reads a wrstat file in the calling thread and has a process pool do
+    the work on it.
+
+    The file is decompressed in big chunks (cut at the last full line)
+    straight into a ring of shared memory blocks, rather than being split
+    into lines and pickled. Each block is handed to the pool, where `task`
+    gets called with its lines (as bytes - i.e. for a WrstatBlock, see
+    utils/wrstat.py) and whatever `args` we were given. The partial results it returns should be small -
+    i.e. arrays rather than lots of objects - as they're pickled on the way
+    back. They're passed to `merge` in the calling thread, in the same
+    order the lines were in the file, and then the block can be reused.
+
+    A pool can be shared by lots of pipelines (i.e. one per volume, see
+    run_volumes), each having up to `batches_in_flight` blocks with it at
+    once.
+    """
+
+    def __init__(self, pool: concurrent.futures.Executor, batch_bytes: int = BATCH_BYTES,
+                 batches_in_flight: int = 2) -> None:
+        self.pool = pool
+        self.batch_bytes = batch_bytes
+        self.batches_in_flight = batches_in_flight
+
+    def run(self, report_path: str, task: T.Callable[..., P], args: T.Tuple[T.Any, ...],
+            merge: T.Callable[[P], None], metrics: Metrics, stage: str,
+            offset: int = 0, lines: int = 0,
+            checkpoint_due: T.Optional[T.Callable[[], bool]] = None,
+            save_checkpoint: T.Optional[T.Callable[[int, int], None]] = None,
+            line_filter: T.Optional[Filter] = None,
+            sample: T.Optional[T.Callable[[int], bool]] = None,
+            unsampled: T.Optional[T.Callable[..., P]] = None) -> T.Tuple[int, int]:
+        """
+        Goes through a wrstat file, from offset bytes into the uncompressed
+        data. `task` has to be a module level function, so it can be pickled.
+
+        If there's a line_filter, the lines it doesn't want are dropped in
+        the pool process before `task` sees them (see utils/filters.py).
+        It's sent with every batch, so it should be small.
+
+        If there's a sample, it's called with the number of each batch (from
+        0), and only the ones it says yes to go to `task` - the rest go to
+        `unsampled` instead (with the same args), or if there isn't one,
+        are just read past (see utils/sampling.py).
+
+        If checkpoint_due says it's time, everything up to the current
+        offset is merged, and save_checkpoint gets called with how far
+        through the file we are (in bytes and lines).
+
+        The time spent reading the file goes in metrics as `stage`, and the
+        time spent waiting for the pool as "wait_for_workers".
+
+        :returns: how far through the file we got, in bytes and lines
+        """
+        ring = [shared_memory.SharedMemory(create=True, size=self.batch_bytes + BATCH_SLACK)
+                for _ in range(self.batches_in_flight)]
+        free = list(range(len(ring)))
+        # (future, block), oldest first
+        pending: T.Deque[T.Tuple[concurrent.futures.Future, int]] = collections.deque()
+        resumed_lines = lines
+
+        def collect_oldest() -> None:
+            future, block = pending.popleft()
+            merge(future.result())
+            free.append(block)
+
+        _read_start = (time.perf_counter(), time.process_time())
+        _wait_time = 0.0
+        try:
+            with gzip.open(report_path, "rb") as wrstat:
+                if offset > 0:
+                    wrstat.seek(offset)
+
+                for number, batch in enumerate(
+                        utils.wrstat.read_chunks(wrstat, self.batch_bytes, BATCH_SLACK)):
+                    batch_task = task
+                    if sample is not None and not sample(number):
+                        if unsampled is None:
+                            offset += len(batch)
+                            lines += batch.count(b"\n")
+                            continue
+                        batch_task = unsampled
+
+                    if len(free) == 0:
+                        _wait_start = time.perf_counter()
+                        collect_oldest()
+                        _wait_time += time.perf_counter() - _wait_start
+
+                    block = free.pop()
+                    ring[block].buf[:len(batch)] = batch
+                    pending.append((self.pool.submit(
+                        _run_task, batch_task, ring[block].name, len(batch), args, line_filter), block))
+                    offset += len(batch)
+                    lines += batch.count(b"\n")
+
+                    if checkpoint_due is not None and save_checkpoint is not None \
+                            and checkpoint_due():
+                        # everything up to offset has to be merged before
+                        # it's saved
+                        while len(pending) > 0:
+                            collect_oldest()
+                        save_checkpoint(offset, lines)
+
+                _wait_start = time.perf_counter()
+                while len(pending) > 0:
+                    collect_oldest()
+                _wait_time += time.perf_counter() - _wait_start
+        finally:
+            for future, _ in pending:
+                future.cancel()
+            concurrent.futures.wait([future for future, _ in pending])
+            for shm in ring:
+                shm.close()
+                shm.unlink()
+
+        metrics.add(stage,
+                    wall=time.perf_counter() - _read_start[0] - _wait_time,
+                    cpu=time.process_time() - _read_start[1],
+                    lines=lines - resumed_lines, bytes=os.path.getsize(report_path))
+        metrics.add("wait_for_workers", wall=_wait_time)
+
+        return offset, lines
+
+
+def run_volumes(fn: T.Callable[[int, SharedMemoryPipeline], R], volumes: T.Sequence[int],
+                processes: T.Optional[int] = None, batch_bytes: int = BATCH_BYTES,
+                initializer: T.Optional[T.Callable[..., None]] = None,
+                initargs: T.Tuple[T.Any, ...] = ()) -> T.List[R]:
+    """
+    Runs fn for every volume at once, each in its own thread with its own
+    SharedMemoryPipeline, all sharing one pool of processes (defaulting to
+    one per CPU) - so we're not stuck with a process per volume.
+
+    :returns: what fn returned for each volume, in the same order
+    """
+    processes = processes or os.cpu_count() or 1
+    # enough to keep every process busy, with another one ready to go
+    in_flight = max(2, 2 * processes // max(len(volumes), 1))
+
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=_CONTEXT, initializer=initializer,
+            initargs=initargs) as pool, \
+            concurrent.futures.ThreadPoolExecutor(max(len(volumes), 1)) as readers:
+        return list(readers.map(
+            lambda volume: fn(volume, SharedMemoryPipeline(pool, batch_bytes, in_flight)),
+            volumes))
+
+
+@contextlib.contextmanager
+def local_pipeline(processes: T.Optional[int] = None,
+                   initializer: T.Optional[T.Callable[..., None]] = None,
+                   initargs: T.Tuple[T.Any, ...] = ()) -> T.Iterator[SharedMemoryPipeline]:
+    """a SharedMemoryPipeline with a process pool all to itself, for when
+    we're only reading the one file"""
+    processes = processes or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=_CONTEXT, initializer=initializer,
+            initargs=initargs) as pool:
+        yield SharedMemoryPipeline(pool, batches_in_flight=2 * processes)
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import bisect
+import glob
+import logging
+import os
+import threading
+import time
+import typing as T
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from directory_config import EXPORT_DIR
+from utils.symlink import get_mdt_symlink
+
+# Serves the latest night's exports (see utils/export.py) from memory, so
+# dashboards don't have to query MySQL. Each dataset is kept as an Arrow
+# table (columnar, so it's about the size of the Parquet files), with
+# indexes that are just numpy arrays of row numbers for each value of the
+# columns people look things up by, and a sorted list of paths for prefix
+# lookups.
+#
+# The dataset: (the columns it's indexed by, the column its paths are in)
+DATASETS: T.Dict[str, T.Tuple[T.Tuple[str, ...], T.Optional[str]]] = {
+    "group_usage": (("group_name", "pi_name", "volume"), "directory_path"),
+    "directory_usage": (("group_name", "pi_name", "volume"), "subdir"),
+    "top_files": (("group_name", "pi_name", "volume", "kind"), "path"),
+    "user_usage": (("username", "group_name", "volume"), None),
+    "vault_usage": (("owner", "group_name", "volume"), "full_path")
+}
+
+_NO_ROWS = np.empty(0, dtype=np.int64)
+
+logger = logging.getLogger(__name__)
+
+
+def _latest_partitions(export_dir: str, dataset: str) -> T.Tuple[T.Optional[str], T.List[str]]:
+    """the most recent date in a dataset, and the Parquet files for it"""
+    dates = sorted(glob.glob(f"{export_dir}{dataset}/date=*"))
+    if len(dates) == 0:
+        return None, []
+    return dates[-1].split("date=")[-1], sorted(glob.glob(f"{dates[-1]}/volume=*/part-0.parquet"))
+
+
+class Dataset:
+    """one day of one dataset, indexed"""
+
+    def __init__(self, name: str, date: T.Optional[str], paths: T.List[str]) -> None:
+        self.name = name
+        self.date = date
+        indexed, path_column = DATASETS[name]
+
+        tables: T.List[pa.Table] = []
+        for path in paths:
+            table = pq.read_table(path)
+            volume = int(path.split("volume=scratch")[-1].split("/")[0])
+            tables.append(table.append_column(
+                "volume", pa.array([volume] * table.num_rows, pa.int64())))
+        self.table: T.Optional[pa.Table] = pa.concat_tables(tables) if len(tables) > 0 else None
+
+        self._indexes: T.Dict[str, T.Dict[T.Any, np.ndarray]] = {
+            column: self._index(column) for column in indexed}
+
+        # (path, row) sorted by path
+        self._paths: T.List[str] = []
+        self._path_rows = _NO_ROWS
+        if self.table is not None and path_column is not None:
+            paths_by_row = self._path_column(path_column)
+            order = sorted(range(len(paths_by_row)), key=paths_by_row.__getitem__)
+            self._paths = [paths_by_row[i] for i in order]
+            self._path_rows = np.array(order, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.table.num_rows if self.table is not None else 0
+
+    def _path_column(self, column: str) -> T.List[str]:
+        assert self.table is not None
+        if column == "subdir":
+            # subdirectories only have their base path (as the MDT path)
+            # and the part under it
+            return [f"{get_mdt_symlink(base or '')}/{subdir}" for base, subdir in zip(
+                self.table.column("base_path").to_pylist(),
+                self.table.column("subdir").to_pylist())]
+        return [get_mdt_symlink(path or "") for path in self.table.column(column).to_pylist()]
+
+    def _index(self, column: str) -> T.Dict[T.Any, np.ndarray]:
+        """value -> the (sorted) rows it's in"""
+        if self.table is None:
+            return {}
+
+        encoded = self.table.column(column).combine_chunks().dictionary_encode()
+        codes = encoded.indices.to_numpy(zero_copy_only=False)
+        # nulls end up as NaNs - they can't be looked up anyway
+        valid = ~np.isnan(codes) if codes.dtype.kind == "f" else np.ones(len(codes), dtype=bool)
+        codes = np.where(valid, codes, -1).astype(np.int64)
+
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes[valid], minlength=len(encoded.dictionary))
+        starts = np.concatenate(([0], np.cumsum(counts)))[:-1] + np.count_nonzero(~valid)
+
+        return {
+            value: order[start:start + count]
+            for value, start, count in zip(encoded.dictionary.to_pylist(), starts.tolist(), counts.tolist())
+        }
+
+    def rows(self, prefix: T.Optional[str] = None, **filters: T.Any) -> T.List[T.Dict[str, T.Any]]:
+        """
+        The rows matching every filter (column=value, for the indexed
+        columns) and whose path starts with prefix.
+
+        :raises KeyError: if a filter isn't for an indexed column
+        """
+        if self.table is None:
+            return []
+
+        selected: T.Optional[np.ndarray] = None
+        for column, value in filters.items():
+            if value is None:
+                continue
+            if column not in self._indexes:
+                raise KeyError(f"{self.name} can't be looked up by {column}")
+
+            found = self._indexes[column].get(value, _NO_ROWS)
+            selected = found if selected is None else np.intersect1d(
+                selected, found, assume_unique=True)
+
+        if prefix is not None:
+            start = bisect.bisect_left(self._paths, prefix)
+            end = bisect.bisect_left(self._paths, prefix + "\U0010ffff", start)
+            found = np.sort(self._path_rows[start:end])
+            selected = found if selected is None else np.intersect1d(
+                selected, found, assume_unique=True)
+
+        if selected is None:
+            return self.table.to_pylist()
+        return self.table.take(selected).to_pylist()
+
+
+class Snapshot:
+    """the latest day of every dataset, all loaded at once"""
+
+    def __init__(self, export_dir: str = EXPORT_DIR) -> None:
+        self.loaded_at = time.time()
+        self.datasets: T.Dict[str, Dataset] = {}
+        self.signature = signature(export_dir)
+        for name in DATASETS:
+            date, paths = _latest_partitions(export_dir, name)
+            self.datasets[name] = Dataset(name, date, paths)
+
+    def __getitem__(self, name: str) -> Dataset:
+        return self.datasets[name]
+
+    @property
+    def status(self) -> T.Dict[str, T.Any]:
+        return {
+            "loaded_at": self.loaded_at,
+            "datasets": {name: {"date": dataset.date, "rows": len(dataset)}
+                         for name, dataset in self.datasets.items()}
+        }
+
+
+def signature(export_dir: str = EXPORT_DIR) -> T.Tuple[T.Tuple[str, float, int], ...]:
+    """what the latest partitions look like on disk - if this changes,
+    there's a new run"""
+    found: T.List[T.Tuple[str, float, int]] = []
+    for name in DATASETS:
+        for path in _latest_partitions(export_dir, name)[1]:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append((path, stat.st_mtime, stat.st_size))
+    return tuple(found)
+
+
+class QueryService:
+    """
+    Answers queries from the latest Snapshot.
+
+    Reloading builds a whole new Snapshot before swapping it in, so a
+    query either sees the old run or the new one, never a bit of both, and
+    queries carry on against the old one while it's loading.
+    """
+
+    def __init__(self, export_dir: str = EXPORT_DIR) -> None:
+        self.export_dir = export_dir
+        self._reload_lock = threading.Lock()
+        self._snapshot = Snapshot(export_dir)
+
+    @property
+    def snapshot(self) -> Snapshot:
+        return self._snapshot
+
+    def reload(self, force: bool = False) -> bool:
+        """loads the exports again if there's been a new run (or if forced)
+
+        :returns: whether anything was loaded
+        """
+        with self._reload_lock:
+            if not force and signature(self.export_dir) == self._snapshot.signature:
+                return False
+            self._snapshot = Snapshot(self.export_dir)
+            return True
+
+    def watch(self, interval: int, stop: T.Optional[threading.Event] = None) -> None:
+        """
+        Checks for a new run every interval seconds until stop is set. The
+        volumes of a run are exported one at a time, so it only reloads once
+        the exports haven't changed since the last check.
+
+        If it can't load them (i.e. a partition was removed part way
+        through), that's logged, the old Snapshot stays, and it tries again
+        at the next check.
+        """
+        stop = stop or threading.Event()
+        seen = self._snapshot.signature
+        while not stop.wait(interval):
+            try:
+                current = signature(self.export_dir)
+                if current != seen:
+                    seen = current
+                elif current != self._snapshot.signature:
+                    self.reload()
+            except Exception:
+                logger.exception(f"couldn't reload the exports from {self.export_dir}")
+
+    def groups(self, group: T.Optional[str] = None, pi: T.Optional[str] = None,
+               volume: T.Optional[int] = None,
+               prefix: T.Optional[str] = None) -> T.List[T.Dict[str, T.Any]]:
+        return self._snapshot["group_usage"].rows(
+            prefix, group_name=group, pi_name=pi, volume=volume)
+
+    def directories(self, group: T.Optional[str] = None, pi: T.Optional[str] = None,
+                    volume: T.Optional[int] = None,
+                    prefix: T.Optional[str] = None) -> T.List[T.Dict[str, T.Any]]:
+        return self._snapshot["directory_usage"].rows(
+            prefix, group_name=group, pi_name=pi, volume=volume)
+
+    def top_files(self, group: T.Optional[str] = None, pi: T.Optional[str] = None,
+                  volume: T.Optional[int] = None, kind: T.Optional[str] = None,
+                  prefix: T.Optional[str] = None) -> T.List[T.Dict[str, T.Any]]:
+        return self._snapshot["top_files"].rows(
+            prefix, group_name=group, pi_name=pi, volume=volume, kind=kind)
+
+    def users(self, user: T.Optional[str] = None, group: T.Optional[str] = None,
+              volume: T.Optional[int] = None) -> T.List[T.Dict[str, T.Any]]:
+        return self._snapshot["user_usage"].rows(
+            username=user, group_name=group, volume=volume)
+
+    def vaults(self, user: T.Optional[str] = None, group: T.Optional[str] = None,
+               volume: T.Optional[int] = None,
+               prefix: T.Optional[str] = None) -> T.List[T.Dict[str, T.Any]]:
+        return self._snapshot["vault_usage"].rows(
+            prefix, owner=user, group_name=group, volume=volume)
@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import csv
+import datetime
+import logging
+import logging.config
+import math
+import os
+import random
+import re
+import typing as T
+from dataclasses import dataclass
+
+import numpy as np
+
+import utils.finder
+import utils.ldap
+import utils.pipeline
+from directory_config import (ESTIMATES_DIR, LOGGING_CONFIG, SAMPLE_BATCH_BYTES,
+                              SAMPLE_EXACT_SIZE, SAMPLE_PER_STRATUM, SAMPLE_STRATUM_BLOCKS,
+                              VOLUMES, WRSTAT_DIR)
+from utils.metrics import Metrics
+from utils.pipeline import SharedMemoryPipeline
+from utils.wrstat import GID, NLINK, SIZE, TYPE, UID, WrstatBlock
+
+# Stratified sampling (group_reporter.py --sample and user_reporter.py --sample)
+#
+# A full run takes hours, so for a rough idea of where a volume's at, we can
+# estimate each group's (or user's) usage from some of the wrstat file
+# instead. A gzip file can only be read from the start, so the whole file
+# still gets decompressed, but that's the quick part - only the sampled
+# blocks are split into columns and totalled up, by the pool processes.
+#
+# The blocks are split into strata of SAMPLE_STRATUM_BLOCKS in a row, and
+# SAMPLE_PER_STRATUM of each are picked at random. Nearby lines in a wrstat
+# file are from the same part of the tree, so this gets us a bit of every
+# part of it, rather than (by chance) lots of some and none of others. The
+# first stratum is read in full, so small files come out exact.
+#
+# A few huge files can be most of a volume, and whether a sample happens
+# to have them would make or break the estimate - so files of at least
+# SAMPLE_EXACT_SIZE are counted exactly. They're picked out of the blocks
+# we're not sampling by a regex on the size column, without splitting the
+# lines up, which is about as quick as decompressing them.
+#
+# For everything else, each group's total for a stratum is estimated from
+# the mean of its sampled blocks, and its variance from how much they vary,
+# and these are added up over the strata (the usual stratified estimator).
+# The error bounds are 1.96 standard errors either way - 95%, if sizes were
+# better behaved than they are, so take them as a rough guide.
+
+Z = 1.96
+
+# what we can estimate by, and the wrstat column it's in
+COLUMNS = {"group": GID, "user": UID}
+
+# columns of id, total size and number of files
+Totals = T.Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+@dataclass(frozen=True)
+class Estimate:
+    size: float
+    size_error: float
+    files: float
+    files_error: float
+
+
+class BlockSample:
+    """
+    Decides which blocks of a file to read, as they come (see
+    SharedMemoryPipeline.run), and remembers which it picked. It doesn't
+    need to know how many there'll be.
+    """
+
+    def __init__(self, stratum_blocks: int = SAMPLE_STRATUM_BLOCKS,
+                 per_stratum: int = SAMPLE_PER_STRATUM, seed: T.Optional[int] = None) -> None:
+        self.stratum_blocks = stratum_blocks
+        self.per_stratum = min(per_stratum, stratum_blocks)
+        self.blocks = 0
+        self.chosen: T.List[int] = []
+
+        self._rng = random.Random(seed)
+        self._picks: T.Set[int] = set()
+
+    def __call__(self, block: int) -> bool:
+        self.blocks = block + 1
+        stratum, position = divmod(block, self.stratum_blocks)
+        if stratum > 0 and position == 0:
+            self._picks = set(self._rng.sample(range(self.stratum_blocks), self.per_stratum))
+
+        if stratum == 0 or position in self._picks:
+            self.chosen.append(block)
+            return True
+        return False
+
+    def strata(self) -> T.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :returns: the stratum of each chosen block, and how many blocks
+            are in each stratum, and how many of them we read
+        """
+        sizes = [min(self.stratum_blocks, self.blocks - start)
+                 for start in range(0, self.blocks, self.stratum_blocks)]
+        strata = np.array(self.chosen, dtype=np.int64) // self.stratum_blocks
+        counts = np.bincount(strata, minlength=len(sizes)).tolist()
+
+        # the last stratum can be cut short before we got to its blocks. If
+        # we didn't read it all, we need at least two of its blocks to see
+        # how much they vary, so if we haven't got them, it goes in with
+        # the one before
+        merged = list(range(len(sizes)))
+        for stratum in range(1, len(sizes)):
+            if counts[stratum] < 2 and counts[stratum] < sizes[stratum]:
+                merged[stratum] = merged[stratum - 1]
+
+        labels, merged_strata = np.unique(merged, return_inverse=True)
+        merged_sizes = np.bincount(merged_strata, weights=sizes, minlength=len(labels))
+        merged_counts = np.bincount(merged_strata, weights=counts, minlength=len(labels))
+        return merged_strata[strata], merged_sizes, merged_counts
+
+
+def _totals(block: WrstatBlock, column: int, rows: np.ndarray) -> Totals:
+    """the total size (each link to a file counting for size // nlink of
+    it, as usual) and number of files of some rows of a block, for each
+    value of column (i.e. group id)"""
+    sizes = block.ints(SIZE)[rows]
+    nlinks = block.ints(NLINK)[rows]
+    shares = np.zeros_like(sizes)
+    np.floor_divide(sizes, nlinks, out=shares, where=nlinks != 0)
+
+    keys, which = np.unique(block.ints(column)[rows], return_inverse=True)
+    totals = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(totals, which, shares)
+    files = np.bincount(which, weights=np.array(block.column(TYPE))[rows] == b"f",
+                        minlength=len(keys)).astype(np.int64)
+    return keys, totals, files
+
+
+def _sum_by(data: bytes, column: int, exact_size: int) -> T.Tuple[T.Optional[Totals], Totals]:
+    """what the pool processes do with each sampled block - the totals for
+    the files smaller than exact_size, and for the rest"""
+    block = WrstatBlock(data)
+    exact = block.ints(SIZE) >= exact_size
+    return _totals(block, column, ~exact), _totals(block, column, exact)
+
+
+_EXACT_PATTERNS: T.Dict[int, T.Pattern[bytes]] = {}
+
+
+def _exact_only(data: bytes, column: int, exact_size: int) -> T.Tuple[T.Optional[Totals], Totals]:
+    """what the pool processes do with the other blocks - just the totals
+    for the files of at least exact_size. They're found by looking for a
+    size with at least as many digits, straight after a path at the start
+    of a line, so the rest of the lines never get split up"""
+    if exact_size not in _EXACT_PATTERNS:
+        _EXACT_PATTERNS[exact_size] = re.compile(
+            b"\n[^\t\n]*\t[0-9]{%d,}\t" % len(str(exact_size)))
+
+    # every line starts after a newline - where the newline is in here is
+    # where the line starts in data
+    lines: T.List[bytes] = []
+    for match in _EXACT_PATTERNS[exact_size].finditer(b"\n" + data):
+        end = data.find(b"\n", match.start())
+        lines.append(data[match.start():end if end >= 0 else len(data)])
+
+    block = WrstatBlock(b"\n".join(lines))
+    return None, _totals(block, column, block.ints(SIZE) >= exact_size)
+
+
+def estimate(sample: BlockSample, results: T.List[Totals],
+             exact: T.List[Totals]) -> T.Dict[int, Estimate]:
+    """the estimates for everything, from the totals for the smaller files
+    in each sampled block (in the same order as sample.chosen) and the
+    totals for the files we counted exactly"""
+    exact_keys = np.concatenate([np.empty(0, dtype=np.int64), *(keys for keys, _, _ in exact)])
+    keys, which = np.unique(np.concatenate(
+        [exact_keys, *(keys for keys, _, _ in results)]), return_inverse=True)
+    exact_which, which = which[:len(exact_keys)], which[len(exact_keys):]
+
+    totals: T.Dict[str, np.ndarray] = {}
+    variances: T.Dict[str, np.ndarray] = {}
+    block_strata, sizes, counts = sample.strata()
+    entry_strata = np.repeat(block_strata, [len(keys) for keys, _, _ in results]) \
+        if len(results) > 0 else np.empty(0, dtype=np.int64)
+
+    for measure, i in (("size", 1), ("files", 2)):
+        totals[measure] = np.bincount(exact_which, weights=np.concatenate(
+            [np.empty(0), *(result[i] for result in exact)]), minlength=len(keys))
+        variances[measure] = np.zeros(len(keys))
+
+        values = np.concatenate([np.empty(0), *(result[i] for result in results)])
+        for stratum in range(len(sizes)):
+            in_stratum = entry_strata == stratum
+            # blocks that didn't have a key count as 0 for it
+            total = np.bincount(which[in_stratum], weights=values[in_stratum], minlength=len(keys))
+            squares = np.bincount(which[in_stratum], weights=values[in_stratum] ** 2,
+                                  minlength=len(keys))
+            read, blocks = counts[stratum], sizes[stratum]
+
+            totals[measure] += blocks * total / read
+            if read > 1 and read < blocks:
+                variance = np.maximum(squares - total ** 2 / read, 0) / (read - 1)
+                variances[measure] += blocks ** 2 * (1 - read / blocks) * variance / read
+
+    return {key: Estimate(
+        size=totals["size"][i], size_error=Z * math.sqrt(variances["size"][i]),
+        files=totals["files"][i], files_error=Z * math.sqrt(variances["files"][i]))
+        for i, key in enumerate(keys.tolist())}
+
+
+def estimate_volume(volume: int, by: str, logger: logging.Logger,
+                    pipeline: SharedMemoryPipeline, seed: T.Optional[int] = None
+                    ) -> T.Tuple[datetime.date, T.Dict[int, Estimate], BlockSample, Metrics]:
+    """Estimates usage by group or user ("group" or "user") from a sample of
+    the latest wrstat file for a volume
+
+    :returns: the date of the wrstat file, the estimates by group or user
+        id, the BlockSample and the Metrics for this volume
+    """
+    metrics = Metrics(f"{by}_sample", f"Volume {volume}")
+
+    with metrics.stage("find_report"):
+        report_path = utils.finder.find_report(f"scratch{volume}", WRSTAT_DIR, logger)
+    wr_date_str = report_path.split("/")[-1].split("_")[0]
+    wr_date = datetime.date(int(wr_date_str[:4]), int(
+        wr_date_str[4:6]), int(wr_date_str[6:8]))
+
+    sample = BlockSample(seed=seed)
+    results: T.List[Totals] = []
+    exact: T.List[Totals] = []
+
+    def merge(found: T.Tuple[T.Optional[Totals], Totals]) -> None:
+        sampled, exact_totals = found
+        if sampled is not None:
+            results.append(sampled)
+        exact.append(exact_totals)
+
+    _, lines_read = pipeline.run(
+        report_path, _sum_by, (COLUMNS[by], SAMPLE_EXACT_SIZE), merge, metrics, "sample_wrstat",
+        sample=sample, unsampled=_exact_only)
+    logger.debug(f"Read {lines_read} lines from {volume}, "
+                 f"and totalled up {len(sample.chosen)} of {sample.blocks} blocks")
+
+    with metrics.stage("estimate"):
+        estimates = estimate(sample, results, exact)
+
+    logger.info(f"Finished sampling {volume}")
+    return wr_date, estimates, sample, metrics
+
+
+def write_estimates(path: str, by: str, volume: int, wr_date: datetime.date,
+                    estimates: T.Dict[int, Estimate], names: T.Dict[int, str],
+                    sample: BlockSample) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+        writer.writerow(["volume", "wrstat_date", f"{by}_id", f"{by}_name", "size",
+                         "size_error", "files", "files_error", "blocks_read", "blocks"])
+        for key, found in sorted(estimates.items(), key=lambda item: -item[1].size):
+            writer.writerow([
+                volume, wr_date.isoformat(), key, names.get(key, "-"),
+                round(found.size), round(found.size_error),
+                round(found.files), round(found.files_error),
+                len(sample.chosen), sample.blocks])
+
+
+def main(by: str, volumes: T.List[int] = VOLUMES, processes: T.Optional[int] = None) -> None:
+    """estimates usage by group or user ("group" or "user") for every volume,
+    and writes them to ESTIMATES_DIR, under when we started"""
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+    metrics = Metrics(f"{by}_sample")
+    started = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    # every volume is read at once, sharing a pool of processes, in smaller
+    # blocks than usual so there are more of them to pick from
+    with metrics.stage("wait_for_volumes"):
+        results = utils.pipeline.run_volumes(
+            lambda volume, pipeline: estimate_volume(volume, by, logger, pipeline),
+            volumes, processes, SAMPLE_BATCH_BYTES)
+
+    with metrics.stage("ldap"):
+        ldap_conn = utils.ldap.get_ldap_connection()
+        names: T.Dict[int, str] = {}
+        if by == "group":
+            _, groups = utils.ldap.get_groups_ldap_info(ldap_conn)
+            names = {int(gid): name for gid, name in groups.items()}
+        else:
+            for uid in {uid for _, estimates, _, _ in results for uid in estimates}:
+                names[uid] = utils.ldap.get_username(ldap_conn, uid)
+
+    for volume, (wr_date, estimates, sample, volume_metrics) in zip(volumes, results):
+        metrics.merge(volume_metrics)
+        path = f"{ESTIMATES_DIR}{started}/scratch{volume}.{by}s.tsv"
+        write_estimates(path, by, volume, wr_date, estimates, names, sample)
+        logger.info(f"wrote {len(estimates)} {by} estimates for scratch{volume} to {path}")
+
+    logger.info(f"run metrics written to {metrics.write_summary()}")
@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+import os
+import struct
+import typing as T
+from collections import defaultdict
+from dataclasses import dataclass
+
+import numpy as np
+
+from utils.blockfile import atomic_write
+from utils.wrstat import MTIME, PATH, SIZE, TYPE, decode_path, read_blocks
+
+# Tree snapshots (see group_splitter.py)
+#
+# If the splitter's asked for them, it writes a snapshot of each group's
+# directory tree next to its lines:
+#     {REPORT_DIR}groups/20220601/{group}.tree
+#
+# so a tree browser can load the tree as it is, rather than building it from
+# the lines every time. Only directories are in it - each one's totals
+# (size, number of files, number of directories and latest mtime) are for
+# everything under it, so nothing needs adding up when it's loaded.
+#
+# The file's a fixed size header, then a table of nodes (NODE, one per
+# directory), then their names:
+#   - the nodes are in breadth first order, so every directory's children
+#     are next to each other in the table, sorted by name - each node just
+#     says where its first child is and how many there are
+#   - names are UTF-8, and each node says where its name is in the names
+#   - the root is node 0, and is /
+#
+# Everything's little endian and fixed size, so the whole file can be
+# memory mapped, and looked at in place (TreeSnapshot). It takes as much
+# memory as the file's size.
+
+MAGIC = b"LURGESNAP1\n"
+# magic (padded), nodes, where the nodes start, where the names start, and
+# how long the names are
+_HEADER = struct.Struct("<16sQQQQ")
+_HEADER_BYTES = 64
+
+NODE = np.dtype([
+    ("parent", "<i8"),
+    ("first_child", "<i8"),
+    ("children", "<i8"),
+    ("name_offset", "<i8"),
+    ("name_length", "<i8"),
+    ("size", "<u8"),
+    ("files", "<u8"),
+    ("directories", "<u8"),
+    ("mtime", "<i8")
+])
+
+
+@dataclass(frozen=True)
+class SnapshotNode:
+    path: str
+    size: int
+    files: int
+    directories: int
+    mtime: int
+
+
+def _parent(path: str) -> str:
+    return os.path.dirname(path) or "/"
+
+
+def _name(path: str) -> bytes:
+    return os.path.basename(path).encode("UTF-8")
+
+
+def build_snapshot(data_path: str) -> T.Tuple[np.ndarray, bytes]:
+    """the node table and names for the lines in data_path (a gzipped file
+    of wrstat lines, i.e. one of the splitter's)"""
+    # each directory's own [size, files, mtime] - what's directly in it
+    own: T.Dict[str, T.List[int]] = {}
+    for block in read_blocks(data_path):
+        for encoded, file_type, size, mtime in zip(
+                block.column(PATH), block.column(TYPE),
+                block.ints(SIZE).tolist(), block.ints(MTIME).tolist()):
+            path = decode_path(encoded).rstrip("/") or "/"
+            if file_type == b"d":
+                stats = own.setdefault(path, [0, 0, 0])
+            else:
+                stats = own.setdefault(_parent(path), [0, 0, 0])
+                stats[0] += size
+                stats[1] += 1
+            stats[2] = max(stats[2], mtime)
+
+    # every directory on the way down to them, even if we haven't got a
+    # line for it
+    own.setdefault("/", [0, 0, 0])
+    for path in list(own):
+        while path != "/" and _parent(path) not in own:
+            path = _parent(path)
+            own[path] = [0, 0, 0]
+
+    # totals for everything under each directory, deepest first
+    totals = {path: [*stats, 0] for path, stats in own.items()}
+    children: T.DefaultDict[str, T.List[str]] = defaultdict(list)
+    for path in sorted(totals, key=lambda path: path.count("/"), reverse=True):
+        if path == "/":
+            continue
+        parent, total = totals[_parent(path)], totals[path]
+        parent[0] += total[0]
+        parent[1] += total[1]
+        parent[2] = max(parent[2], total[2])
+        parent[3] += total[3] + 1
+        children[_parent(path)].append(path)
+
+    # breadth first, so each directory's children are all together
+    order = ["/"]
+    parents = [-1]
+    first_children: T.List[int] = []
+    for i, path in enumerate(order):
+        first_children.append(len(order))
+        for child in sorted(children[path], key=_name):
+            order.append(child)
+            parents.append(i)
+
+    names = [_name(path) if path != "/" else b"" for path in order]
+    nodes = np.zeros(len(order), dtype=NODE)
+    nodes["parent"] = parents
+    nodes["first_child"] = first_children
+    nodes["children"] = [len(children[path]) for path in order]
+    nodes["name_length"] = [len(name) for name in names]
+    nodes["name_offset"] = np.cumsum(nodes["name_length"]) - nodes["name_length"]
+    for column, i in (("size", 0), ("files", 1), ("mtime", 2), ("directories", 3)):
+        nodes[column] = [totals[path][i] for path in order]
+
+    return nodes, b"".join(names)
+
+
+def write_snapshot(data_path: str, snapshot_path: str) -> int:
+    """builds a snapshot of the tree in data_path, and writes it to
+    snapshot_path (see utils/blockfile.atomic_write)
+
+    :returns: the size of the snapshot, which is how much memory it'll take
+    """
+    nodes, names = build_snapshot(data_path)
+
+    with atomic_write(snapshot_path) as f:
+        names_offset = _HEADER_BYTES + nodes.nbytes
+        f.write(_HEADER.pack(MAGIC, len(nodes), _HEADER_BYTES,
+                             names_offset, len(names)).ljust(_HEADER_BYTES, b"\0"))
+        f.write(nodes.tobytes())
+        f.write(names)
+
+    return names_offset + len(names)
+
+
+class TreeSnapshot:
+    """
+    A snapshot written by write_snapshot, memory mapped - nothing's read
+    until it's looked at. Nodes are referred to by where they are in the
+    table, and the root is 0.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+
+        magic, count, nodes_offset, names_offset, names_length = _HEADER.unpack(
+            bytes(self._map[:_HEADER.size]))
+        if magic.rstrip(b"\0") != MAGIC:
+            raise ValueError(f"{path} isn't a tree snapshot")
+
+        self.nodes: np.ndarray = self._map[nodes_offset:nodes_offset + count * NODE.itemsize].view(NODE)
+        self._names = self._map[names_offset:names_offset + names_length]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def _name(self, node: int) -> bytes:
+        offset = int(self.nodes["name_offset"][node])
+        return bytes(self._names[offset:offset + int(self.nodes["name_length"][node])])
+
+    def name(self, node: int) -> str:
+        return self._name(node).decode("UTF-8")
+
+    def full_path(self, node: int) -> str:
+        names: T.List[str] = []
+        while node > 0:
+            names.append(self.name(node))
+            node = int(self.nodes["parent"][node])
+        return "/" + "/".join(reversed(names))
+
+    def children(self, node: int) -> range:
+        first = int(self.nodes["first_child"][node])
+        return range(first, first + int(self.nodes["children"][node]))
+
+    def find(self, path: str) -> T.Optional[int]:
+        """the node for a directory, if it's in the snapshot"""
+        node = 0
+        for name in [part for part in path.split("/") if part]:
+            wanted = name.encode("UTF-8")
+            # children are sorted by name, so we can bisect them
+            children = self.children(node)
+            low, high = children.start, children.stop
+            while low < high:
+                middle = (low + high) // 2
+                if self._name(middle) < wanted:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low == children.stop or self._name(low) != wanted:
+                return None
+            node = low
+        return node
+
+    def node(self, node: int) -> SnapshotNode:
+        record = self.nodes[node]
+        return SnapshotNode(
+            path=self.full_path(node),
+            size=int(record["size"]),
+            files=int(record["files"]),
+            directories=int(record["directories"]),
+            mtime=int(record["mtime"]))
+
+
+if __name__ == "__main__":
+    """
+    Looks at a tree snapshot, i.e.:
+        python -m utils.snapshot groups/20220601/hgi.tree /lustre/scratch123/hgi
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("snapshot")
+    parser.add_argument("path", nargs="?", default="/")
+    args = parser.parse_args()
+
+    snapshot = TreeSnapshot(args.snapshot)
+    found = snapshot.find(args.path)
+    if found is None:
+        raise SystemExit(f"{args.path} isn't in {args.snapshot}")
+
+    for node in [found, *snapshot.children(found)]:
+        entry = snapshot.node(node)
+        print("\t".join([
+            entry.path, str(entry.size), str(entry.files), str(entry.directories),
+            datetime.date.fromtimestamp(entry.mtime).isoformat()]))
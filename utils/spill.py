@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import typing as T
+
+from directory_config import SPILL_DIR, SPILL_MEMORY_LIMIT_MB
+
+K = T.TypeVar("K")
+V = T.TypeVar("V")
+
+_MISSING = object()
+
+
+def current_rss() -> int:
+    """resident memory of this process in bytes"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class SpillingAggregator(T.Generic[K, V]):
+    """
+    Behaves (mostly) like a dictionary of partial aggregates, but if the
+    process goes over its memory ceiling, everything held so far is written
+    out to scratch as a run sorted by key, and we start again with an empty
+    dictionary. When we're done, `items()` does a k-way merge of all the
+    runs, combining values with the same key using `merge`.
+
+    Keys must be sortable, and values picklable (they'd have to be anyway
+    to get sent over MPI or back from a multiprocessing Pool).
+
+    Nothing spills by itself - whoever's filling it calls `maybe_spill`
+    between blocks, once nothing's holding on to a value it got from us.
+    (Otherwise a spill between getting a value and updating it would lose
+    the update, as the value's already been written to the run.)
+
+    Once we've spilled once, we know roughly how many entries fit in
+    memory, so after that we spill based on the number of entries - Python
+    doesn't hand freed memory back to the OS, so the RSS won't go down.
+    """
+
+    def __init__(self,
+                 merge: T.Callable[[V, V], V],
+                 factory: T.Optional[T.Callable[[], V]] = None,
+                 memory_limit_mb: T.Optional[int] = SPILL_MEMORY_LIMIT_MB,
+                 scratch_dir: str = SPILL_DIR) -> None:
+        self.merge = merge
+        self.factory = factory
+        self.memory_limit = memory_limit_mb * 2**20 if memory_limit_mb else None
+        self.scratch_dir = scratch_dir
+
+        self._data: T.Dict[K, V] = {}
+        self._runs: T.List[str] = []
+        self._max_entries: T.Optional[int] = None
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __getitem__(self, key: K) -> V:
+        try:
+            return self._data[key]
+        except KeyError:
+            if self.factory is None:
+                raise
+            self._data[key] = self.factory()
+            return self._data[key]
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._data[key] = value
+
+    def add(self, key: K, value: V) -> None:
+        """merges a value in with whatever we've got for that key"""
+        if key in self._data:
+            self._data[key] = self.merge(self._data[key], value)
+        else:
+            self._data[key] = value
+
+    def maybe_spill(self) -> None:
+        """spills if we're over the memory ceiling - only call this when
+        nothing's partway through updating one of our values"""
+        if self.memory_limit is None or len(self._data) == 0:
+            return
+
+        if self._max_entries is not None:
+            if len(self._data) >= self._max_entries:
+                self.spill()
+        elif current_rss() > self.memory_limit:
+            self._max_entries = len(self._data)
+            self.spill()
+
+    def spill(self) -> None:
+        """writes everything we're holding out as a sorted run"""
+        fd, run_path = tempfile.mkstemp(
+            prefix="lurge-spill-", dir=self.scratch_dir)
+        with os.fdopen(fd, "wb") as run:
+            for key in sorted(self._data):
+                pickle.dump((key, self._data[key]), run,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._runs.append(run_path)
+        self._data = {}
+
+    @staticmethod
+    def _read_run(run_path: str) -> T.Iterator[T.Tuple[K, V]]:
+        with open(run_path, "rb") as run:
+            while True:
+                try:
+                    yield pickle.load(run)
+                except EOFError:
+                    return
+
+    def items(self) -> T.Iterator[T.Tuple[K, V]]:
+        """every key and its fully merged value. If we've spilled, these
+        come out in key order. This consumes the aggregator."""
+        if len(self._runs) == 0:
+            yield from self._data.items()
+            self._data = {}
+            return
+
+        if len(self._data) > 0:
+            self.spill()
+
+        try:
+            yield from self._merged([self._read_run(run) for run in self._runs])
+        finally:
+            self.close()
+
+    def _merged(self, streams: T.List[T.Iterator[T.Tuple[K, V]]]) -> T.Iterator[T.Tuple[K, V]]:
+        """k-way merge of sorted streams, combining values with the same key.
+        Values from earlier streams are merged into, so the last stream can
+        be our live data without it getting changed."""
+        current_key: T.Any = _MISSING
+        current: T.Any = _MISSING
+        for key, value in heapq.merge(*streams, key=lambda kv: kv[0]):
+            if current_key is not _MISSING and key == current_key:
+                current = self.merge(current, value)
+            else:
+                if current_key is not _MISSING:
+                    yield current_key, current
+                current_key, current = key, value
+
+        if current_key is not _MISSING:
+            yield current_key, current
+
+    def merged(self) -> T.Mapping[K, V]:
+        """
+        Every key and its fully merged value, as a mapping. If we haven't
+        spilled, that's just what's in memory - otherwise the runs are
+        merged (as a stream) into one more run on scratch, which is read
+        back as it's needed (see SpilledRun). This consumes the aggregator.
+        """
+        if len(self._runs) == 0:
+            data, self._data = self._data, {}
+            return data
+
+        fd, run_path = tempfile.mkstemp(
+            prefix="lurge-spill-", dir=self.scratch_dir)
+        os.close(fd)
+        try:
+            self.save(run_path)
+        finally:
+            self.close()
+            self._data = {}
+        return SpilledRun(run_path)
+
+    def save(self, path: str) -> None:
+        """
+        Writes everything we've aggregated so far (in memory and spilled)
+        to path as a single sorted run, without consuming anything - this
+        is for checkpointing, so we carry on afterwards.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as out:
+            for kv in self._merged([*[self._read_run(run) for run in self._runs],
+                                    iter(sorted(self._data.items(), key=lambda kv: kv[0]))]):
+                pickle.dump(kv, out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        """
+        Adds a run written by `save` into this aggregator. We take a copy
+        onto scratch, as our runs get removed when we're done with them.
+        """
+        fd, run_path = tempfile.mkstemp(
+            prefix="lurge-spill-", dir=self.scratch_dir)
+        with os.fdopen(fd, "wb") as run, open(path, "rb") as saved:
+            shutil.copyfileobj(saved, run)
+
+        self._runs.append(run_path)
+
+    def close(self) -> None:
+        """removes any runs left on scratch"""
+        for run_path in self._runs:
+            try:
+                os.remove(run_path)
+            except FileNotFoundError:
+                pass
+        self._runs = []
+
+
+class SpilledRun(T.Mapping[K, V]):
+    """
+    A sorted run (i.e. from SpillingAggregator.merged), as a read-only
+    mapping. Only where each key's value is in the file is kept in memory:
+    values are read back one at a time as they're asked for, and `items()`
+    goes through the file in key order. `close()` removes the file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._offsets: T.Dict[K, int] = {}
+        self._file: T.Optional[T.BinaryIO] = None
+        # the last value read, as it's often asked for again straight away
+        self._last: T.Tuple[T.Any, T.Any] = (_MISSING, None)
+
+        with open(path, "rb") as run:
+            while True:
+                offset = run.tell()
+                try:
+                    key, _ = pickle.load(run)
+                except EOFError:
+                    break
+                self._offsets[key] = offset
+
+    def __getitem__(self, key: K) -> V:
+        if self._last[0] == key:
+            return self._last[1]
+
+        offset = self._offsets[key]
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        self._file.seek(offset)
+        _, value = pickle.load(self._file)
+        self._last = (key, value)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._offsets
+
+    def __iter__(self) -> T.Iterator[K]:
+        return iter(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def items(self) -> T.Iterator[T.Tuple[K, V]]:  # type: ignore[override]
+        yield from SpillingAggregator._read_run(self.path)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
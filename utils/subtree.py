@@ -0,0 +1,416 @@
+from __future__ import annotations
+
+import argparse
+import bisect
+import datetime
+import glob
+import logging
+import logging.config
+import os
+import typing as T
+from dataclasses import dataclass
+
+import numpy as np
+
+import utils.finder
+import utils.pipeline
+from directory_config import (LOGGING_CONFIG, SUBTREE_DIR, SUBTREE_MEMORY_MB, VOLUMES,
+                              WRSTAT_DIR)
+from utils.blockfile import BlockFile, front_code, front_decode, write_block_file
+from utils.metrics import Metrics
+from utils.pipeline import SharedMemoryPipeline
+from utils.spill import SpillingAggregator
+from utils.wrstat import GID, MTIME, NLINK, PATH, SIZE, TYPE, UID, WrstatBlock, decode_path
+
+# Subtree indexes
+#
+# A wrstat file is in the order wrstat walked the tree, so the totals for
+# one directory mean reading the whole thing. Once it's been through
+# `python -m utils.subtree build`, every line is in one file per volume
+# per wrstat file:
+#     {SUBTREE_DIR}2022-06-01/scratch123.subtree
+#
+# sorted by path, so everything under a directory is in one run of it. It's
+# a block file, like the drill-down trees (see utils/blockfile.py): blocks
+# of BLOCK_RECORDS lines, each one's records (RECORD), then its paths,
+# front coded, and an index of the first and last path in every block, and
+# its totals. A query bisects the index, only decompresses the blocks at
+# either end of the run, and takes the totals of the ones in between from
+# the index.
+#
+# Paths are sorted by their components (as with the drill-down trees), so
+# they're kept with "\0" in place of "/", which sorts before anything
+# else. The lines get sorted on SPILL_DIR (see utils/spill.py), so it
+# doesn't matter how big the file is.
+
+MAGIC = b"LURGESUBTREE1\n"
+BLOCK_RECORDS = 4096
+
+# everything in a line apart from the path
+RECORD = np.dtype([
+    ("size", "<u8"),
+    ("uid", "<i8"),
+    ("gid", "<i8"),
+    ("mtime", "<i8"),
+    ("nlink", "<u8"),
+    ("type", "S1")
+])
+
+
+@dataclass(frozen=True)
+class SubtreeEntry:
+    path: str
+    type: str
+    size: int
+    uid: int
+    gid: int
+    mtime: int
+    nlink: int
+
+
+@dataclass(frozen=True)
+class SubtreeTotals:
+    """everything at or under a path - sizes are as they are in the wrstat
+    file, with no allowance for hardlinks, and anything that isn't a
+    directory counts as a file"""
+    size: int = 0
+    files: int = 0
+    directories: int = 0
+    mtime: int = 0
+
+    def __add__(self, other: SubtreeTotals) -> SubtreeTotals:
+        return SubtreeTotals(self.size + other.size, self.files + other.files,
+                             self.directories + other.directories,
+                             max(self.mtime, other.mtime))
+
+
+def _key(path: str) -> str:
+    return path.rstrip("/").replace("/", "\0")
+
+
+def _path(key: str) -> str:
+    return key.replace("\0", "/") or "/"
+
+
+def _totals(records: np.ndarray) -> SubtreeTotals:
+    directories = records["type"] == b"d"
+    return SubtreeTotals(
+        size=int(records["size"][~directories].sum()),
+        files=int((~directories).sum()),
+        directories=int(directories.sum()),
+        mtime=int(records["mtime"].max()) if len(records) > 0 else 0)
+
+
+def _records(data: bytes) -> T.Tuple[T.List[str], np.ndarray, int]:
+    """what the pool processes do with each batch of lines - decodes every
+    path, and sends them back (as keys) with the rest of the line, and how
+    many lines were skipped because their path couldn't be decoded"""
+    block = WrstatBlock(data)
+    records = np.zeros(len(block), dtype=RECORD)
+    if len(block) == 0:
+        return [], records, 0
+
+    for name, column, dtype in (("size", SIZE, np.uint64), ("uid", UID, np.int64),
+                                ("gid", GID, np.int64), ("mtime", MTIME, np.int64),
+                                ("nlink", NLINK, np.uint64)):
+        records[name] = block.ints(column, dtype)
+    records["type"] = block.column(TYPE)
+
+    keys: T.List[str] = []
+    decoded = np.ones(len(block), dtype=bool)
+    for i, path in enumerate(block.column(PATH)):
+        # as with process_block, a line we can't make sense of is skipped,
+        # rather than losing the whole index
+        try:
+            keys.append(_key(decode_path(path)))
+        except ValueError:
+            decoded[i] = False
+
+    skipped = len(block) - len(keys)
+    return keys, records[decoded] if skipped else records, skipped
+
+
+def _latest(_: T.Any, record: T.Any) -> T.Any:
+    # a path should only be in a wrstat file once, but if it isn't, the
+    # last one wins
+    return record
+
+
+def write_index(path: str, records: T.Iterable[T.Tuple[str, T.Tuple[T.Any, ...]]],
+                volume: int, wrstat_date: datetime.date) -> int:
+    """writes (already sorted) keys and records to path
+
+    :returns: how many records were written
+    """
+    written = 0
+    with write_block_file(path, MAGIC) as writer:
+        blocks: T.List[T.List[T.Any]] = []
+
+        def write_block(keys: T.List[str], rows: T.List[T.Tuple[T.Any, ...]]) -> None:
+            coded = front_code([key.encode("UTF-8") for key in keys])
+            block_records = np.array(rows, dtype=RECORD)
+
+            offset, length = writer.write(b"".join([
+                block_records.tobytes(),
+                np.array([shared for shared, _ in coded], dtype="<u4").tobytes(),
+                np.array([len(suffix) for _, suffix in coded], dtype="<u4").tobytes(),
+                *[suffix for _, suffix in coded]]))
+            totals = _totals(block_records)
+            blocks.append([keys[0], keys[-1], offset, length, len(keys),
+                           totals.size, totals.files, totals.directories, totals.mtime])
+
+        keys: T.List[str] = []
+        rows: T.List[T.Tuple[T.Any, ...]] = []
+        for key, record in records:
+            keys.append(key)
+            rows.append(record)
+            if len(keys) == BLOCK_RECORDS:
+                write_block(keys, rows)
+                written += len(keys)
+                keys, rows = [], []
+        if len(keys) > 0:
+            write_block(keys, rows)
+            written += len(keys)
+
+        writer.finish({
+            "volume": volume,
+            "wrstat_date": wrstat_date.isoformat(),
+            "records": written,
+            "blocks": blocks
+        })
+
+    return written
+
+
+def index_path(volume: int, wrstat_date: datetime.date,
+               subtree_dir: str = SUBTREE_DIR) -> str:
+    return f"{subtree_dir}{wrstat_date.isoformat()}/scratch{volume}.subtree"
+
+
+def build_index(volume: int, logger: logging.Logger,
+                pipeline: T.Optional[SharedMemoryPipeline] = None,
+                rebuild: bool = False) -> T.Tuple[str, Metrics]:
+    """
+    Builds the subtree index for a volume's latest wrstat file, unless
+    there already is one (or rebuild is set).
+
+    :returns: the path of the index, and the Metrics for this volume
+    """
+    if pipeline is None:
+        with utils.pipeline.local_pipeline() as pipeline:
+            return build_index(volume, logger, pipeline, rebuild)
+
+    metrics = Metrics("subtree_index", f"Volume {volume}")
+
+    with metrics.stage("find_report"):
+        report_path = utils.finder.find_report(f"scratch{volume}", WRSTAT_DIR, logger)
+    wr_date_str = report_path.split("/")[-1].split("_")[0]
+    wr_date = datetime.date(int(wr_date_str[:4]), int(
+        wr_date_str[4:6]), int(wr_date_str[6:8]))
+
+    path = index_path(volume, wr_date)
+    if os.path.exists(path) and not rebuild:
+        logger.info(f"already got a subtree index for scratch{volume} at {path}")
+        return path, metrics
+
+    records: SpillingAggregator[str, T.Tuple[T.Any, ...]] = SpillingAggregator(
+        _latest, memory_limit_mb=SUBTREE_MEMORY_MB)
+
+    skipped = 0
+
+    def merge(found: T.Tuple[T.List[str], np.ndarray, int]) -> None:
+        nonlocal skipped
+        keys, rows, block_skipped = found
+        skipped += block_skipped
+        for key, record in zip(keys, rows.tolist()):
+            records.add(key, record)
+        records.maybe_spill()
+
+    try:
+        _, lines_read = pipeline.run(
+            report_path, _records, (), merge, metrics, "read_wrstat")
+        logger.debug(f"Read {lines_read} lines from {volume}")
+        if skipped > 0:
+            logger.warning(f"skipped {skipped} lines in {report_path} whose paths couldn't be decoded")
+
+        with metrics.stage("write_index"):
+            # everything goes out to scratch at least once, so it all comes
+            # back sorted
+            records.spill()
+            written = write_index(path, records.items(), volume, wr_date)
+    finally:
+        records.close()
+
+    logger.info(f"wrote {written} lines for scratch{volume} to {path}")
+    return path, metrics
+
+
+def _decode_block(entry: T.List[T.Any], data: bytes) -> T.Tuple[T.List[str], np.ndarray]:
+    """the keys and records in a block"""
+    count = entry[4]
+    records = np.frombuffer(data, dtype=RECORD, count=count)
+    position = records.nbytes
+    shared = np.frombuffer(data, dtype="<u4", count=count, offset=position).tolist()
+    position += 4 * count
+    lengths = np.frombuffer(data, dtype="<u4", count=count, offset=position).tolist()
+    position += 4 * count
+
+    suffixes: T.List[bytes] = []
+    for length in lengths:
+        suffixes.append(data[position:position + length])
+        position += length
+    return [key.decode("UTF-8") for key in front_decode(zip(shared, suffixes))], records
+
+
+class SubtreeIndex:
+    """
+    Reads a subtree index written by write_index - only the blocks a query
+    needs get read (see utils/blockfile.BlockFile).
+
+    Paths are as they are in the wrstat file (i.e. not after MDT_SYMLINKS).
+    """
+
+    def __init__(self, path: str, cached_blocks: int = 16) -> None:
+        self.path = path
+        self._file: BlockFile[T.Tuple[T.List[str], np.ndarray]] = BlockFile(
+            path, MAGIC, "subtree index", _decode_block, cached_blocks)
+
+        index = self._file.index
+        self.volume: int = index["volume"]
+        self.wrstat_date = datetime.date.fromisoformat(index["wrstat_date"])
+        self.records: int = index["records"]
+
+        self._first_keys: T.List[str] = [block[0] for block in self._file.blocks]
+        self._last_keys: T.List[str] = [block[1] for block in self._file.blocks]
+        self._block_totals: T.List[SubtreeTotals] = [
+            SubtreeTotals(*block[5:]) for block in self._file.blocks]
+
+    def __enter__(self) -> SubtreeIndex:
+        return self
+
+    def __exit__(self, *_: T.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _range(self, key: str) -> T.Tuple[range, str]:
+        """the blocks that could have anything at or under key in them, and
+        the key everything under it comes before"""
+        # everything under key starts with key + "\0", so comes before this
+        upper = key + "\x01"
+        start = max(0, bisect.bisect_right(self._first_keys, key) - 1)
+        return range(start, bisect.bisect_left(self._first_keys, upper)), upper
+
+    def totals(self, path: str) -> SubtreeTotals:
+        """the totals for everything at or under path"""
+        key = _key(path)
+        totals = SubtreeTotals()
+        blocks, upper = self._range(key)
+        for i in blocks:
+            if self._first_keys[i] >= key and self._last_keys[i] < upper:
+                totals += self._block_totals[i]
+            else:
+                keys, records = self._file.block(i)
+                totals += _totals(records[bisect.bisect_left(keys, key):
+                                          bisect.bisect_left(keys, upper)])
+        return totals
+
+    def entries(self, path: str, depth: T.Optional[int] = None) -> T.Iterator[SubtreeEntry]:
+        """everything at or under path, down to depth levels below it, with
+        each directory straight before everything under it"""
+        key = _key(path)
+        levels = key.count("\0")
+        blocks, upper = self._range(key)
+        for i in blocks:
+            keys, records = self._file.block(i)
+            start, end = bisect.bisect_left(keys, key), bisect.bisect_left(keys, upper)
+            for found, record in zip(keys[start:end], records[start:end].tolist()):
+                if depth is not None and found.count("\0") - levels > depth:
+                    continue
+                size, uid, gid, mtime, nlink, file_type = record
+                yield SubtreeEntry(_path(found), file_type.decode(), size, uid, gid, mtime, nlink)
+
+    def lookup(self, path: str) -> T.Optional[SubtreeEntry]:
+        """the line for just path, if there is one"""
+        return next(self.entries(path, 0), None)
+
+    def __len__(self) -> int:
+        return self.records
+
+
+def find_index(volume: int, date: T.Optional[str] = None,
+               subtree_dir: str = SUBTREE_DIR) -> T.Optional[SubtreeIndex]:
+    """the subtree index for a volume's wrstat file from a date (as an ISO
+    date string), or the most recent one if there's no date"""
+    if date is not None:
+        path = index_path(volume, datetime.date.fromisoformat(date), subtree_dir)
+        return SubtreeIndex(path) if os.path.exists(path) else None
+
+    found = sorted(glob.glob(f"{subtree_dir}*/scratch{volume}.subtree"))
+    return SubtreeIndex(found[-1]) if len(found) > 0 else None
+
+
+def main(volumes: T.List[int] = VOLUMES, processes: T.Optional[int] = None,
+         rebuild: bool = False) -> None:
+    """builds the subtree index for every volume's latest wrstat file"""
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+    metrics = Metrics("subtree_index")
+
+    with metrics.stage("wait_for_volumes"):
+        results = utils.pipeline.run_volumes(
+            lambda volume, pipeline: build_index(volume, logger, pipeline, rebuild),
+            volumes, processes)
+
+    for _, volume_metrics in results:
+        metrics.merge(volume_metrics)
+    logger.info(f"run metrics written to {metrics.write_summary()}")
+
+
+if __name__ == "__main__":
+    """
+    Builds the subtree indexes, or looks things up in them, i.e.:
+        python -m utils.subtree build 123 124 --processes 16
+        python -m utils.subtree totals 123 /lustre/scratch123/hgi/projects/foo
+        python -m utils.subtree list 123 /lustre/scratch123/hgi/projects/foo --depth 1
+    """
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="index the latest wrstat files")
+    build.add_argument("volumes", type=int, nargs="*", default=VOLUMES)
+    build.add_argument("--processes", type=int, default=None,
+                       help="number of processes to read the files with (defaults to the number of CPUs)")
+    build.add_argument("--rebuild", action="store_true",
+                       help="index them again, even if they already have been")
+
+    for command in ("totals", "list"):
+        query = commands.add_parser(command)
+        query.add_argument("volume", type=int)
+        query.add_argument("path")
+        query.add_argument("--date", default=None,
+                           help="the date of the wrstat file (YYYY-MM-DD), defaults to the latest")
+        if command == "list":
+            query.add_argument("--depth", type=int, default=None,
+                               help="how many levels below path to show (defaults to all of them)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        main(args.volumes, args.processes, args.rebuild)
+    else:
+        index = find_index(args.volume, args.date)
+        if index is None:
+            raise SystemExit(f"no subtree index for scratch{args.volume}")
+
+        with index:
+            if args.command == "totals":
+                totals = index.totals(args.path)
+                print("\t".join([
+                    args.path, str(totals.size), str(totals.files), str(totals.directories),
+                    datetime.date.fromtimestamp(totals.mtime).isoformat() if totals.mtime else "-"]))
+            else:
+                for entry in index.entries(args.path, args.depth):
+                    print("\t".join([
+                        entry.path, entry.type, str(entry.size), str(entry.uid), str(entry.gid),
+                        datetime.date.fromtimestamp(entry.mtime).isoformat()]))
@@ -1,10 +1,61 @@
+from __future__ import annotations
+
+import functools
 import re
+import typing as T
 
 from directory_config import MDT_SYMLINKS
 
+# a regex that could match a "/" other than a literal one
+_MATCHES_SLASH = re.compile(r"(?<!\\)\.|\\[WSD]|\[\^")
+
+
+class PathTranslator:
+    """
+    Rewrites paths using a mapping of {regex: replacement}, where the regex
+    has to match from the start of the path (i.e. MDT_SYMLINKS, turning the
+    real MDT paths into the human readable ones). The first one that matches
+    wins.
+
+    All the regexes are compiled into one anchored pattern, and the result
+    is cached per path prefix - the regexes can only match as many path
+    components as they've got `/` in, so everything after that is tacked
+    on unchanged, and paths under the same directory share a cache entry.
+    This makes it cheap enough to use on every line of a wrstat file.
+    """
+
+    def __init__(self, mappings: T.Dict[str, str], cache_size: int = 2**16) -> None:
+        self._replacements = list(mappings.values())
+        self._matcher = re.compile("|".join(
+            f"(?P<m{i}>{pattern})" for i, pattern in enumerate(mappings)))
+
+        # if any of them could match a "/", we can't tell where the part
+        # we need to look at ends, so we'll have to cache whole paths
+        self._depth: T.Optional[int] = None
+        if len(mappings) > 0 and not any(_MATCHES_SLASH.search(p) for p in mappings):
+            self._depth = max(pattern.count("/") for pattern in mappings) + 1
+
+        self._translate_prefix = functools.lru_cache(
+            maxsize=cache_size)(self._translate_uncached)
+
+    def _translate_uncached(self, prefix: str) -> str:
+        match = self._matcher.match(prefix)
+        if match is None:
+            return prefix
+        return self._replacements[int(T.cast(str, match.lastgroup)[1:])] + prefix[match.end():]
+
+    def __call__(self, path: str) -> str:
+        if self._depth is None:
+            return self._translate_prefix(path)
+
+        # the last element is everything past the part the mappings could
+        # match (if the path's that long)
+        parts = path.split("/", self._depth)
+        if len(parts) <= self._depth:
+            return self._translate_prefix(path)
+
+        cut = len(path) - len(parts[-1]) - 1
+        return self._translate_prefix(path[:cut]) + path[cut:]
+
 
-def get_mdt_symlink(path: str) -> str:
-    for full_path, human_path in MDT_SYMLINKS.items():
-        if re.match(full_path, path):
-            return re.sub(full_path, human_path, path)
-    return path
+get_mdt_symlink = PathTranslator(MDT_SYMLINKS)
@@ -10,6 +10,7 @@ from directory_config import FILETYPES, REPORT_DIR
 from lurge_types.group_report import GroupReport
 from lurge_types.user import UserReport
 from utils import humanise
+from utils.drilldown import DrilldownIndex
 
 
 def create_tsv_report(group_reports: T.List[T.List[GroupReport]],
@@ -40,7 +41,7 @@ def create_tsv_report(group_reports: T.List[T.List[GroupReport]],
     logger.info("{} created.".format(name))
 
 
-def create_tsv_user_report(user_reports: T.Dict[int, T.DefaultDict[str, UserReport]], usernames: T.Dict[int, str],
+def create_tsv_user_report(user_reports: T.Dict[int, T.Mapping[str, UserReport]], usernames: T.Dict[int, str],
                            user_groups: T.Dict[str, T.Set[T.Tuple[str, str]]], logger: logging.Logger) -> None:
     logger.info("Writing user report info to TSV file")
     with open(f"{REPORT_DIR}user-reports/{datetime.today().strftime('%Y-%m-%d')}.tsv", "w", newline="") as rf:
@@ -99,3 +100,35 @@ def create_tsv_inspector_report(
                         report.pi_name or "",
                         report.group_name or ""
                     ])
+
+
+def create_tsv_drilldown_report(tree_paths: T.List[str], date: str,
+                                logger: logging.LoggerAdapter[logging.Logger]) -> None:
+    """the drill-down trees (see utils/drilldown.py) in the same layout as
+    the inspector report, with a row for each directory"""
+    logger.info("writing drill-down trees to TSV file")
+
+    _filetypes = sorted(FILETYPES.keys())
+
+    with open(f"{REPORT_DIR}inspector-reports/{date}.drilldown.tsv", "w", newline="") as rf:
+        writer = csv.writer(rf, delimiter="\t", quoting=csv.QUOTE_NONE, escapechar="\\")
+        writer.writerow([
+            "Directory",
+            "Size",
+            *_filetypes,
+            "Num Files",
+            "Last Modified",
+            "Group"
+        ])
+
+        for tree_path in tree_paths:
+            with DrilldownIndex(tree_path) as index:
+                for entry in index:
+                    writer.writerow([
+                        entry.path,
+                        str(humanise(entry.size)),
+                        *[str(humanise(entry.filetypes.get(x, 0))) for x in _filetypes],
+                        str(entry.num_files),
+                        str(max(0, round((index.wrstat_time - entry.mtime) / 86400, 1))),
+                        entry.group_name or ""
+                    ])
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import threading
+import typing as T
+
+from directory_config import VAULT_INDEX, VAULT_SWEEP_DAYS
+from utils.filters import AnyFilter, Filter, LineFilter
+
+# Vault Locations
+#
+# Vaults only live in a few .vault directories, which hardly ever change,
+# so rather than looking at every path on a volume for them, puppeteer
+# remembers where they were last time. Then it only needs the files under
+# those directories (which are matched on their base 64, without decoding
+# anything - see utils/filters.py), and the directories with .vault in
+# their path, which is how we spot a new one. If there is a new one, we've
+# skipped its files, so they're read in another (filtered) pass.
+#
+# Every VAULT_SWEEP_DAYS days, or if we don't know anything about a volume,
+# we look at everything with .vault in its path instead.
+
+# everything that could be in a vault, or be one
+SWEEP_FILTER = LineFilter(path_contains=("/.vault",))
+
+# volumes are read in threads of the same process, and they all share the
+# one file
+_lock = threading.Lock()
+
+
+def vault_location(path: str) -> T.Optional[str]:
+    """the .vault directory a path is in (or is), if there is one"""
+    path_elems = path.split("/")
+    if ".vault" not in path_elems:
+        return None
+    return "/".join(path_elems[:path_elems.index(".vault") + 1])
+
+
+def files_under(locations: T.Iterable[str]) -> LineFilter:
+    return LineFilter(types=frozenset({"f"}),
+                      path_prefixes=tuple(sorted(f"{location}/" for location in locations)))
+
+
+class VaultIndex:
+    """
+    Where the .vault directories on a volume were, as of the last run, and
+    the ones this run's found (in found, which whoever reads the wrstat
+    file fills in). known is None if this run has to sweep.
+    """
+
+    def __init__(self, volume: int, wrstat_date: datetime.date, sweep: bool = False,
+                 index_path: T.Optional[str] = VAULT_INDEX,
+                 sweep_days: T.Optional[int] = VAULT_SWEEP_DAYS) -> None:
+        self.volume = volume
+        self.wrstat_date = wrstat_date
+        self.index_path = index_path
+        self.found: T.Set[str] = set()
+
+        entry = self._load().get(str(volume))
+        self.known: T.Optional[T.List[str]] = None
+        self.swept: T.Optional[datetime.date] = None
+        if entry is not None:
+            self.swept = datetime.datetime.strptime(entry["swept"], "%Y%m%d").date()
+            if not sweep and sweep_days is not None and \
+                    (wrstat_date - self.swept).days < sweep_days:
+                self.known = entry["locations"]
+
+    @property
+    def sweep(self) -> bool:
+        return self.known is None
+
+    def line_filter(self) -> Filter:
+        """the lines we need to read to find every vault"""
+        if self.known is None:
+            return SWEEP_FILTER
+        return AnyFilter((files_under(self.known),
+                          LineFilter(types=frozenset({"d"}), path_contains=("/.vault",))))
+
+    def new_locations(self) -> T.List[str]:
+        """the .vault directories we didn't know about, so didn't read the
+        files in - there aren't any if we swept"""
+        if self.known is None:
+            return []
+        return sorted(self.found - set(self.known))
+
+    def _load(self) -> T.Dict[str, T.Any]:
+        if self.index_path is None:
+            return {}
+        try:
+            with open(self.index_path) as f:
+                index: T.Dict[str, T.Any] = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        return index
+
+    def save(self) -> None:
+        """records the .vault directories we found, for next time. If
+        we can't, the next run will just have to sweep"""
+        if self.index_path is None:
+            return
+
+        swept = self.wrstat_date if self.sweep else self.swept
+        with _lock:
+            index = self._load()
+            index[str(self.volume)] = {
+                "swept": T.cast(datetime.date, swept).strftime("%Y%m%d"),
+                "locations": sorted(self.found)
+            }
+            try:
+                with open(f"{self.index_path}.{os.getpid()}.tmp", "w") as f:
+                    json.dump(index, f)
+                os.replace(f"{self.index_path}.{os.getpid()}.tmp", self.index_path)
+            except OSError:
+                pass
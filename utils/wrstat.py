@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import base64
+import gzip
+import typing as T
+
+import numpy as np
+
+# The columns of a wrstat line
+#     Index   Item
+#     0       File Path (base 64 encoded)
+#     1       Size (bytes)
+#     2       Owner (User ID)
+#     3       Group (Group ID)
+#     4       Last Accessed Time (Unix)
+#     5       Last Modified Time (Unix)
+#     6       Last Changed Time (Unix)
+#     7       File Type (f = file, d = directory)
+#     8       Inode ID
+#     9       Number of Hardlinks
+#     10      Device ID
+PATH, SIZE, UID, GID, ATIME, MTIME, CTIME, TYPE, INODE, NLINK, DEV = range(11)
+COLUMNS = 11
+
+# how much of a wrstat file read_blocks reads at a time
+BLOCK_BYTES = 4 * 2**20
+
+
+def decode_path(encoded: bytes) -> str:
+    """the path from a wrstat line, from its base 64"""
+    return base64.b64decode(encoded).decode("UTF-8", "replace")
+
+
+class WrstatBlock:
+    """
+    A block of wrstat lines, kept as the bytes they came out of the gzip
+    file as, and split into columns.
+
+    Nothing gets decoded until it's asked for - a column is a list of
+    bytes, `ints` turns a whole column into a numpy array in one go, and
+    paths are only base 64 decoded one at a time, for the lines that need
+    them. Anything that only needs the numbers never has to look at the
+    paths at all.
+
+    Lines with fewer than 11 columns are skipped.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        fields = data.split()
+        lines = data.count(b"\n") + (0 if data.endswith(b"\n") or len(data) == 0 else 1)
+
+        self._lines: T.Optional[T.List[bytes]] = None
+        if len(fields) != lines * COLUMNS:
+            # something's not right - either there are blank lines, or
+            # some of them don't have 11 columns, so we'll have to go
+            # line by line
+            self._lines = []
+            fields = []
+            for line in data.split(b"\n"):
+                line_fields = line.split()
+                if len(line_fields) >= COLUMNS:
+                    self._lines.append(line)
+                    fields.extend(line_fields[:COLUMNS])
+
+        self._data = data
+        self._fields = fields
+        self._columns: T.Dict[int, T.List[bytes]] = {}
+        self._ints: T.Dict[T.Tuple[int, T.Any], np.ndarray] = {}
+
+    @classmethod
+    def from_lines(cls, lines: T.Collection[str]) -> WrstatBlock:
+        """a block from lines that have already been decoded (with or
+        without their newlines)"""
+        if next(iter(lines), "").endswith("\n"):
+            return cls("".join(lines).encode("ascii"))
+        return cls("\n".join(lines).encode("ascii"))
+
+    def __len__(self) -> int:
+        return len(self._fields) // COLUMNS
+
+    def column(self, index: int) -> T.List[bytes]:
+        """one column, as it is in the file"""
+        if index not in self._columns:
+            self._columns[index] = self._fields[index::COLUMNS]
+        return self._columns[index]
+
+    def ints(self, index: int, dtype: T.Any = np.int64) -> np.ndarray:
+        """one (numeric) column as a numpy array - inodes should be
+        np.uint64, as they can be too big for an int64
+
+        :raises ValueError: if any of the column isn't an integer that fits
+            in dtype, saying which lines
+        """
+        if (index, dtype) not in self._ints:
+            column = self.column(index)
+            values: T.Optional[np.ndarray] = np.empty(0, dtype=dtype)
+            if len(column) > 0:
+                try:
+                    values = np.fromstring(b" ".join(column), dtype=dtype, sep=" ")
+                except ValueError:
+                    values = None
+
+                # fromstring can stop short, and clamps anything too big to
+                # the biggest value there is, so if it looks like it has,
+                # we go through the column properly
+                limits = np.iinfo(dtype)
+                if values is None or len(values) != len(column) or \
+                        (values == limits.max).any() or \
+                        (limits.min < 0 and (values == limits.min).any()):
+                    values = self._checked_ints(index, dtype)
+
+            self._ints[(index, dtype)] = values
+        return self._ints[(index, dtype)]
+
+    def _checked_ints(self, index: int, dtype: T.Any) -> np.ndarray:
+        """ints, a field at a time, so we can say where the problems are"""
+        column = self.column(index)
+        limits = np.iinfo(dtype)
+        values = np.empty(len(column), dtype=dtype)
+        bad: T.List[int] = []
+        for i, field in enumerate(column):
+            try:
+                value = int(field)
+            except ValueError:
+                bad.append(i)
+                continue
+            if not limits.min <= value <= limits.max:
+                bad.append(i)
+                continue
+            values[i] = value
+
+        if len(bad) > 0:
+            lines = self.lines()
+            raise ValueError(
+                f"{len(bad)} wrstat line(s) don't have an integer that fits in "
+                f"{np.dtype(dtype).name} in column {index}, i.e. " + "; ".join(
+                    f"line {i + 1} of the block: {lines[i][:200]!r}" for i in bad[:5]))
+        return values
+
+    def path(self, i: int) -> str:
+        """the decoded path for line i"""
+        return decode_path(self.column(PATH)[i])
+
+    def lines(self) -> T.List[bytes]:
+        """the lines themselves, without their newlines"""
+        if self._lines is None:
+            self._lines = self._data.split(b"\n")
+            if len(self._lines[-1]) == 0:
+                self._lines.pop()
+        return self._lines
+
+
+def read_chunks(wrstat: T.BinaryIO, chunk_bytes: int = BLOCK_BYTES,
+                max_line: int = 2**20) -> T.Iterator[bytes]:
+    """
+    Reads an (already opened, binary) wrstat file in chunks of about
+    chunk_bytes, each cut at the end of its last full line (apart from the
+    last, if the file doesn't end with a newline).
+
+    :raises ValueError: if there's a line longer than max_line
+    """
+    leftover = b""
+    while True:
+        chunk = wrstat.read(chunk_bytes)
+        if len(chunk) == 0:
+            if len(leftover) > 0:
+                yield leftover
+            return
+
+        data = leftover + chunk
+        cut = data.rfind(b"\n") + 1
+        # the start of a line we'll finish next time - so no chunk is
+        # ever more than chunk_bytes + max_line
+        leftover = data[cut:]
+        if len(leftover) > max_line:
+            raise ValueError(
+                f"found a line in {getattr(wrstat, 'name', 'wrstat')} longer than {max_line} bytes")
+
+        if cut > 0:
+            yield data[:cut]
+
+
+def read_blocks(report_path: str, block_bytes: int = BLOCK_BYTES) -> T.Iterator[WrstatBlock]:
+    """goes through a wrstat file a WrstatBlock at a time"""
+    with gzip.open(report_path, "rb") as wrstat:
+        for chunk in read_chunks(wrstat, block_bytes):
+            yield WrstatBlock(chunk)